@@ -8,9 +8,12 @@ from argparse import ArgumentParser
 from src.utils.preprocess import CropAndExtract
 from src.test_audio2coeff import Audio2Coeff  
 from src.facerender.animate import AnimateFromCoeff
-from src.generate_batch import get_data
 from src.generate_facerender_batch import get_facerender_data
 from src.utils.init_path import init_path
+from src.utils.backend import BACKENDS, default_export_dir
+from src.utils.ref_cache import default_ref_cache_dir
+from src.utils.coeff_cache import default_coeff_cache_dir
+from src.utils.audio import AudioBuffer
 
 def main(args):
     #torch.backends.cudnn.enabled = False
@@ -33,19 +36,23 @@ def main(args):
     sadtalker_paths = init_path(args.checkpoint_dir, os.path.join(current_root_path, 'src/config'), args.size, args.old_version, args.preprocess)
 
     #init model
-    preprocess_model = CropAndExtract(sadtalker_paths, device)
+    export_dir = args.export_dir or default_export_dir(args.checkpoint_dir, args.size, args.preprocess)
+    ref_cache_dir = None if args.no_ref_cache else args.ref_cache_dir or default_ref_cache_dir(args.checkpoint_dir)
+    preprocess_model = CropAndExtract(sadtalker_paths, device, backend=args.backend, export_dir=export_dir, ref_cache_dir=ref_cache_dir)
 
-    audio_to_coeff = Audio2Coeff(sadtalker_paths,  device)
+    coeff_cache_dir = None if args.no_coeff_cache else args.coeff_cache_dir or default_coeff_cache_dir(args.checkpoint_dir)
+    audio_to_coeff = Audio2Coeff(sadtalker_paths,  device, backend=args.backend, export_dir=export_dir, coeff_cache_dir=coeff_cache_dir)
     
-    animate_from_coeff = AnimateFromCoeff(sadtalker_paths, device)
+    animate_from_coeff = AnimateFromCoeff(sadtalker_paths, device, precision=args.precision, channels_last=args.channels_last,
+                                          backend=args.backend, export_dir=export_dir)
 
     #crop image and extract 3dmm from image
     first_frame_dir = os.path.join(save_dir, 'first_frame_dir')
     os.makedirs(first_frame_dir, exist_ok=True)
     print('3DMM Extraction for source image')
-    first_coeff_path, crop_pic_path, crop_info =  preprocess_model.generate(pic_path, first_frame_dir, args.preprocess,\
-                                                                             source_image_flag=True, pic_size=args.size)
-    if first_coeff_path is None:
+    first_coeff, crop_pic, crop_info =  preprocess_model.generate(pic_path, first_frame_dir, args.preprocess,\
+                                                                   source_image_flag=True, pic_size=args.size, persist=args.verbose)
+    if first_coeff is None:
         print("Can't get the coeffs of the input")
         return
 
@@ -54,38 +61,39 @@ def main(args):
         ref_eyeblink_frame_dir = os.path.join(save_dir, ref_eyeblink_videoname)
         os.makedirs(ref_eyeblink_frame_dir, exist_ok=True)
         print('3DMM Extraction for the reference video providing eye blinking')
-        ref_eyeblink_coeff_path, _, _ =  preprocess_model.generate(ref_eyeblink, ref_eyeblink_frame_dir, args.preprocess, source_image_flag=False)
+        ref_eyeblink_coeff =  preprocess_model.generate_ref_coeff(ref_eyeblink, ref_eyeblink_frame_dir, args.preprocess, detect_every=args.ref_detect_every, persist=args.verbose)
     else:
-        ref_eyeblink_coeff_path=None
+        ref_eyeblink_coeff=None
 
     if ref_pose is not None:
         if ref_pose == ref_eyeblink: 
-            ref_pose_coeff_path = ref_eyeblink_coeff_path
+            ref_pose_coeff = ref_eyeblink_coeff
         else:
             ref_pose_videoname = os.path.splitext(os.path.split(ref_pose)[-1])[0]
             ref_pose_frame_dir = os.path.join(save_dir, ref_pose_videoname)
             os.makedirs(ref_pose_frame_dir, exist_ok=True)
             print('3DMM Extraction for the reference video providing pose')
-            ref_pose_coeff_path, _, _ =  preprocess_model.generate(ref_pose, ref_pose_frame_dir, args.preprocess, source_image_flag=False)
+            ref_pose_coeff =  preprocess_model.generate_ref_coeff(ref_pose, ref_pose_frame_dir, args.preprocess, detect_every=args.ref_detect_every, persist=args.verbose)
     else:
-        ref_pose_coeff_path=None
+        ref_pose_coeff=None
 
-    #audio2ceoff
-    batch = get_data(first_coeff_path, audio_path, device, ref_eyeblink_coeff_path, still=args.still)
-    coeff_path = audio_to_coeff.generate(batch, save_dir, pose_style, ref_pose_coeff_path)
+    #audio2ceoff, the audio is decoded once for the mel and the muxer
+    audio = AudioBuffer.load(audio_path)
+    coeff = audio_to_coeff.generate_cached(first_coeff, audio, save_dir, pose_style, ref_eyeblink_coeff, ref_pose_coeff,
+                                           seed=args.seed, persist=args.verbose, still=args.still)
 
     # 3dface render
     if args.face3dvis:
         from src.face3d.visualize import gen_composed_video
-        gen_composed_video(args, device, first_coeff_path, coeff_path, audio_path, os.path.join(save_dir, '3dface.mp4'))
+        gen_composed_video(args, device, first_coeff, coeff, audio_path, os.path.join(save_dir, '3dface.mp4'))
     
     #coeff2video
-    data = get_facerender_data(coeff_path, crop_pic_path, first_coeff_path, audio_path, 
+    data = get_facerender_data(coeff, crop_pic, first_coeff, audio, 
                                 batch_size, input_yaw_list, input_pitch_list, input_roll_list,
-                                expression_scale=args.expression_scale, still_mode=args.still, preprocess=args.preprocess, size=args.size)
+                                expression_scale=args.expression_scale, still_mode=args.still, preprocess=args.preprocess, size=args.size, verbose=args.verbose)
     
     result = animate_from_coeff.generate(data, save_dir, pic_path, crop_info, \
-                                enhancer=args.enhancer, background_enhancer=args.background_enhancer, preprocess=args.preprocess, img_size=args.size)
+                                enhancer=args.enhancer, background_enhancer=args.background_enhancer, preprocess=args.preprocess, img_size=args.size, paste_method=args.paste_method, num_workers=args.render_workers)
     
     shutil.move(result, save_dir+'.mp4')
     print('The generated video is named:', save_dir+'.mp4')
@@ -101,6 +109,12 @@ if __name__ == '__main__':
     parser.add_argument("--source_image", default='./examples/source_image/full_body_1.png', help="path to source image")
     parser.add_argument("--ref_eyeblink", default=None, help="path to reference video providing eye blinking")
     parser.add_argument("--ref_pose", default=None, help="path to reference video providing pose")
+    parser.add_argument("--ref_cache_dir", default=None, help="cache of the reference video coefficients, checkpoints/ref_cache by default")
+    parser.add_argument("--no_ref_cache", action="store_true", help="extract the coefficients of the reference videos on every run")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the sampled pose and blinks, makes the result reproducible and cacheable")
+    parser.add_argument("--coeff_cache_dir", default=None, help="cache of the coefficients of seeded runs, checkpoints/coeff_cache by default")
+    parser.add_argument("--no_coeff_cache", action="store_true", help="predict the coefficients on every seeded run")
+    parser.add_argument("--ref_detect_every", type=int, default=1, help="detect the face every n frames of the reference videos, the box is tracked in between")
     parser.add_argument("--checkpoint_dir", default='./checkpoints', help="path to output")
     parser.add_argument("--result_dir", default='./results', help="path to output")
     parser.add_argument("--pose_style", type=int, default=0,  help="input pose style from [0, 46)")
@@ -116,6 +130,12 @@ if __name__ == '__main__':
     parser.add_argument("--face3dvis", action="store_true", help="generate 3d face and 3d landmarks") 
     parser.add_argument("--still", action="store_true", help="can crop back to the original videos for the full body aniamtion") 
     parser.add_argument("--preprocess", default='crop', choices=['crop', 'extcrop', 'resize', 'full', 'extfull'], help="how to preprocess the images" ) 
+    parser.add_argument("--precision", default='fp32', choices=['fp32', 'bf16'], help="precision of the face renderer, bf16 needs native support and falls back to fp32" ) 
+    parser.add_argument("--channels_last", action="store_true", help="channels last memory format for the face renderer convolutions" ) 
+    parser.add_argument("--backend", default='torch', choices=BACKENDS, help="run the networks in torch or from the models exported by scripts/export_models.py" ) 
+    parser.add_argument("--export_dir", default=None, help="directory of the exported models, checkpoints/exported/<size>_<crop|full> by default" ) 
+    parser.add_argument("--paste_method", default='poisson', choices=['poisson', 'feather'], help="how to paste the face back in full mode, feather is faster for a static background" ) 
+    parser.add_argument("--render_workers", type=int, default=1, help="render a long video in up to n segments in parallel processes, CPU only" ) 
     parser.add_argument("--verbose",action="store_true", help="saving the intermedia output or not" ) 
     parser.add_argument("--old_version",action="store_true", help="use the pth other than safetensor version" ) 
 
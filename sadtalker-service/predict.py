@@ -1,16 +1,44 @@
 """run bash scripts/download_models.sh first to prepare the weights file"""
 import os
 import shutil
+import tempfile
+import threading
+import time
 from argparse import Namespace
 from src.utils.preprocess import CropAndExtract
 from src.test_audio2coeff import Audio2Coeff
 from src.facerender.animate import AnimateFromCoeff
-from src.generate_batch import get_data
 from src.generate_facerender_batch import get_facerender_data
 from src.utils.init_path import init_path
+from src.utils.face_enhancer import FaceEnhancer
+from src.utils.ref_cache import default_ref_cache_dir
+from src.utils.coeff_cache import default_coeff_cache_dir
+from src.utils.audio import AudioBuffer
 from cog import BasePredictor, Input, Path
 
 checkpoints = "checkpoints"
+# seconds an output video is kept for cog to upload it, on disk
+output_ttl = 600
+
+
+def default_workspace_root():
+    """ tmpfs when the machine has one, the intermediate files of a prediction never touch the disk """
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+def purge_outputs(output_dir, ttl):
+    """ remove the output videos older than ttl seconds, cog has uploaded them long ago """
+    now = time.time()
+    for name in os.listdir(output_dir):
+        path = os.path.join(output_dir, name)
+        try:
+            if now - os.path.getmtime(path) > ttl:
+                os.remove(path)
+        except OSError:
+            # removed by a concurrent prediction
+            pass
 
 
 class Predictor(BasePredictor):
@@ -22,24 +50,28 @@ class Predictor(BasePredictor):
         sadtalker_paths = init_path(checkpoints,os.path.join("src","config"))
 
         # init model
-        self.preprocess_model = CropAndExtract(sadtalker_paths, device
+        self.preprocess_model = CropAndExtract(sadtalker_paths, device,
+            ref_cache_dir=default_ref_cache_dir(checkpoints),
         )
 
         self.audio_to_coeff = Audio2Coeff(
             sadtalker_paths,
             device,
+            coeff_cache_dir=default_coeff_cache_dir(checkpoints),
         )
 
-        self.animate_from_coeff = {
-            "full": AnimateFromCoeff(
-                sadtalker_paths,
-                device,
-            ),
-            "others": AnimateFromCoeff(
-                sadtalker_paths,
-                device,
-            ),
-        }
+        # the same paths serve every preprocess mode, one renderer is shared by all of them and
+        # by the concurrent predictions, which only run its networks in inference
+        self.animate_from_coeff = AnimateFromCoeff(sadtalker_paths, device)
+
+        # face enhancers keep per image state, they are loaded on first use by each thread and then kept
+        self.local = threading.local()
+
+    def get_face_enhancer(self, method, bg_upsampler=None):
+        enhancers = self.local.__dict__.setdefault("enhancers", {})
+        if (method, bg_upsampler) not in enhancers:
+            enhancers[method, bg_upsampler] = FaceEnhancer(method, bg_upsampler=bg_upsampler)
+        return enhancers[method, bg_upsampler]
 
     def predict(
         self,
@@ -71,36 +103,51 @@ class Predictor(BasePredictor):
             description="can crop back to the original videos for the full body aniamtion when preprocess is full",
             default=True,
         ),
+        seed: int = Input(
+            description="seed of the sampled pose and blinks, the same seed and inputs give the same motion",
+            default=None,
+        ),
     ) -> Path:
         """Run a single prediction on the model"""
 
-        animate_from_coeff = (
-            self.animate_from_coeff["full"]
-            if preprocess == "full"
-            else self.animate_from_coeff["others"]
-        )
+        # every prediction works in its own directory, removed before returning. The video is moved out of it
+        # to output_dir, where it stays for cog to upload until a later prediction purges it after output_ttl.
+        # the intermediate files stay in tmpfs, the videos waiting for their upload do not hold on to RAM
+        output_dir = os.path.join(tempfile.gettempdir(), "sadtalker_outputs")
+        os.makedirs(output_dir, exist_ok=True)
+        purge_outputs(output_dir, output_ttl)
+        work_dir = tempfile.mkdtemp(prefix="predict_", dir=default_workspace_root())
+        try:
+            video_path = self.run(work_dir, source_image, driven_audio, enhancer, preprocess, ref_eyeblink, ref_pose, still, seed)
+            if video_path is None:
+                return
+            output = os.path.join(output_dir, os.path.basename(work_dir) + ".mp4")
+            shutil.move(video_path, output)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        return Path(output)
+
+    def run(self, results_dir, source_image, driven_audio, enhancer, preprocess, ref_eyeblink, ref_pose, still, seed):
+        """ the prediction in results_dir, returns the path of the video """
+
+        animate_from_coeff = self.animate_from_coeff
 
         args = load_default()
         args.pic_path = str(source_image)
         args.audio_path = str(driven_audio)
-        device = "cuda"
         args.still = still
         args.ref_eyeblink = None if ref_eyeblink is None else str(ref_eyeblink)
         args.ref_pose = None if ref_pose is None else str(ref_pose)
 
         # crop image and extract 3dmm from image
-        results_dir = "results"
-        if os.path.exists(results_dir):
-            shutil.rmtree(results_dir)
-        os.makedirs(results_dir)
         first_frame_dir = os.path.join(results_dir, "first_frame_dir")
         os.makedirs(first_frame_dir)
 
         print("3DMM Extraction for source image")
-        first_coeff_path, crop_pic_path, crop_info = self.preprocess_model.generate(
+        first_coeff, crop_pic, crop_info = self.preprocess_model.generate(
             args.pic_path, first_frame_dir, preprocess, source_image_flag=True
         )
-        if first_coeff_path is None:
+        if first_coeff is None:
             print("Can't get the coeffs of the input")
             return
 
@@ -111,44 +158,45 @@ class Predictor(BasePredictor):
             ref_eyeblink_frame_dir = os.path.join(results_dir, ref_eyeblink_videoname)
             os.makedirs(ref_eyeblink_frame_dir, exist_ok=True)
             print("3DMM Extraction for the reference video providing eye blinking")
-            ref_eyeblink_coeff_path, _, _ = self.preprocess_model.generate(
+            ref_eyeblink_coeff = self.preprocess_model.generate_ref_coeff(
                 ref_eyeblink, ref_eyeblink_frame_dir
             )
         else:
-            ref_eyeblink_coeff_path = None
+            ref_eyeblink_coeff = None
 
         if ref_pose is not None:
             if ref_pose == ref_eyeblink:
-                ref_pose_coeff_path = ref_eyeblink_coeff_path
+                ref_pose_coeff = ref_eyeblink_coeff
             else:
                 ref_pose_videoname = os.path.splitext(os.path.split(ref_pose)[-1])[0]
                 ref_pose_frame_dir = os.path.join(results_dir, ref_pose_videoname)
                 os.makedirs(ref_pose_frame_dir, exist_ok=True)
                 print("3DMM Extraction for the reference video providing pose")
-                ref_pose_coeff_path, _, _ = self.preprocess_model.generate(
+                ref_pose_coeff = self.preprocess_model.generate_ref_coeff(
                     ref_pose, ref_pose_frame_dir
                 )
         else:
-            ref_pose_coeff_path = None
-
-        # audio2ceoff
-        batch = get_data(
-            first_coeff_path,
-            args.audio_path,
-            device,
-            ref_eyeblink_coeff_path,
+            ref_pose_coeff = None
+
+        # audio2ceoff, the audio is decoded once for the mel and the muxer
+        audio = AudioBuffer.load(args.audio_path)
+        coeff = self.audio_to_coeff.generate_cached(
+            first_coeff,
+            audio,
+            results_dir,
+            args.pose_style,
+            ref_eyeblink_coeff,
+            ref_pose_coeff,
+            seed=seed,
             still=still,
         )
-        coeff_path = self.audio_to_coeff.generate(
-            batch, results_dir, args.pose_style, ref_pose_coeff_path
-        )
         # coeff2video
         print("coeff2video")
         data = get_facerender_data(
-            coeff_path,
-            crop_pic_path,
-            first_coeff_path,
-            args.audio_path,
+            coeff,
+            crop_pic,
+            first_coeff,
+            audio,
             args.batch_size,
             args.input_yaw,
             args.input_pitch,
@@ -157,17 +205,11 @@ class Predictor(BasePredictor):
             still_mode=still,
             preprocess=preprocess,
         )
-        animate_from_coeff.generate(
+        return animate_from_coeff.generate(
             data, results_dir, args.pic_path, crop_info,
-            enhancer=enhancer, background_enhancer=args.background_enhancer,
+            enhancer=self.get_face_enhancer(enhancer, args.background_enhancer), background_enhancer=args.background_enhancer,
             preprocess=preprocess)
 
-        output = "/tmp/out.mp4"
-        mp4_path = os.path.join(results_dir, [f for f in os.listdir(results_dir) if "enhanced.mp4" in f][0])
-        shutil.copy(mp4_path, output)
-
-        return Path(output)
-
 
 def load_default():
     return Namespace(
@@ -0,0 +1,111 @@
+"""
+Peak memory and speed of the DenseMotionNetwork of the face renderer for several deform_chunk_size values,
+against the previous implementation that repeated the feature volume for every keypoint.
+
+    python scripts/benchmark_dense_motion.py --size 256 --batch_size 2 4 8
+
+The peak memory is the largest total size of the tensors allocated during one forward and alive at the same time,
+replayed from the allocation events of the torch profiler (the CUDA peak allocation above the inputs on a GPU),
+divided by the batch size. Weights are random, they do not change the memory or the speed.
+"""
+import os, sys, time
+from argparse import ArgumentParser
+
+import torch
+import torch.nn.functional as F
+import yaml
+from torch.profiler import ProfilerActivity, profile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.facerender.modules.dense_motion import DenseMotionNetwork
+
+
+class RepeatDenseMotionNetwork(DenseMotionNetwork):
+    """ the implementation before deform_chunk_size: repeat, one grid_sample, concatenation """
+
+    def create_deformed_feature(self, feature, sparse_motions):
+        bs, _, d, h, w = feature.shape
+        feature_repeat = feature.unsqueeze(1).unsqueeze(1).repeat(1, self.num_kp+1, 1, 1, 1, 1, 1)
+        feature_repeat = feature_repeat.view(bs * (self.num_kp+1), -1, d, h, w)
+        sparse_motions = sparse_motions.view((bs * (self.num_kp+1), d, h, w, -1))
+        sparse_deformed = F.grid_sample(feature_repeat, sparse_motions)
+        return sparse_deformed.view((bs, self.num_kp+1, -1, d, h, w))
+
+    def forward(self, feature, kp_driving, kp_source):
+        bs, _, d, h, w = feature.shape
+        feature = F.relu(self.norm(self.compress(feature)))
+        sparse_motion = self.create_sparse_motions(feature, kp_driving, kp_source)
+        deformed_feature = self.create_deformed_feature(feature, sparse_motion)
+        heatmap = self.create_heatmap_representations(deformed_feature, kp_driving, kp_source)
+        input_ = torch.cat([heatmap, deformed_feature], dim=2).reshape(bs, -1, d, h, w)
+        prediction = self.hourglass(input_)
+        mask = F.softmax(self.mask(prediction), dim=1).unsqueeze(2)
+        mask = torch.where(mask < 1e-3, torch.zeros_like(mask), mask)
+        deformation = (sparse_motion.permute(0, 1, 5, 2, 3, 4) * mask).sum(dim=1).permute(0, 2, 3, 4, 1)
+        occlusion_map = torch.sigmoid(self.occlusion(prediction.reshape(bs, -1, h, w)))
+        return {'deformation': deformation, 'occlusion_map': occlusion_map}
+
+
+def peak_cpu_memory(prof):
+    """ replay the allocations (positive) and frees (negative) recorded by the profiler in time order """
+    current = peak = 0
+    for event in sorted(prof.events(), key=lambda event: event.time_range.start):
+        current += event.self_cpu_memory_usage
+        peak = max(peak, current)
+    return peak
+
+
+def measure(config_path, size, batch_size, chunk_size, device):
+    torch.manual_seed(0)
+    config = yaml.safe_load(open(config_path))['model_params']
+    generator_params, common_params = config['generator_params'], config['common_params']
+    network = RepeatDenseMotionNetwork if chunk_size == 'repeat' else DenseMotionNetwork
+    dense_motion = network(num_kp=common_params['num_kp'], feature_channel=generator_params['reshape_channel'],
+                           estimate_occlusion_map=generator_params['estimate_occlusion_map'],
+                           **generator_params['dense_motion_params']).to(device).eval()
+    if chunk_size != 'repeat':
+        dense_motion.deform_chunk_size = chunk_size
+    depth = generator_params['dense_motion_params']['reshape_depth']
+    feature = torch.randn(batch_size, generator_params['reshape_channel'], depth, size // 4, size // 4, device=device)
+    kp_driving = {'value': torch.randn(batch_size, common_params['num_kp'], 3, device=device) * 0.3}
+    kp_source = {'value': torch.randn(batch_size, common_params['num_kp'], 3, device=device) * 0.3}
+
+    with torch.no_grad():
+        dense_motion(feature, kp_driving, kp_source)
+        if device == 'cuda':
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            before = torch.cuda.memory_allocated()
+            start = time.time()
+            dense_motion(feature, kp_driving, kp_source)
+            torch.cuda.synchronize()
+            elapsed = time.time() - start
+            peak = torch.cuda.max_memory_allocated() - before
+        else:
+            start = time.time()
+            with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+                dense_motion(feature, kp_driving, kp_source)
+            elapsed = time.time() - start
+            peak = peak_cpu_memory(prof)
+    return peak, elapsed
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--size', type=int, default=256, help='the image size of the facerender')
+    parser.add_argument('--batch_size', type=int, nargs='+', default=[2, 4])
+    parser.add_argument('--chunk_size', type=int, nargs='+', default=[0, 1, 4, 8], help='0 for all the keypoints at once')
+    parser.add_argument('--cpu', action='store_true')
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() and not args.cpu else 'cpu'
+    config_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src/config/facerender.yaml')
+
+    print('%-6s %-10s %18s %16s %12s' % ('batch', 'chunk', 'peak MB / frame', 'seconds / frame', 'vs repeat'))
+    for batch_size in args.batch_size:
+        reference = None
+        for chunk_size in ['repeat'] + [c or None for c in args.chunk_size]:
+            peak, elapsed = measure(config_path, args.size, batch_size, chunk_size, device)
+            reference = reference or peak
+            print('%-6d %-10s %18.1f %16.3f %11.2fx' % (batch_size, chunk_size or 'all', peak / batch_size / 2**20,
+                                                       elapsed / batch_size, peak / reference))
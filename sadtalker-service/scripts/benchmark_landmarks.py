@@ -0,0 +1,73 @@
+"""
+Throughput of the landmark extraction of the reference videos (KeypointExtractor in
+src/face3d/extract_kp_videos_safe.py), frame by frame against the batched path.
+
+    python scripts/benchmark_landmarks.py --video examples/ref_video/WDA_KatieHill_000.mp4 --cpu
+    python scripts/benchmark_landmarks.py --detect_every 1 5 10 --detect_size 256
+
+The frames are cropped and resized to --size as CropAndExtract does before landmarking, unless --full_frame is
+given. Each configuration reports frames/s and the largest and mean landmark distance, in pixels, to the frame by
+frame extraction.
+"""
+import os, sys, time
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.face3d.extract_kp_videos_safe import KeypointExtractor, read_video
+
+
+def reference_frames(video, size, max_frames, full_frame):
+    frames = read_video(video)[:max_frames]
+    if not full_frame:
+        frames = [frame.resize((size, size)) for frame in frames]
+    return frames
+
+
+def frame_by_frame(kp_extractor, frames):
+    keypoints = []
+    for frame in frames:
+        current_kp = kp_extractor.extract_keypoint(frame)
+        keypoints.append(keypoints[-1] if np.mean(current_kp) == -1 and keypoints else current_kp)
+    return np.stack(keypoints)
+
+
+def timed(fn, *args, **kwargs):
+    start = time.time()
+    out = fn(*args, **kwargs)
+    return out, time.time() - start
+
+
+if __name__ == '__main__':
+    current_root_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    parser = ArgumentParser()
+    parser.add_argument('--video', default=os.path.join(current_root_path, 'examples/ref_video/WDA_AlexandriaOcasioCortez_000.mp4'))
+    parser.add_argument('--max_frames', type=int, default=100)
+    parser.add_argument('--size', type=int, default=256, help='the frames are resized to size x size like in CropAndExtract')
+    parser.add_argument('--full_frame', action='store_true', help='landmark the decoded frames, not resized')
+    parser.add_argument('--batch_size', type=int, nargs='+', default=[4, 8, 16])
+    parser.add_argument('--detect_every', type=int, nargs='+', default=[1, 5])
+    parser.add_argument('--detect_size', type=int, nargs='+', default=[0], help='0 to detect at the frame size')
+    parser.add_argument('--cpu', action='store_true')
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() and not args.cpu else 'cpu'
+    kp_extractor = KeypointExtractor(device)
+    frames = reference_frames(args.video, args.size, args.max_frames, args.full_frame)
+    print('%d frames of %dx%d on %s' % (len(frames), frames[0].size[0], frames[0].size[1], device))
+
+    kp_extractor.extract_keypoint(frames[:2], info=False)
+    expected, elapsed = timed(frame_by_frame, kp_extractor, frames)
+    reference = len(frames) / elapsed
+    print('%-6s %-7s %-7s %10s %9s %14s %14s' % ('batch', 'every', 'det px', 'frames/s', 'speedup', 'max diff px', 'mean diff px'))
+    print('%-6s %-7s %-7s %10.2f %8.2fx %14s %14s' % ('-', 1, '-', reference, 1, '-', '-'))
+    for batch_size in args.batch_size:
+        for detect_every in args.detect_every:
+            for detect_size in args.detect_size:
+                keypoints, elapsed = timed(kp_extractor.extract_keypoint, frames, info=False, batch_size=batch_size,
+                                           detect_every=detect_every, detect_size=detect_size or None)
+                distance = np.linalg.norm(keypoints - expected, axis=-1)
+                print('%-6d %-7d %-7s %10.2f %8.2fx %14.2f %14.3f' % (batch_size, detect_every, detect_size or '-',
+                      len(frames) / elapsed, len(frames) / elapsed / reference, distance.max(), distance.mean()))
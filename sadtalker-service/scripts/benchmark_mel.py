@@ -0,0 +1,58 @@
+"""
+Mel spectrogram of the driving audio (src/utils/audio.py): melspectrogram, the librosa path, against the
+batched torch.stft path melspectrogram_batch and its cache.
+
+    python scripts/benchmark_mel.py --audio examples/driven_audio/bus_chinese.wav examples/driven_audio/japanese.wav
+    python scripts/benchmark_mel.py --batch_size 1 4 8 --cpu
+
+Each clip is cropped to whole video frames as get_data does. Reports the time per clip and the largest
+difference to melspectrogram, on the normalized scale of hparams (+-max_abs_value).
+"""
+import os, sys, glob, time
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.utils import audio as audio_utils
+from src.utils.audio import AudioBuffer
+from src.generate_batch import crop_pad_audio, parse_audio_length
+
+
+def timed(fn, *args, **kwargs):
+    start = time.time()
+    out = fn(*args, **kwargs)
+    return out, time.time() - start
+
+
+if __name__ == '__main__':
+    current_root_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    parser = ArgumentParser()
+    parser.add_argument('--audio', nargs='+', default=sorted(glob.glob(os.path.join(current_root_path, 'examples/driven_audio/*.wav'))))
+    parser.add_argument('--batch_size', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--cpu', action='store_true')
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() and not args.cpu else 'cpu'
+    audios = [AudioBuffer.load(path) for path in args.audio]
+    wavs = [crop_pad_audio(audio.wav, parse_audio_length(len(audio), 16000, 25)[0]) for audio in audios]
+    print('%d clips, %.1fs of audio, on %s' % (len(wavs), sum(len(wav) for wav in wavs) / 16000., device))
+
+    audio_utils.melspectrogram(wavs[0])
+    audio_utils.melspectrogram_batch(wavs[:1], device)
+    expected, elapsed = timed(lambda: [audio_utils.melspectrogram(wav) for wav in wavs])
+    reference = elapsed / len(wavs)
+    print('%-22s %12s %9s %10s' % ('mode', 'ms per clip', 'speedup', 'max diff'))
+    print('%-22s %12.1f %8.2fx %10s' % ('librosa', reference * 1000, 1, '-'))
+    for batch_size in args.batch_size:
+        mels, elapsed = timed(lambda: [mel for i in range(0, len(wavs), batch_size)
+                                       for mel in audio_utils.melspectrogram_batch(wavs[i:i + batch_size], device)])
+        diff = max(np.abs(mel - ref).max() for mel, ref in zip(mels, expected))
+        print('%-22s %12.1f %8.2fx %10.2e' % ('torch batch %d' % batch_size, elapsed / len(wavs) * 1000,
+                                              reference / (elapsed / len(wavs)), diff))
+
+    keys = [audio.digest for audio in audios]
+    audio_utils.cached_melspectrograms(keys, wavs, device)
+    _, elapsed = timed(audio_utils.cached_melspectrograms, keys, wavs, device)
+    print('%-22s %12.3f %8.0fx %10s' % ('cached', elapsed / len(wavs) * 1000, reference / (elapsed / len(wavs)), '0'))
@@ -0,0 +1,86 @@
+"""
+Speed and quality of the paste back used by --preprocess full.
+
+    python scripts/benchmark_paste.py --pic examples/source_image/full_body_1.png
+
+Without --video a synthetic moving crop is pasted. Quality is the PSNR of each method
+against the serial per-frame Poisson paste, which is what SadTalker has always done.
+"""
+import os, sys, time
+from argparse import ArgumentParser
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.utils.paste_pic import paste_frames
+
+
+def synthetic_frames(pic_path, box, num_frames, size=256):
+    full_img = cv2.cvtColor(cv2.imread(pic_path), cv2.COLOR_BGR2RGB)
+    ox1, oy1, ox2, oy2 = box
+    crop = cv2.resize(full_img[oy1:oy2, ox1:ox2], (size, size))
+    frames = []
+    for i in range(num_frames):
+        # small shifts and a brightness change, roughly what a talking head does to the crop
+        shift = np.float32([[1, 0, 4*np.sin(i/5.)], [0, 1, 3*np.cos(i/7.)]])
+        frame = cv2.warpAffine(crop, shift, (size, size), borderMode=cv2.BORDER_REFLECT)
+        frames.append(cv2.convertScaleAbs(frame, alpha=1.0 + 0.05*np.sin(i/3.)))
+    return frames
+
+
+def read_frames(video_path):
+    video_stream = cv2.VideoCapture(video_path)
+    frames = []
+    while 1:
+        still_reading, frame = video_stream.read()
+        if not still_reading:
+            video_stream.release()
+            break
+        frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+    return frames
+
+
+def psnr(a, b):
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    return float('inf') if mse == 0 else 10 * np.log10(255. ** 2 / mse)
+
+
+def run(frames, args, crop_info, **kwargs):
+    start = time.time()
+    out = list(paste_frames(iter(frames), args.pic, crop_info, **kwargs))
+    return out, time.time() - start
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--pic', required=True, help='full resolution source picture')
+    parser.add_argument('--video', default=None, help='rendered crop video, synthetic frames if not given')
+    parser.add_argument('--box', type=int, nargs=4, default=None, help='ox1 oy1 ox2 oy2 of the face in the picture, centred if not given')
+    parser.add_argument('--num_frames', type=int, default=100)
+    parser.add_argument('--workers', type=int, nargs='+', default=[2, 4])
+    args = parser.parse_args()
+
+    h, w = cv2.imread(args.pic).shape[:2]
+    if args.box is None:
+        side = min(h, w) // 2
+        args.box = [(w - side) // 2, (h - side) // 2, (w + side) // 2, (h + side) // 2]
+    ox1, oy1, ox2, oy2 = args.box
+    # crop_info as returned by CropAndExtract, with the crop being the whole picture
+    crop_info = ((w, h), (0, 0, w, h), (ox1, oy1, ox2, oy2))
+
+    frames = read_frames(args.video) if args.video else synthetic_frames(args.pic, args.box, args.num_frames)
+    print('%d frames of %s pasted into %dx%d at %s' % (len(frames), frames[0].shape[:2], w, h, args.box))
+
+    reference, ref_time = run(frames, args, crop_info, method='poisson', num_workers=0)
+    results = [('poisson serial', reference, ref_time)]
+    for num_workers in args.workers:
+        out, t = run(frames, args, crop_info, method='poisson', num_workers=num_workers)
+        results.append(('poisson %d workers' % num_workers, out, t))
+    out, t = run(frames, args, crop_info, method='feather')
+    results.append(('feather', out, t))
+
+    print('%-20s %10s %8s %12s %12s' % ('method', 'seconds', 'fps', 'speedup', 'psnr (dB)'))
+    for name, out, t in results:
+        quality = min(psnr(a, b) for a, b in zip(out, reference))
+        print('%-20s %10.3f %8.1f %11.2fx %12.2f' % (name, t, len(out) / t, ref_time / t, quality))
@@ -0,0 +1,71 @@
+"""
+Speed and quality of the face renderer in fp32 and bf16, with and without channels last.
+
+Run inference.py once (the coefficients are kept in the result directory), then
+
+    python scripts/benchmark_precision.py --source_image results/<time>/first_frame_dir/<name>.png \
+        --first_coeff_path results/<time>/first_frame_dir/<name>.mat --coeff_path results/<time>/<name>##<audio>.mat
+
+Quality is the PSNR of every mode against the fp32 frames.
+"""
+import os, sys, time
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.facerender.animate import AnimateFromCoeff, half_precision_supported
+from src.generate_facerender_batch import get_facerender_data
+from src.utils.init_path import init_path
+
+
+def psnr(a, b):
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    return float('inf') if mse == 0 else 10 * np.log10(255. ** 2 / mse)
+
+
+def render(animate_from_coeff, data, precision, max_frames):
+    frames = []
+    start = time.time()
+    for frame in animate_from_coeff.generate_frames(data, ((256, 256), None, None), precision=precision):
+        frames.append(frame)
+        if len(frames) == max_frames:
+            break
+    return frames, time.time() - start
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--source_image', required=True, help='cropped source image written by the preprocess')
+    parser.add_argument('--first_coeff_path', required=True)
+    parser.add_argument('--coeff_path', required=True, help='coefficients written by Audio2Coeff')
+    parser.add_argument('--checkpoint_dir', default='./checkpoints')
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--max_frames', type=int, default=50)
+    parser.add_argument('--cpu', action='store_true')
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() and not args.cpu else 'cpu'
+    current_root_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sadtalker_paths = init_path(args.checkpoint_dir, os.path.join(current_root_path, 'src/config'), args.size)
+    data = get_facerender_data(args.coeff_path, args.source_image, args.first_coeff_path, args.coeff_path,
+                               args.batch_size, size=args.size)
+    print('device %s, native reduced precision: %s' % (device, half_precision_supported(device)))
+
+    results = []
+    for channels_last in (False, True):
+        animate_from_coeff = AnimateFromCoeff(sadtalker_paths, device, channels_last=channels_last)
+        for precision in ('fp32', 'bf16'):
+            # the first batch pays for the one-off kernel selection, render it once before timing
+            render(animate_from_coeff, data, precision, args.batch_size)
+            frames, t = render(animate_from_coeff, data, precision, args.max_frames)
+            results.append(('%s%s' % (precision, ' channels_last' if channels_last else ''), frames, t))
+        del animate_from_coeff
+
+    reference, ref_time = results[0][1], results[0][2]
+    print('%-20s %10s %8s %10s %12s %12s' % ('mode', 'seconds', 'fps', 'speedup', 'min psnr', 'mean psnr'))
+    for name, frames, t in results:
+        quality = [psnr(a, b) for a, b in zip(frames, reference)]
+        print('%-20s %10.2f %8.2f %9.2fx %12.2f %12.2f' % (name, t, len(frames) / t, ref_time / t, min(quality), np.mean(quality)))
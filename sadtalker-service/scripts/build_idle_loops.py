@@ -0,0 +1,78 @@
+"""
+Render the idle loops (src/utils/idle_loops.py) of a set of avatars ahead of the requests, so that the first
+idle clip of an avatar is served by concatenation as well.
+
+    python scripts/build_idle_loops.py --source_image examples/source_image/art_0.png --seconds 4 8 --still
+
+The settings must be the ones of the idle requests, they are part of the key of the loops. The loops go to
+checkpoints/idle_loops unless --idle_dir is given, where the webui looks by default. Avatars with loops are
+skipped unless --force is given. With --serve, a clip of that many seconds is cut from the loops of every avatar
+and written next to the library, to check the loop point.
+"""
+import os, sys, shutil, tempfile, time
+from argparse import ArgumentParser
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.utils.init_path import init_path
+from src.utils.preprocess import CropAndExtract
+from src.test_audio2coeff import Audio2Coeff
+from src.facerender.animate import AnimateFromCoeff
+from src.utils.ref_cache import default_ref_cache_dir
+from src.utils.coeff_cache import default_coeff_cache_dir
+from src.utils.idle_loops import IdleLoopLibrary, IDLE_LOOP_SECONDS, default_idle_loop_dir, render_idle_loops
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--source_image', nargs='+', required=True)
+    parser.add_argument('--seconds', type=float, nargs='+', default=list(IDLE_LOOP_SECONDS), help='lengths of the loops')
+    parser.add_argument('--checkpoint_dir', default='./checkpoints')
+    parser.add_argument('--idle_dir', default=None, help='checkpoints/idle_loops by default')
+    parser.add_argument('--preprocess', default='crop', choices=['crop', 'extcrop', 'resize', 'full', 'extfull'])
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--still', action='store_true')
+    parser.add_argument('--enhancer', default=None, choices=['gfpgan', 'RestoreFormer'], help='face enhancer')
+    parser.add_argument('--expression_scale', type=float, default=1.)
+    parser.add_argument('--pose_style', type=int, default=0)
+    parser.add_argument('--no_blink', action='store_true')
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--force', action='store_true', help='render again the loops already in the library')
+    parser.add_argument('--serve', type=float, default=None, help='cut a clip of this many seconds from the loops')
+    parser.add_argument('--cpu', action='store_true')
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() and not args.cpu else 'cpu'
+    current_root_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sadtalker_paths = init_path(args.checkpoint_dir, os.path.join(current_root_path, 'src/config'), args.size, False, args.preprocess)
+    idle_loops = IdleLoopLibrary(args.idle_dir or default_idle_loop_dir(args.checkpoint_dir))
+    models = None
+
+    for source_image in args.source_image:
+        # the settings of SadTalker.idle in the webui and of the idle jobs of server.py
+        avatar = idle_loops.avatar_key(source_image, preprocess=args.preprocess, still=args.still, enhancer=args.enhancer,
+                                       size=args.size, pose_style=args.pose_style, expression_scale=args.expression_scale,
+                                       use_blink=not args.no_blink)
+        if idle_loops.loops(avatar) and not args.force:
+            print('cached   %s' % source_image)
+        else:
+            if models is None:
+                models = (CropAndExtract(sadtalker_paths, device, ref_cache_dir=default_ref_cache_dir(args.checkpoint_dir)),
+                          Audio2Coeff(sadtalker_paths, device, coeff_cache_dir=default_coeff_cache_dir(args.checkpoint_dir)),
+                          AnimateFromCoeff(sadtalker_paths, device))
+            start = time.time()
+            save_dir = tempfile.mkdtemp()
+            try:
+                render_idle_loops(idle_loops, avatar, source_image, *models, save_dir, seconds=args.seconds,
+                                  preprocess=args.preprocess, size=args.size, still=args.still,
+                                  enhancer=args.enhancer, expression_scale=args.expression_scale,
+                                  pose_style=args.pose_style, use_blink=not args.no_blink, batch_size=args.batch_size)
+            finally:
+                shutil.rmtree(save_dir)
+            print('rendered %s in %.1fs' % (source_image, time.time() - start))
+
+        if args.serve is not None:
+            start = time.time()
+            path = idle_loops.serve(avatar, args.serve, os.path.join(idle_loops.cache_dir, avatar, 'served.mp4'))
+            print('served   %.1fs in %.2fs: %s' % (args.serve, time.time() - start, path))
@@ -0,0 +1,102 @@
+"""
+Equivalence and speed of prepare_for_inference() (src/utils/prepare_model.py) on every SadTalker network.
+
+    python scripts/check_prepare_for_inference.py
+
+The networks are built from the configs with random weights. Batch norm statistics and affine parameters are
+randomised too, otherwise the folded batch norms would be close to identities and the check would prove little.
+Each network is run before and after the conversion on the same inputs. Folding only reorders float32 rounding,
+but the randomly initialised generator amplifies rounding a lot, so the difference is compared with the effect of
+a float32 rounding sized perturbation (relative 1e-7) of the original weights: the script fails when the largest
+absolute difference is above both --atol and twice that noise floor.
+"""
+import copy, os, sys, time
+from argparse import ArgumentParser
+
+import torch
+import yaml
+from torch import nn
+from yacs.config import CfgNode as CN
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.utils.prepare_model import prepare_for_inference
+from export_models import example_inputs, torch_outputs
+
+
+def random_networks(config_dir):
+    from src.facerender.modules.keypoint_detector import KPDetector
+    from src.facerender.modules.mapping import MappingNet
+    from src.facerender.modules.generator import OcclusionAwareSPADEGenerator
+    from src.audio2exp_models.networks import SimpleWrapperV2
+    from src.audio2pose_models.audio2pose import Audio2Pose
+    from src.face3d.models import networks
+
+    config = yaml.safe_load(open(os.path.join(config_dir, 'facerender.yaml')))['model_params']
+    audio2pose = Audio2Pose(CN.load_cfg(open(os.path.join(config_dir, 'auido2pose.yaml'))), None, device='cpu')
+    return {
+        'kp_detector': KPDetector(**config['kp_detector_params'], **config['common_params']),
+        'mapping': MappingNet(**config['mapping_params']),
+        'generator': OcclusionAwareSPADEGenerator(**config['generator_params'], **config['common_params']),
+        'audio2exp': SimpleWrapperV2(),
+        'audio_encoder': audio2pose.audio_encoder,
+        'pose_decoder': audio2pose.netG.decoder,
+        'net_recon': networks.define_net_recon(net_recon='resnet50', use_last_fc=False, init_path=''),
+    }
+
+
+def randomise_batch_norms(model):
+    with torch.no_grad():
+        for module in model.modules():
+            if isinstance(module, nn.modules.batchnorm._BatchNorm):
+                module.running_mean.normal_(0, 0.1)
+                module.running_var.uniform_(0.5, 2)
+                if module.affine:
+                    module.weight.uniform_(0.5, 1.5)
+                    module.bias.normal_(0, 0.1)
+    return model
+
+
+def rounding_noise(name, model, inputs, expected):
+    perturbed = copy.deepcopy(model)
+    with torch.no_grad():
+        for param in perturbed.parameters():
+            param.mul_(1 + 1e-7 * torch.randn_like(param))
+    outputs = torch_outputs(name, perturbed, inputs)
+    return max((a - b).abs().max().item() for a, b in zip(expected, outputs))
+
+
+def timed(name, module, inputs, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        outputs = torch_outputs(name, module, inputs)
+    return outputs, (time.time() - start) / repeat
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--atol', type=float, default=1e-4)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    current_root_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    networks = random_networks(os.path.join(current_root_path, 'src/config'))
+
+    failed = []
+    print('%-14s %12s %12s %9s %14s %14s' % ('network', 'before (s)', 'after (s)', 'speedup', 'max abs diff', 'noise floor'))
+    for name, model in networks.items():
+        model = randomise_batch_norms(model).eval()
+        prepared = prepare_for_inference(copy.deepcopy(model))
+        inputs = example_inputs(name, args.batch_size, size=args.size)
+        expected, before = timed(name, model, inputs, args.repeat)
+        outputs, after = timed(name, prepared, inputs, args.repeat)
+        error = max((a - b).abs().max().item() for a, b in zip(expected, outputs))
+        noise = rounding_noise(name, model, inputs, expected)
+        if error > max(args.atol, 2 * noise):
+            failed.append(name)
+        print('%-14s %12.4f %12.4f %8.2fx %14.2e %14.2e' % (name, before, after, before / after, error, noise))
+
+    if failed:
+        sys.exit('prepare_for_inference changed the output of ' + ', '.join(failed))
@@ -0,0 +1,123 @@
+"""
+Export the SadTalker networks to ONNX and OpenVINO IR for the --backend onnx / openvino options of inference.py,
+and check the exported models against PyTorch.
+
+    python scripts/export_models.py --size 256 --preprocess crop
+    python scripts/export_models.py --size 256 --preprocess full
+
+The facerender checkpoints differ with the size and between the full and the other preprocess modes, so export
+once per combination in use. The models are written to checkpoints/exported/<size>_<crop|full> (see
+src/utils/backend.py), which is also where inference.py looks for them by default.
+
+Every network is run in PyTorch and on each exported backend at two batch sizes other than the one it was traced
+with, the script fails when the largest absolute difference is above --atol.
+"""
+import os, sys, time
+from argparse import ArgumentParser
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.utils.backend import NETWORKS, CompiledModel, default_export_dir, export_network
+from src.utils.init_path import init_path
+
+
+def sadtalker_networks(sadtalker_paths, device='cpu'):
+    """ The PyTorch networks that the backends replace, by export name. """
+    from src.utils.preprocess import CropAndExtract
+    from src.test_audio2coeff import Audio2Coeff
+    from src.facerender.animate import AnimateFromCoeff
+
+    preprocess_model = CropAndExtract(sadtalker_paths, device)
+    audio_to_coeff = Audio2Coeff(sadtalker_paths, device)
+    animate_from_coeff = AnimateFromCoeff(sadtalker_paths, device)
+    return {
+        'kp_detector': animate_from_coeff.kp_extractor,
+        'mapping': animate_from_coeff.mapping,
+        'generator': animate_from_coeff.generator,
+        'audio2exp': audio_to_coeff.audio2exp_model.netG,
+        'audio_encoder': audio_to_coeff.audio2pose_model.audio_encoder,
+        'pose_decoder': audio_to_coeff.audio2pose_model.netG.decoder,
+        'net_recon': preprocess_model.net_recon,
+    }
+
+
+def example_inputs(name, batch_size, size=256, num_kp=15, seq_len=32, latent_size=64, num_classes=46):
+    """ Random inputs of network `name`, shaped as SadTalker calls it with batch_size items. """
+    if name == 'kp_detector':
+        return [torch.rand(batch_size, 3, size, size)]
+    elif name == 'mapping':
+        return [torch.randn(batch_size, 70, 27)]
+    elif name == 'generator':
+        return [torch.rand(batch_size, 3, size, size), torch.randn(batch_size, num_kp, 3) * 0.3, torch.randn(batch_size, num_kp, 3) * 0.3]
+    elif name == 'audio2exp':
+        # batch_size frames of two audios
+        return [torch.randn(2*batch_size, 1, 80, 16), torch.randn(2, batch_size, 64), torch.rand(2, batch_size, 1)]
+    elif name == 'audio_encoder':
+        return [torch.randn(batch_size, 1, 80, 16)]
+    elif name == 'pose_decoder':
+        return [torch.randn(batch_size, latent_size), torch.randint(0, num_classes, (batch_size,)),
+                torch.randn(batch_size, 6), torch.randn(batch_size, seq_len, 512)]
+    elif name == 'net_recon':
+        return [torch.rand(batch_size, 3, 224, 224)]
+    raise ValueError('unknown network %s' % name)
+
+
+def torch_outputs(name, module, inputs):
+    export_wrapper = NETWORKS[name][0]
+    module = export_wrapper(module) if export_wrapper is not None else module
+    with torch.no_grad():
+        out = module.eval()(*inputs)
+    return list(out) if isinstance(out, tuple) else [out]
+
+
+def check_parity(name, module, export_dir, backends, batch_sizes, atol, **shapes):
+    """ Largest absolute difference to PyTorch per backend, over the given batch sizes. """
+    errors = {}
+    for backend in backends:
+        model = CompiledModel(os.path.join(export_dir, name), backend)
+        error = 0.
+        for batch_size in batch_sizes:
+            inputs = example_inputs(name, batch_size, **shapes)
+            expected = torch_outputs(name, module, inputs)
+            start = time.time()
+            outputs = model(*inputs)
+            elapsed = time.time() - start
+            error = max([error] + [(a - b).abs().max().item() for a, b in zip(expected, outputs)])
+        errors[backend] = error
+        print('%-14s %-9s max abs diff %.2e  %s  (%.3fs at batch %d)' % (name, backend, error, 'ok' if error <= atol else 'FAILED', elapsed, batch_sizes[-1]))
+    return errors
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--checkpoint_dir', default='./checkpoints')
+    parser.add_argument('--size', type=int, default=256, help='the image size of the facerender')
+    parser.add_argument('--preprocess', default='crop', choices=['crop', 'extcrop', 'resize', 'full', 'extfull'])
+    parser.add_argument('--old_version', action='store_true', help='use the pth other than safetensor version')
+    parser.add_argument('--export_dir', default=None, help='defaults to checkpoints/exported/<size>_<crop|full>')
+    parser.add_argument('--networks', nargs='+', default=list(NETWORKS), choices=list(NETWORKS))
+    parser.add_argument('--backends', nargs='+', default=['onnx', 'openvino'], choices=['onnx', 'openvino'])
+    parser.add_argument('--opset', type=int, default=20, help='5D grid_sample in the generator needs opset 20')
+    parser.add_argument('--atol', type=float, default=5e-3, help='the generator output is in [0, 1], 5e-3 is about one step of the 8 bit frames')
+    parser.add_argument('--skip_export', action='store_true', help='only check the models already exported')
+    args = parser.parse_args()
+
+    current_root_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sadtalker_paths = init_path(args.checkpoint_dir, os.path.join(current_root_path, 'src/config'), args.size, args.old_version, args.preprocess)
+    export_dir = args.export_dir or default_export_dir(args.checkpoint_dir, args.size, args.preprocess)
+    networks = sadtalker_networks(sadtalker_paths)
+
+    failed = []
+    for name in args.networks:
+        if not args.skip_export:
+            start = time.time()
+            export_network(name, networks[name], example_inputs(name, 2, size=args.size), export_dir,
+                           openvino='openvino' in args.backends, opset_version=args.opset)
+            print('exported %s in %.1fs' % (name, time.time() - start))
+        errors = check_parity(name, networks[name], export_dir, args.backends, [1, 3], args.atol, size=args.size)
+        failed += ['%s/%s' % (name, backend) for backend, error in errors.items() if error > args.atol]
+
+    if failed:
+        sys.exit('parity check failed for ' + ', '.join(failed))
+    print('all exported models match PyTorch within %g, use --backend %s --export_dir %s' % (args.atol, args.backends[0], export_dir))
@@ -0,0 +1,79 @@
+"""
+Cold import time of the SadTalker entry points, with a per package breakdown from python -X importtime.
+
+    python scripts/profile_imports.py
+    python scripts/profile_imports.py --modules server --top 20
+    python scripts/profile_imports.py --budget 6 --check
+
+Each module is imported in a fresh interpreter, several times, and the fastest run is kept so the page cache
+is warm but nothing is imported yet. The breakdown sums the self time of every imported module by top level
+package. With --check the script fails when a module takes longer than --budget seconds to import, or when it
+imports one of the --lazy packages, which the service only imports at first use (the enhancers, the UI...).
+scripts/test.sh runs the check.
+"""
+import os, re, subprocess, sys
+from argparse import ArgumentParser
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_MODULES = ['src.facerender.animate', 'src.gradio_demo', 'server']
+# imported by the requests that use them, never by importing the service
+LAZY_PACKAGES = ['gradio', 'pydub', 'gfpgan', 'basicsr', 'realesrgan', 'facexlib', 'safetensors', 'skimage',
+                 'imageio', 'imageio_ffmpeg']
+
+# import time:       self [us] |  cumulative | imported package
+IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+
+def import_times(module):
+    """ the (self, cumulative) import times in seconds of every module imported by `import module`, and the total """
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1')
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % module], cwd=ROOT, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    lines = result.stderr.splitlines()
+    if result.returncode != 0:
+        raise RuntimeError('import %s failed:\n%s' % (module, '\n'.join(line for line in lines if not line.startswith('import time:'))))
+    times = {}
+    for line in lines:
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            times[match.group(4)] = (int(match.group(1)) / 1e6, int(match.group(2)) / 1e6)
+    return times, times[module][1]
+
+
+def by_package(times):
+    """ the self times summed by top level package, largest first """
+    packages = defaultdict(float)
+    for name, (self_time, _) in times.items():
+        packages[name.split('.')[0]] += self_time
+    return sorted(packages.items(), key=lambda item: -item[1])
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--modules', nargs='+', default=DEFAULT_MODULES)
+    parser.add_argument('--runs', type=int, default=3, help='imports per module, the fastest is kept')
+    parser.add_argument('--top', type=int, default=12, help='packages shown per module')
+    parser.add_argument('--budget', type=float, default=8.0, help='seconds a module may take to import')
+    parser.add_argument('--lazy', nargs='*', default=LAZY_PACKAGES, help='packages the modules may not import')
+    parser.add_argument('--check', action='store_true', help='exit with an error on a failure')
+    args = parser.parse_args()
+
+    failures = []
+    for module in args.modules:
+        times, total = min((import_times(module) for _ in range(args.runs)), key=lambda run: run[1])
+        print('%s: %.3fs, %d modules' % (module, total, len(times)))
+        for package, seconds in by_package(times)[:args.top]:
+            print('  %-24s %7.3fs %5.1f%%' % (package, seconds, 100 * seconds / max(total, 1e-9)))
+
+        if total > args.budget:
+            failures.append('%s takes %.3fs to import, the budget is %.3fs' % (module, total, args.budget))
+        eager = sorted(set(name.split('.')[0] for name in times) & set(args.lazy))
+        if eager:
+            failures.append('%s imports %s, which should be imported at first use' % (module, ', '.join(eager)))
+
+    for failure in failures:
+        print('FAIL ' + failure)
+    if args.check and failures:
+        sys.exit(1)
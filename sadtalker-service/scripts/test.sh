@@ -1,4 +1,7 @@
 # ### some test command before commit.
+# cold start: import time budget, and no optional dependency imported with the service
+python scripts/profile_imports.py --check
+
 # python inference.py --preprocess crop --size 256
 # python inference.py --preprocess crop --size 512
 
@@ -0,0 +1,54 @@
+"""
+Fill the reference video cache (src/utils/ref_cache.py) for a directory of reference clips, so that requests
+using them as ref_pose / ref_eyeblink skip the landmarking and 3DMM fitting.
+
+    python scripts/warm_ref_cache.py --ref_dir ./examples/ref_video --preprocess crop full
+
+The cache goes to checkpoints/ref_cache unless --ref_cache_dir is given, where inference.py, predict.py and the
+webui look by default. Clips already in the cache are skipped.
+"""
+import os, sys, glob, shutil, tempfile, time
+from argparse import ArgumentParser
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.utils.init_path import init_path
+from src.utils.preprocess import CropAndExtract
+from src.utils.ref_cache import default_ref_cache_dir
+
+VIDEO_EXTENSIONS = ['mp4', 'mov', 'avi', 'mkv', 'webm']
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--ref_dir', required=True, help='directory of reference clips, searched recursively')
+    parser.add_argument('--checkpoint_dir', default='./checkpoints')
+    parser.add_argument('--ref_cache_dir', default=None, help='checkpoints/ref_cache by default')
+    parser.add_argument('--preprocess', nargs='+', default=['crop'], choices=['crop', 'extcrop', 'resize', 'full', 'extfull'])
+    parser.add_argument('--detect_every', type=int, default=1, help='the --ref_detect_every the requests use')
+    parser.add_argument('--cpu', action='store_true')
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() and not args.cpu else 'cpu'
+    current_root_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    # net_recon and the landmark models are the same for every size and preprocess mode
+    sadtalker_paths = init_path(args.checkpoint_dir, os.path.join(current_root_path, 'src/config'), 256)
+    preprocess_model = CropAndExtract(sadtalker_paths, device,
+                                      ref_cache_dir=args.ref_cache_dir or default_ref_cache_dir(args.checkpoint_dir))
+
+    videos = sorted(path for ext in VIDEO_EXTENSIONS for pattern in (ext, ext.upper())
+                    for path in glob.glob(os.path.join(args.ref_dir, '**', '*.' + pattern), recursive=True))
+    print('%d reference clips, cache in %s' % (len(videos), preprocess_model.ref_cache.cache_dir))
+    for video in videos:
+        for preprocess in args.preprocess:
+            if preprocess_model.ref_cache.get(video, preprocess, args.detect_every) is not None:
+                print('cached   %s (%s)' % (video, preprocess))
+                continue
+            start = time.time()
+            save_dir = tempfile.mkdtemp()
+            try:
+                coeff = preprocess_model.generate_ref_coeff(video, save_dir, preprocess, detect_every=args.detect_every)
+            finally:
+                shutil.rmtree(save_dir)
+            print('%s %s (%s) in %.1fs' % ('added   ' if coeff is not None else 'no face ', video, preprocess, time.time() - start))
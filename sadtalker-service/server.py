@@ -0,0 +1,479 @@
+"""
+Headless HTTP server for the SadTalker pipeline.
+
+    python server.py --checkpoint_dir ./checkpoints --workers 2 --max_queue 8 --port 5002
+
+The models are loaded once at start up and shared by --workers worker threads, which take the jobs from a queue
+of at most --max_queue waiting jobs; a job submitted to a full queue is refused with 429. A job goes through the
+stages preprocess, audio2coeff and render, reported by GET /api/jobs/<id> in place of the tqdm bars, and the
+video is streamed from disk by GET /api/jobs/<id>/result. Finished jobs are dropped with their files after
+--result_ttl seconds. The paste back of the full modes runs in the worker thread, unless --paste_workers processes
+are shared out among the workers.
+
+    GET    /health                  {'status': 'healthy'|'degraded', 'models_available': bool, 'service': 'sadtalker'},
+                                    200 or 503, the contract of the Wav2Lip service
+    POST   /api/jobs                image and audio as multipart files, or a JSON body with base64 image and audio,
+                                    plus the options of parse_options; 202 with the job
+    GET    /api/jobs/<id>           status, stage and progress of the job
+    GET    /api/jobs/<id>/result    the mp4 once the job is done
+    DELETE /api/jobs/<id>           cancel a queued job, or drop a finished one and its files
+    POST   /api/generate            the synchronous call of the Wav2Lip service, the mp4 back as base64 JSON
+
+A job with idle_seconds and no audio is an idle clip cut from the idle loops of the avatar (src/utils/idle_loops.py).
+"""
+import os
+# the progress of the jobs is reported by the API, not by tqdm bars on stderr
+os.environ.setdefault('TQDM_DISABLE', '1')
+
+import base64
+import logging
+import mimetypes
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from argparse import ArgumentParser
+
+import torch
+from flask import Flask, request, jsonify, send_file
+from flask_cors import CORS
+
+from src.utils.preprocess import CropAndExtract
+from src.test_audio2coeff import Audio2Coeff
+from src.facerender.animate import AnimateFromCoeff
+from src.generate_facerender_batch import get_facerender_data
+from src.utils.init_path import init_path
+from src.utils.audio import AudioBuffer
+from src.utils.face_enhancer import FaceEnhancer
+from src.utils.ref_cache import default_ref_cache_dir
+from src.utils.coeff_cache import default_coeff_cache_dir
+from src.utils.idle_loops import IdleLoopLibrary, default_idle_loop_dir, render_idle_loops
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+app = Flask(__name__)
+CORS(app)
+
+SERVICE_NAME = 'sadtalker'
+PREPROCESS_MODES = ['crop', 'extcrop', 'resize', 'full', 'extfull']
+ENHANCERS = ['gfpgan', 'RestoreFormer']
+
+# set up in __main__
+service = None
+jobs = None
+
+
+def parse_options(values):
+    """ the render options of a job from the form fields or the JSON body, ValueError on a bad value """
+    def get(name, cast, default):
+        value = values.get(name)
+        if value is None or value == '':
+            return default
+        try:
+            return cast(value)
+        except (TypeError, ValueError):
+            raise ValueError('invalid %s: %r' % (name, value))
+    to_bool = lambda value: value if isinstance(value, bool) else str(value).lower() in ('1', 'true', 'yes', 'on')
+
+    options = {
+        'preprocess': get('preprocess', str, 'crop'),
+        'still': get('still', to_bool, False),
+        'enhancer': get('enhancer', str, None),
+        'pose_style': get('pose_style', int, 0),
+        'expression_scale': get('expression_scale', float, 1.0),
+        'seed': get('seed', int, None),
+        'batch_size': get('batch_size', int, 2),
+        'paste_method': get('paste_method', str, 'poisson'),
+        'idle_seconds': get('idle_seconds', float, None),
+    }
+    if options['preprocess'] not in PREPROCESS_MODES:
+        raise ValueError('preprocess must be one of %s' % ', '.join(PREPROCESS_MODES))
+    if options['enhancer'] not in [None] + ENHANCERS:
+        raise ValueError('enhancer must be one of %s' % ', '.join(ENHANCERS))
+    if not 0 <= options['pose_style'] < 46:
+        raise ValueError('pose_style must be in [0, 46)')
+    if not 1 <= options['batch_size'] <= 16:
+        raise ValueError('batch_size must be in [1, 16]')
+    if options['paste_method'] not in ['poisson', 'feather']:
+        raise ValueError('paste_method must be poisson or feather')
+    if options['idle_seconds'] is not None and not 0 < options['idle_seconds'] <= 600:
+        raise ValueError('idle_seconds must be in (0, 600]')
+    return options
+
+
+class Job():
+    """ a request and its state, status is one of queued, running, done, failed, cancelled """
+
+    def __init__(self, work_dir, image_path, audio_path, options):
+        self.id = uuid.uuid4().hex
+        self.work_dir = work_dir
+        self.image_path = image_path
+        self.audio_path = audio_path
+        self.options = options
+        self.status = 'queued'
+        self.stage = None
+        self.progress = 0.
+        self.error = None
+        self.result_path = None
+        self.created = time.time()
+        self.finished = None
+        self.done = threading.Event()
+
+    def set_stage(self, stage):
+        self.stage, self.progress = stage, 0.
+        logger.info('job %s: %s', self.id, stage)
+
+    def to_dict(self):
+        return {'job_id': self.id, 'status': self.status, 'stage': self.stage, 'progress': round(self.progress, 3),
+                'error': self.error, 'created': self.created, 'finished': self.finished}
+
+
+class SerializedPreprocess():
+    """ a CropAndExtract shared by the worker threads, one generate at a time: its face detector keeps the
+    scale of the image it works on between calls """
+
+    def __init__(self, model):
+        self.model = model
+        self.lock = threading.Lock()
+
+    def generate(self, *args, **kwargs):
+        with self.lock:
+            return self.model.generate(*args, **kwargs)
+
+
+class SadTalkerService():
+    """ the resident models and the pipeline of a job, shared by the worker threads """
+
+    def __init__(self, checkpoint_dir, size=256, device=None, paste_workers=0):
+        self.checkpoint_dir = checkpoint_dir
+        self.size = size
+        # processes of the paste back of a full job, 0 pastes in the worker thread
+        self.paste_workers = paste_workers
+        self.device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+        self.models_loaded = False
+        # the face enhancers keep per image state, every worker thread gets its own
+        self.local = threading.local()
+
+    def load(self):
+        config_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src/config')
+        crop_paths = init_path(self.checkpoint_dir, config_dir, self.size, False, 'crop')
+        full_paths = init_path(self.checkpoint_dir, config_dir, self.size, False, 'full')
+        self.preprocess_model = SerializedPreprocess(CropAndExtract(crop_paths, self.device,
+                                                                    ref_cache_dir=default_ref_cache_dir(self.checkpoint_dir)))
+        self.audio_to_coeff = Audio2Coeff(crop_paths, self.device, coeff_cache_dir=default_coeff_cache_dir(self.checkpoint_dir))
+        # the full modes use their own mapping network
+        self.animate_from_coeff = {'full': AnimateFromCoeff(full_paths, self.device),
+                                   'others': AnimateFromCoeff(crop_paths, self.device)}
+        self.idle_loops = IdleLoopLibrary(default_idle_loop_dir(self.checkpoint_dir))
+        self.models_loaded = True
+
+    def face_enhancer(self, method):
+        enhancers = self.local.__dict__.setdefault('enhancers', {})
+        if method not in enhancers:
+            enhancers[method] = FaceEnhancer(method)
+        return enhancers[method]
+
+    def run(self, job):
+        """ render the job, returns the path of the video """
+        options = job.options
+        preprocess = options['preprocess']
+        animate_from_coeff = self.animate_from_coeff['full' if 'full' in preprocess else 'others']
+        enhancer = self.face_enhancer(options['enhancer']) if options['enhancer'] else None
+
+        if job.audio_path is None:
+            return self.idle(job, animate_from_coeff, enhancer)
+
+        job.set_stage('preprocess')
+        first_coeff, crop_pic, crop_info = self.preprocess_model.generate(job.image_path, job.work_dir, preprocess,
+                                                                          source_image_flag=True, pic_size=self.size)
+        if first_coeff is None:
+            raise ValueError('No face is detected')
+
+        job.set_stage('audio2coeff')
+        audio = AudioBuffer.load(job.audio_path)
+        coeff = self.audio_to_coeff.generate_cached(first_coeff, audio, job.work_dir, options['pose_style'],
+                                                    seed=options['seed'], still=options['still'])
+
+        job.set_stage('render')
+        data = get_facerender_data(coeff, crop_pic, first_coeff, audio, options['batch_size'],
+                                   expression_scale=options['expression_scale'], still_mode=options['still'],
+                                   preprocess=preprocess, size=self.size)
+        return animate_from_coeff.generate(data, job.work_dir, job.image_path, crop_info, enhancer=enhancer,
+                                           preprocess=preprocess, img_size=self.size, paste_method=options['paste_method'],
+                                           paste_workers=self.paste_workers,
+                                           progress=lambda frames, frame_num: setattr(job, 'progress', frames / frame_num))
+
+    def idle(self, job, animate_from_coeff, enhancer):
+        options = job.options
+        # the settings of SadTalker.idle in the webui, the avatars share their loops with it
+        avatar = self.idle_loops.avatar_key(job.image_path, preprocess=options['preprocess'], still=options['still'],
+                                            enhancer=options['enhancer'], size=self.size, pose_style=options['pose_style'],
+                                            expression_scale=options['expression_scale'], use_blink=True)
+        if not self.idle_loops.loops(avatar):
+            job.set_stage('render')
+            render_idle_loops(self.idle_loops, avatar, job.image_path, self.preprocess_model, self.audio_to_coeff,
+                              animate_from_coeff, job.work_dir, preprocess=options['preprocess'], size=self.size,
+                              still=options['still'], enhancer=enhancer, expression_scale=options['expression_scale'],
+                              pose_style=options['pose_style'], batch_size=options['batch_size'],
+                              paste_workers=self.paste_workers)
+        job.set_stage('concat')
+        return self.idle_loops.serve(avatar, options['idle_seconds'], os.path.join(job.work_dir, 'idle.mp4'))
+
+
+class JobQueue():
+    """ a bounded queue of jobs served by a pool of worker threads """
+
+    def __init__(self, service, work_dir, workers=1, max_queue=8, result_ttl=3600):
+        self.service = service
+        self.work_dir = work_dir
+        self.result_ttl = result_ttl
+        self.queue = queue.Queue(max_queue)
+        self.jobs = {}
+        self.lock = threading.Lock()
+        os.makedirs(work_dir, exist_ok=True)
+        self.workers = [threading.Thread(target=self.worker, name='sadtalker-worker-%d' % i, daemon=True)
+                        for i in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def new_workspace(self):
+        return tempfile.mkdtemp(prefix='job_', dir=self.work_dir)
+
+    def submit(self, job):
+        """ queue the job, queue.Full when max_queue jobs are already waiting """
+        with self.lock:
+            self.queue.put_nowait(job)
+            self.jobs[job.id] = job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def position(self, job):
+        """ the number of jobs waiting ahead of a queued job """
+        with self.lock:
+            return sum(1 for other in self.jobs.values() if other.status == 'queued' and other.created < job.created)
+
+    def remove(self, job):
+        """ cancel the job if it is still queued and drop it with its files, False while it is running """
+        with self.lock:
+            if job.status == 'running':
+                return False
+            if job.status == 'queued':
+                job.status = 'cancelled'
+                job.done.set()
+            self.jobs.pop(job.id, None)
+        shutil.rmtree(job.work_dir, ignore_errors=True)
+        return True
+
+    def expire(self):
+        now = time.time()
+        with self.lock:
+            expired = [job for job in self.jobs.values() if job.finished is not None and now - job.finished > self.result_ttl]
+        for job in expired:
+            self.remove(job)
+
+    def worker(self):
+        while True:
+            try:
+                job = self.queue.get(timeout=60)
+            except queue.Empty:
+                self.expire()
+                continue
+            with self.lock:
+                if job.status == 'cancelled':
+                    continue
+                job.status = 'running'
+            try:
+                job.result_path = self.service.run(job)
+                job.status = 'done'
+            except Exception as e:
+                logger.error(f"job {job.id} failed: {e}", exc_info=True)
+                job.error = str(e)
+                job.status = 'failed'
+            finally:
+                job.finished = time.time()
+                job.done.set()
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+            self.expire()
+
+
+def decode_upload(data, work_dir, name, default_ext):
+    """ save a base64 string or data URL to <work_dir>/<name><ext>, the extension taken from the data URL type """
+    ext = default_ext
+    if ',' in data:
+        header, data = data.split(',', 1)
+        mime = header[len('data:'):].split(';')[0]
+        ext = {'image/jpeg': '.jpg', 'image/jpg': '.jpg', 'audio/mpeg': '.mp3', 'audio/x-wav': '.wav'}.get(mime) or mimetypes.guess_extension(mime) or default_ext
+    path = os.path.join(work_dir, name + ext)
+    with open(path, 'wb') as f:
+        f.write(base64.b64decode(data))
+    return path
+
+
+def save_upload(storage, work_dir, name, default_ext):
+    """ save a multipart file to <work_dir>/<name><ext>, keeping the extension of its file name """
+    ext = os.path.splitext(storage.filename or '')[1].lower() or default_ext
+    path = os.path.join(work_dir, name + ext)
+    storage.save(path)
+    return path
+
+
+def create_job():
+    """ the Job of the request, with its uploads saved in a new workspace, ValueError on a bad request """
+    work_dir = jobs.new_workspace()
+    try:
+        if request.files:
+            values = request.form
+            if 'image' not in request.files:
+                raise ValueError('image is required')
+            image_path = save_upload(request.files['image'], work_dir, 'image', '.png')
+            audio_path = save_upload(request.files['audio'], work_dir, 'audio', '.wav') if 'audio' in request.files else None
+        else:
+            values = request.get_json(silent=True) or {}
+            if not values.get('image'):
+                raise ValueError('image (base64) is required')
+            try:
+                image_path = decode_upload(values['image'], work_dir, 'image', '.png')
+                audio_path = decode_upload(values['audio'], work_dir, 'audio', '.wav') if values.get('audio') else None
+            except (TypeError, ValueError) as e:
+                raise ValueError('invalid base64 encoding: %s' % e)
+        # CropAndExtract tells a picture from a video by its extension
+        if os.path.splitext(image_path)[1][1:] not in ['jpg', 'png', 'jpeg']:
+            raise ValueError('image must be a png or jpeg picture')
+        options = parse_options(values)
+        if audio_path is None and options['idle_seconds'] is None:
+            raise ValueError('audio is required, or idle_seconds for an idle clip')
+        if audio_path is not None:
+            options['idle_seconds'] = None
+        return Job(work_dir, image_path, audio_path, options)
+    except Exception:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+
+
+def submit_job():
+    """ create and queue the job of the request, the job or an error response """
+    if service is None or not service.models_loaded:
+        return None, (jsonify({'error': 'SadTalker models not loaded',
+                               'details': 'Service is initializing or models are missing'}), 503)
+    try:
+        job = create_job()
+    except ValueError as e:
+        return None, (jsonify({'error': 'Invalid request', 'details': str(e)}), 400)
+    try:
+        jobs.submit(job)
+    except queue.Full:
+        shutil.rmtree(job.work_dir, ignore_errors=True)
+        return None, (jsonify({'error': 'Queue is full', 'details': 'Try again later'}), 429)
+    return job, None
+
+
+@app.route('/health', methods=['GET'])
+def health_check():
+    """Health check endpoint"""
+    models_available = service is not None and service.models_loaded
+    return jsonify({
+        'status': 'healthy' if models_available else 'degraded',
+        'models_available': models_available,
+        'service': SERVICE_NAME
+    }), 200 if models_available else 503
+
+
+@app.route('/api/jobs', methods=['POST'])
+def create_job_route():
+    job, error = submit_job()
+    if error is not None:
+        return error
+    response = job.to_dict()
+    response['position'] = jobs.position(job)
+    return jsonify(response), 202
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = jobs.get(job_id) if jobs is not None else None
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    response = job.to_dict()
+    if job.status == 'queued':
+        response['position'] = jobs.position(job)
+    return jsonify(response), 200
+
+
+@app.route('/api/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    job = jobs.get(job_id) if jobs is not None else None
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    if job.status != 'done':
+        return jsonify({'error': 'Job is %s' % job.status, 'details': job.error}), 409
+    # streamed from the file, with range requests
+    return send_file(job.result_path, mimetype='video/mp4', as_attachment=True,
+                     download_name='%s.mp4' % job.id, conditional=True)
+
+
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+def delete_job(job_id):
+    job = jobs.get(job_id) if jobs is not None else None
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    if not jobs.remove(job):
+        return jsonify({'error': 'Job is running'}), 409
+    return jsonify({'job_id': job.id, 'status': job.status}), 200
+
+
+@app.route('/api/generate', methods=['POST'])
+def generate_video():
+    """Generate a talking head video from image and audio, waiting for it (the call of the Wav2Lip service)"""
+    job, error = submit_job()
+    if error is not None:
+        return error
+    try:
+        job.done.wait()
+        if job.status != 'done':
+            return jsonify({'error': 'Video generation failed', 'details': job.error}), 500
+        with open(job.result_path, 'rb') as video_file:
+            video_data = video_file.read()
+        logger.info(f"Video generated successfully: {len(video_data)} bytes")
+        return jsonify({
+            'success': True,
+            'video': f'data:video/mp4;base64,{base64.b64encode(video_data).decode("utf-8")}',
+            'size': len(video_data)
+        }), 200
+    finally:
+        jobs.remove(job)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--checkpoint_dir', default='./checkpoints')
+    parser.add_argument('--size', type=int, default=256, help='the image size of the facerender')
+    parser.add_argument('--workers', type=int, default=1, help='jobs rendered at the same time')
+    parser.add_argument('--max_queue', type=int, default=8, help='jobs waiting at most, more are refused with 429')
+    parser.add_argument('--result_ttl', type=int, default=3600, help='seconds a finished job and its video are kept')
+    parser.add_argument('--work_dir', default=os.path.join(tempfile.gettempdir(), 'sadtalker_jobs'))
+    parser.add_argument('--host', default='0.0.0.0')
+    # PORT from the environment as in the Wav2Lip service (Render/Docker)
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 5002)))
+    parser.add_argument('--paste_workers', type=int, default=0,
+                        help='paste back processes shared by the workers, 0 pastes in the worker threads')
+    parser.add_argument('--cpu', action='store_true')
+    args = parser.parse_args()
+
+    # every running job gets its share of the paste back processes, a job with less than 2 pastes in its thread
+    service = SadTalkerService(args.checkpoint_dir, args.size, 'cpu' if args.cpu else None,
+                               paste_workers=args.paste_workers // max(args.workers, 1))
+    try:
+        logger.info("Loading the SadTalker models...")
+        service.load()
+        logger.info("SadTalker models loaded on %s", service.device)
+    except Exception as e:
+        logger.error(f"Failed to load the SadTalker models: {e} - service will run in degraded mode")
+    jobs = JobQueue(service, args.work_dir, args.workers, args.max_queue, args.result_ttl)
+
+    app.run(host=args.host, port=args.port, debug=False, threaded=True)
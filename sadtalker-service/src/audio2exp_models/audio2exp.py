@@ -4,11 +4,12 @@ from torch import nn
 
 
 class Audio2Exp(nn.Module):
-    def __init__(self, netG, cfg, device, prepare_training_loss=False):
+    def __init__(self, netG, cfg, device, prepare_training_loss=False, max_batch_frames=256):
         super(Audio2Exp, self).__init__()
         self.cfg = cfg
         self.device = device
         self.netG = netG.to(device)
+        self.max_batch_frames = max_batch_frames
 
     def test(self, batch):
 
@@ -16,17 +17,20 @@ class Audio2Exp(nn.Module):
         bs = mel_input.shape[0]
         T = mel_input.shape[1]
 
+        # frames are predicted independently, so run up to max_batch_frames per forward
+        step = max(1, self.max_batch_frames // bs)
+
         exp_coeff_pred = []
 
-        for i in tqdm(range(0, T, 10),'audio2exp:'): # every 10 frames
+        for i in tqdm(range(0, T, step),'audio2exp:'):
             
-            current_mel_input = mel_input[:,i:i+10]
+            current_mel_input = mel_input[:,i:i+step]
 
             #ref = batch['ref'][:, :, :64].repeat((1,current_mel_input.shape[1],1))           #bs T 64
-            ref = batch['ref'][:, :, :64][:, i:i+10]
-            ratio = batch['ratio_gt'][:, i:i+10]                               #bs T
+            ref = batch['ref'][:, :, :64][:, i:i+step]
+            ratio = batch['ratio_gt'][:, i:i+step]                               #bs T
 
-            audiox = current_mel_input.view(-1, 1, 80, 16)                  # bs*T 1 80 16
+            audiox = current_mel_input.reshape(-1, 1, 80, 16)                  # bs*T 1 80 16
 
             curr_exp_coeff_pred  = self.netG(audiox, ref, ratio)         # bs T 64 
 
@@ -5,12 +5,13 @@ from src.audio2pose_models.discriminator import PoseSequenceDiscriminator
 from src.audio2pose_models.audio_encoder import AudioEncoder
 
 class Audio2Pose(nn.Module):
-    def __init__(self, cfg, wav2lip_checkpoint, device='cuda'):
+    def __init__(self, cfg, wav2lip_checkpoint, device='cuda', max_batch_frames=256):
         super().__init__()
         self.cfg = cfg
         self.seq_len = cfg.MODEL.CVAE.SEQ_LEN
         self.latent_dim = cfg.MODEL.CVAE.LATENT_SIZE
         self.device = device
+        self.max_batch_frames = max_batch_frames
 
         self.audio_encoder = AudioEncoder(wav2lip_checkpoint, device)
         self.audio_encoder.eval()
@@ -45,7 +46,8 @@ class Audio2Pose(nn.Module):
 
         return batch
 
-    def test(self, x):
+    def test(self, x, generator=None):
+        """ generator -- the torch.Generator the latent codes are drawn from, the global one by default """
 
         batch = {}
         ref = x['ref']                            #bs 1 70
@@ -61,29 +63,41 @@ class Audio2Pose(nn.Module):
         #  
         div = num_frames//self.seq_len
         re = num_frames%self.seq_len
-        audio_emb_list = []
+        # the seq_len windows only share the style, so they are decoded as one batch.
+        # the last window is aligned to the end of the audio and padded with its first frame.
+        mel_windows = [indiv_mels_use[:, i*self.seq_len:(i+1)*self.seq_len] for i in range(div)]
+        if re != 0:
+            mel_window = indiv_mels_use[:, -1*self.seq_len:]
+            if mel_window.shape[1] != self.seq_len:
+                pad_dim = self.seq_len-mel_window.shape[1]
+                pad_mel_window = mel_window[:, :1].repeat(1, pad_dim, 1, 1, 1)
+                mel_window = torch.cat([pad_mel_window, mel_window], 1)
+            mel_windows.append(mel_window)
+
+        # one z per window, drawn in window order to keep the random stream of the per-window loop
+        z_list = [torch.randn(bs, self.latent_dim, generator=generator).to(ref.device) for _ in mel_windows]
+
         pose_motion_pred_list = [torch.zeros(batch['ref'].unsqueeze(1).shape, dtype=batch['ref'].dtype, 
                                                 device=batch['ref'].device)]
 
-        for i in range(div):
-            z = torch.randn(bs, self.latent_dim).to(ref.device)
-            batch['z'] = z
-            audio_emb = self.audio_encoder(indiv_mels_use[:, i*self.seq_len:(i+1)*self.seq_len,:,:,:]) #bs seq_len 512
-            batch['audio_emb'] = audio_emb
-            batch = self.netG.test(batch)
-            pose_motion_pred_list.append(batch['pose_motion_pred'])  #list of bs seq_len 6
-        
+        windows_per_batch = max(1, self.max_batch_frames // (bs*self.seq_len))
+        for i in range(0, len(mel_windows), windows_per_batch):
+            num_windows = len(mel_windows[i:i+windows_per_batch])
+            mels = torch.cat(mel_windows[i:i+num_windows], 0)             # num_windows*bs seq_len 1 80 16
+
+            # the audio encoder folds time into the batch, so feed all frames as a single sequence
+            audio_emb = self.audio_encoder(mels.reshape((1, -1) + mels.shape[2:]))
+            window_batch = {
+                'z': torch.cat(z_list[i:i+num_windows], 0),
+                'class': batch['class'].repeat(num_windows),
+                'ref': batch['ref'].repeat(num_windows, 1),
+                'audio_emb': audio_emb.reshape(num_windows*bs, self.seq_len, -1),   # num_windows*bs seq_len 512
+            }
+            window_batch = self.netG.test(window_batch)
+            pose_motion_pred_list += list(window_batch['pose_motion_pred'].split(bs, 0))  #list of bs seq_len 6
+
         if re != 0:
-            z = torch.randn(bs, self.latent_dim).to(ref.device)
-            batch['z'] = z
-            audio_emb = self.audio_encoder(indiv_mels_use[:, -1*self.seq_len:,:,:,:]) #bs seq_len  512
-            if audio_emb.shape[1] != self.seq_len:
-                pad_dim = self.seq_len-audio_emb.shape[1]
-                pad_audio_emb = audio_emb[:, :1].repeat(1, pad_dim, 1) 
-                audio_emb = torch.cat([pad_audio_emb, audio_emb], 1) 
-            batch['audio_emb'] = audio_emb
-            batch = self.netG.test(batch)
-            pose_motion_pred_list.append(batch['pose_motion_pred'][:,-1*re:,:])   
+            pose_motion_pred_list[-1] = pose_motion_pred_list[-1][:,-1*re:,:]
         
         pose_motion_pred = torch.cat(pose_motion_pred_list, dim = 1)
         batch['pose_motion_pred'] = pose_motion_pred
@@ -45,24 +45,29 @@ class KeypointExtractor():
         self.detector = init_alignment_model('awing_fan',device=device, model_rootpath=root_path)   
         self.det_net = init_detection_model('retinaface_resnet50', half=False,device=device, model_rootpath=root_path)
 
-    def extract_keypoint(self, images, name=None, info=True):
+    def extract_keypoint(self, images, name=None, info=True, batch_size=8, detect_every=1, detect_size=None):
+        """
+        68 landmarks of one image, -1 where there is no face, or (N, 68, 2) landmarks of a list of frames of a video,
+        where a frame without a face takes the landmarks of the previous frame.
+
+        A list is processed batch_size frames at a time, see extract_keypoint_batch.
+        """
         if isinstance(images, list):
             keypoints = []
-            if info:
-                i_range = tqdm(images,desc='landmark Det:')
-            else:
-                i_range = images
-
-            for image in i_range:
-                current_kp = self.extract_keypoint(image)
-                # current_kp = self.detector.get_landmarks(np.array(image))
-                if np.mean(current_kp) == -1 and keypoints:
-                    keypoints.append(keypoints[-1])
-                else:
-                    keypoints.append(current_kp[None])
+            progress = tqdm(total=len(images), desc='landmark Det:', disable=not info)
+            for start in range(0, len(images), batch_size):
+                batch = images[start:start+batch_size]
+                for current_kp in self.extract_keypoint_batch(batch, detect_every, detect_size):
+                    if np.mean(current_kp) == -1 and keypoints:
+                        keypoints.append(keypoints[-1])
+                    else:
+                        keypoints.append(current_kp[None])
+                progress.update(len(batch))
+            progress.close()
 
             keypoints = np.concatenate(keypoints, 0)
-            np.savetxt(os.path.splitext(name)[0]+'.txt', keypoints.reshape(-1))
+            if name is not None:
+                np.savetxt(os.path.splitext(name)[0]+'.txt', keypoints.reshape(-1))
             return keypoints
         else:
             while True:
@@ -98,6 +103,63 @@ class KeypointExtractor():
                 np.savetxt(os.path.splitext(name)[0]+'.txt', keypoints.reshape(-1))
             return keypoints
 
+    def detect_faces_batch(self, images, detect_size=None):
+        """ the box (x1, y1, x2, y2) of the most confident face of every image, None where there is no face """
+        frames = [np.asarray(image) for image in images]
+        scale = 1.
+        if detect_size is not None and min(frames[0].shape[:2]) > detect_size:
+            scale = detect_size / min(frames[0].shape[:2])
+            frames = [cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) for frame in frames]
+
+        with torch.no_grad():
+            if all(frame.shape == frames[0].shape for frame in frames):
+                bboxes, _ = self.det_net.batched_detect_faces([Image.fromarray(frame) for frame in frames], 0.97)
+            else:
+                bboxes = [self.det_net.detect_faces(Image.fromarray(frame), 0.97) for frame in frames]
+        return [bbox[0, :4] / scale if len(bbox) else None for bbox in bboxes]
+
+    def extract_keypoint_batch(self, images, detect_every=1, detect_size=None):
+        """
+        68 landmarks of every frame of a list, -1 where there is no face.
+
+        RetinaFace runs once on the frames to detect, every detect_every-th frame and the last one, downscaled so
+        that their shorter side is detect_size if given. The boxes of the frames in between are tracked by
+        interpolating those of the detected frames around them. FAN then runs once on all the crops. With
+        detect_every=1 and no detect_size, the landmarks are those of extract_keypoint on every frame.
+        """
+        keyframes = sorted(set(range(0, len(images), detect_every)) | {len(images) - 1})
+        detected = dict(zip(keyframes, self.detect_faces_batch([images[i] for i in keyframes], detect_size)))
+
+        boxes = []
+        for i in range(len(images)):
+            if i in detected:
+                boxes.append(detected[i])
+                continue
+            before, after = max(k for k in keyframes if k < i), min(k for k in keyframes if k > i)
+            box_before, box_after = detected[before], detected[after]
+            if box_before is None or box_after is None:
+                boxes.append(box_after if box_before is None else box_before)
+            else:
+                boxes.append(box_before + (box_after - box_before) * (i - before) / (after - before))
+
+        crops, keypoints = [], [-1. * np.ones([68, 2]) for _ in images]
+        for i, (image, box) in enumerate(zip(images, boxes)):
+            crop = None if box is None else np.asarray(image)[int(box[1]):int(box[3]), int(box[0]):int(box[2]), :]
+            if crop is not None and crop.size > 0:
+                crops.append((i, crop))
+        if len(crops) < len(images):
+            print('No face detected in %d of %d frames' % (len(images) - len(crops), len(images)))
+
+        if crops:
+            with torch.no_grad():
+                landmarks = self.detector.get_landmarks_batch([crop for _, crop in crops])
+            for (i, _), lm in zip(crops, landmarks):
+                keypoints[i] = landmark_98_to_68(lm)
+                #### keypoints to the original location
+                keypoints[i][:, 0] += int(boxes[i][0])
+                keypoints[i][:, 1] += int(boxes[i][1])
+        return keypoints
+
 def read_video(filename):
     frames = []
     cap = cv2.VideoCapture(filename)
@@ -121,7 +183,10 @@ def run(data):
     os.makedirs(os.path.join(opt.output_dir, name[-2]), exist_ok=True)
     kp_extractor.extract_keypoint(
         images, 
-        name=os.path.join(opt.output_dir, name[-2], name[-1])
+        name=os.path.join(opt.output_dir, name[-2], name[-1]),
+        batch_size=opt.batch_size,
+        detect_every=opt.detect_every,
+        detect_size=opt.detect_size
     )
 
 if __name__ == '__main__':
@@ -131,6 +196,9 @@ if __name__ == '__main__':
     parser.add_argument('--output_dir', type=str, help='the folder of the output files')
     parser.add_argument('--device_ids', type=str, default='0,1')
     parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--batch_size', type=int, default=8, help='frames per FAN forward')
+    parser.add_argument('--detect_every', type=int, default=1, help='run the face detector every n frames, track the box in between')
+    parser.add_argument('--detect_size', type=int, default=None, help='shorter side of the frames given to the face detector')
 
     opt = parser.parse_args()
     filenames = list()
@@ -376,3 +376,22 @@ class FAN(nn.Module):
         pred += offset[-2:]
 
         return pred
+
+    def get_landmarks_batch(self, imgs):
+        """ get_landmarks of a list of crops of any size, in one forward """
+        inp = np.stack([cv2.resize(img, (256, 256))[..., ::-1].transpose((2, 0, 1)) for img in imgs])
+        inp = torch.from_numpy(np.ascontiguousarray(inp)).float()
+        inp = inp.to(self.device)
+        inp.div_(255.0)
+
+        outputs, _ = self.forward(inp)
+        heatmaps = outputs[-1][:, :-1, :, :].detach().cpu().numpy()
+
+        preds = []
+        for img, heatmap in zip(imgs, heatmaps):
+            H, W, _ = img.shape
+            # one crop at a time, the border checks of calculate_points are over the whole batch
+            pred = calculate_points(heatmap[None]).reshape(-1, 2)
+            pred *= W / 64, H / 64
+            preds.append(pred)
+        return preds
@@ -6,7 +6,6 @@ from scipy.io import loadmat
 from PIL import Image
 import cv2
 import os
-from skimage import transform as trans
 import torch
 import warnings
 warnings.filterwarnings("ignore", category=np.VisibleDeprecationWarning) 
@@ -1,15 +1,14 @@
 import os
 import cv2
+import itertools
+import multiprocessing
+import tempfile
 import yaml
 import numpy as np
 import warnings
-from skimage import img_as_ubyte
-import safetensors
-import safetensors.torch 
 warnings.filterwarnings('ignore')
 
 
-import imageio
 import torch
 import torchvision
 
@@ -17,12 +16,12 @@ import torchvision
 from src.facerender.modules.keypoint_detector import HEEstimator, KPDetector
 from src.facerender.modules.mapping import MappingNet
 from src.facerender.modules.generator import OcclusionAwareGenerator, OcclusionAwareSPADEGenerator
-from src.facerender.modules.make_animation import make_animation 
+from src.facerender.modules.make_animation import make_animation, make_animation_iter
 
-from pydub import AudioSegment 
-from src.utils.face_enhancer import enhancer_generator_with_len, enhancer_list
-from src.utils.paste_pic import paste_pic
-from src.utils.videoio import save_video_with_watermark
+from src.utils.paste_pic import paste_frames
+from src.utils.videoio import save_frames_to_video, concat_videos
+from src.utils.backend import load_network
+from src.utils.prepare_model import prepare_for_inference
 
 try:
     import webui  # in webui
@@ -30,9 +29,65 @@ try:
 except:
     in_webui = False
 
+def half_precision_supported(device):
+    """ whether the generator can run in reduced precision (bfloat16 on CPU, float16 on CUDA) on device """
+    if 'cuda' in str(device):
+        return torch.cuda.is_available()
+    try:
+        # emulated bfloat16 is slower than FP32, only use it with native support
+        return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+# segments shorter than this (2 s) are not worth a worker process
+MIN_SEGMENT_FRAMES = 50
+
+def split_segments(frame_num, batch_size, num_segments):
+    """ Up to num_segments [start, end) frame ranges covering frame_num frames, starting on batch boundaries. """
+    num_batches = -(-frame_num // batch_size)
+    num_segments = max(1, min(num_segments, frame_num // MIN_SEGMENT_FRAMES, num_batches))
+    starts = [round(i * num_batches / num_segments) * batch_size for i in range(num_segments)]
+    return list(zip(starts, starts[1:] + [frame_num]))
+
+def segment_data(x, indices):
+    """ x restricted to the frames at indices, padded to a whole batch with the last one like get_facerender_data """
+    batch_size = x['source_image'].shape[0]
+    frame_num = len(indices)
+    indices = list(indices) + [indices[-1]] * (-frame_num % batch_size)
+    # (bs, frame_num/bs, ...) holds the frames in row-major order
+    take = lambda seq: seq.reshape((-1,) + seq.shape[2:])[indices].reshape((batch_size, -1) + seq.shape[2:])
+    segment = dict(x)
+    segment['target_semantics_list'] = take(x['target_semantics_list'])
+    for key in ('yaw_c_seq', 'pitch_c_seq', 'roll_c_seq'):
+        if key in x:
+            segment[key] = take(x[key])
+    segment['frame_num'] = frame_num
+    return segment
+
+def report_progress(frames, progress, frame_num):
+    """ the frames, calling progress(frames done, frame_num) after each one """
+    for frame_idx, frame in enumerate(frames, 1):
+        yield frame
+        progress(frame_idx, frame_num)
+
+# state of the segment worker processes, set once by _init_segment_worker
+_segment_job = None
+
+def _init_segment_worker(job):
+    global _segment_job
+    # the OpenMP pool of the parent does not survive the fork (libgomp is not fork safe), a single threaded
+    # child never enters a parallel region: the parallelism is one segment per core
+    torch.set_num_threads(1)
+    cv2.setNumThreads(1)
+    _segment_job = job
+
+def _segment_worker(segment):
+    animate_from_coeff, x, stages = _segment_job
+    return animate_from_coeff.render_segment(x, *segment, **stages)
+
 class AnimateFromCoeff():
 
-    def __init__(self, sadtalker_path, device):
+    def __init__(self, sadtalker_path, device, precision='fp32', channels_last=False, backend='torch', export_dir=None):
 
         with open(sadtalker_path['facerender_yaml']) as f:
             config = yaml.safe_load(f)
@@ -76,16 +131,30 @@ class AnimateFromCoeff():
         self.he_estimator = he_estimator
         self.mapping = mapping
 
-        self.kp_extractor.eval()
-        self.generator.eval()
-        self.he_estimator.eval()
-        self.mapping.eval()
+        for model in (self.kp_extractor, self.generator, self.he_estimator, self.mapping):
+            prepare_for_inference(model)
+
+        if channels_last:
+            # the 2D convolutions of the generator in NHWC and the 3D ones in NDHWC
+            for module in self.generator.modules():
+                if isinstance(module, torch.nn.Conv2d):
+                    module.to(memory_format=torch.channels_last)
+                elif isinstance(module, torch.nn.Conv3d):
+                    module.to(memory_format=torch.channels_last_3d)
+
+        if backend != 'torch':
+            # precision and channels_last only apply to the torch networks, the exported ones run as exported
+            self.kp_extractor = load_network('kp_detector', backend, export_dir, device)
+            self.generator = load_network('generator', backend, export_dir, device)
+            self.mapping = load_network('mapping', backend, export_dir, device)
          
         self.device = device
+        self.precision = precision
     
     def load_cpk_facevid2vid_safetensor(self, checkpoint_path, generator=None, 
                         kp_detector=None, he_estimator=None,  
                         device="cpu"):
+        import safetensors.torch
 
         checkpoint = safetensors.torch.load_file(checkpoint_path)
 
@@ -154,7 +223,10 @@ class AnimateFromCoeff():
 
         return checkpoint['epoch']
 
-    def generate(self, x, video_save_dir, pic_path, crop_info, enhancer=None, background_enhancer=None, preprocess='crop', img_size=256):
+    def generate_frames(self, x, crop_info, img_size=256, precision=None):
+        """ Render x batch by batch and yield RGB uint8 frames in order, resized to the crop aspect ratio.
+        precision is 'fp32' or 'bf16' (None for the default of this AnimateFromCoeff), 'bf16' falls back
+        to FP32 when the device has no native support or the first batch fails. """
 
         source_image=x['source_image'].type(torch.FloatTensor)
         source_semantics=x['source_semantics'].type(torch.FloatTensor)
@@ -180,78 +252,133 @@ class AnimateFromCoeff():
 
         frame_num = x['frame_num']
 
-        predictions_video = make_animation(source_image, source_semantics, target_semantics,
-                                        self.generator, self.kp_extractor, self.he_estimator, self.mapping, 
-                                        yaw_c_seq, pitch_c_seq, roll_c_seq, use_exp = True)
-
-        predictions_video = predictions_video.reshape((-1,)+predictions_video.shape[2:])
-        predictions_video = predictions_video[:frame_num]
-
-        video = []
-        for idx in range(predictions_video.shape[0]):
-            image = predictions_video[idx]
-            image = np.transpose(image.data.cpu().numpy(), [1, 2, 0]).astype(np.float32)
-            video.append(image)
-        result = img_as_ubyte(video)
-
         ### the generated video is 256x256, so we keep the aspect ratio, 
         original_size = crop_info[0]
         if original_size:
-            result = [ cv2.resize(result_i,(img_size, int(img_size * original_size[1]/original_size[0]) )) for result_i in result ]
-        
-        video_name = x['video_name']  + '.mp4'
-        path = os.path.join(video_save_dir, 'temp_'+video_name)
-        
-        imageio.mimsave(path, result,  fps=float(25))
+            out_size = (img_size, int(img_size * original_size[1]/original_size[0]))
 
-        av_path = os.path.join(video_save_dir, video_name)
-        return_path = av_path 
-        
-        audio_path =  x['audio_path'] 
-        audio_name = os.path.splitext(os.path.split(audio_path)[-1])[0]
-        new_audio_path = os.path.join(video_save_dir, audio_name+'.wav')
-        start_time = 0
-        # cog will not keep the .mp3 filename
-        sound = AudioSegment.from_file(audio_path)
-        frames = frame_num 
-        end_time = start_time + frames*1/25*1000
-        word1=sound.set_frame_rate(16000)
-        word = word1[start_time:end_time]
-        word.export(new_audio_path, format="wav")
-
-        save_video_with_watermark(path, new_audio_path, av_path, watermark= False)
-        print(f'The generated video is named {video_save_dir}/{video_name}') 
+        precision = precision or self.precision
+        use_half = precision == 'bf16' and half_precision_supported(self.device)
+        if precision == 'bf16' and not use_half:
+            print('bf16 is not supported on this device, rendering in fp32')
+
+        render = lambda use_half: make_animation_iter(source_image, source_semantics, target_semantics,
+                                        self.generator, self.kp_extractor, self.he_estimator, self.mapping, 
+                                        yaw_c_seq, pitch_c_seq, roll_c_seq, use_exp = True, use_half=use_half)
+        predictions_iter = render(use_half)
+        if use_half:
+            try:
+                first_predictions = next(predictions_iter)
+            except RuntimeError as e:
+                print(f'bf16 rendering failed ({e}), rendering in fp32')
+                predictions_iter = render(False)
+            else:
+                predictions_iter = itertools.chain([first_predictions], predictions_iter)
+
+        frame_idx = 0
+        for predictions in predictions_iter:
+            # drop the frames padded up to the batch size
+            predictions = predictions[:frame_num - frame_idx]
+            # same rounding as skimage.img_as_ubyte, done on the tensor
+            frames = predictions.mul(255).round_().clamp_(0, 255).to(torch.uint8)
+            frames = frames.permute(0, 2, 3, 1).contiguous().cpu().numpy()
+            for frame in frames:
+                if original_size:
+                    frame = cv2.resize(frame, out_size)
+                yield frame
+            frame_idx += frames.shape[0]
+            if frame_idx >= frame_num:
+                break
+
+    def render_frames(self, x, crop_info, pic_path, img_size=256, preprocess='crop', paste_method='poisson',
+                      enhancer=None, background_enhancer=None, precision=None, paste_workers=None):
+        """ The frames of x through the renderer, the optional paste back and the enhancer. """
+        frames = self.generate_frames(x, crop_info, img_size, precision=precision)
 
         if 'full' in preprocess.lower():
-            # only add watermark to the full image.
-            video_name_full = x['video_name']  + '_full.mp4'
-            full_video_path = os.path.join(video_save_dir, video_name_full)
-            return_path = full_video_path
-            paste_pic(path, pic_path, crop_info, new_audio_path, full_video_path, extended_crop= True if 'ext' in preprocess.lower() else False)
-            print(f'The generated video is named {video_save_dir}/{video_name_full}') 
-        else:
-            full_video_path = av_path 
+            frames = paste_frames(frames, pic_path, crop_info, extended_crop= True if 'ext' in preprocess.lower() else False,
+                                  method=paste_method, num_workers=paste_workers)
 
         #### paste back then enhancers
         if enhancer:
-            video_name_enhancer = x['video_name']  + '_enhanced.mp4'
-            enhanced_path = os.path.join(video_save_dir, 'temp_'+video_name_enhancer)
-            av_path_enhancer = os.path.join(video_save_dir, video_name_enhancer) 
-            return_path = av_path_enhancer
-
-            try:
-                enhanced_images_gen_with_len = enhancer_generator_with_len(full_video_path, method=enhancer, bg_upsampler=background_enhancer)
-                imageio.mimsave(enhanced_path, enhanced_images_gen_with_len, fps=float(25))
-            except:
-                enhanced_images_gen_with_len = enhancer_list(full_video_path, method=enhancer, bg_upsampler=background_enhancer)
-                imageio.mimsave(enhanced_path, enhanced_images_gen_with_len, fps=float(25))
-            
-            save_video_with_watermark(enhanced_path, new_audio_path, av_path_enhancer, watermark= False)
-            print(f'The generated video is named {video_save_dir}/{video_name_enhancer}')
-            os.remove(enhanced_path)
+            if isinstance(enhancer, str):
+                # gfpgan and basicsr are only imported by the requests that enhance
+                from src.utils.face_enhancer import enhancer_generator_no_len
+                frames = enhancer_generator_no_len(frames, method=enhancer, bg_upsampler=background_enhancer)
+            else:
+                if background_enhancer and background_enhancer != enhancer.bg_upsampler:
+                    raise ValueError('background enhancer %s given with a FaceEnhancer built with %s, build the '
+                                     'FaceEnhancer with bg_upsampler=%r' % (background_enhancer, enhancer.bg_upsampler,
+                                                                            background_enhancer))
+                # a resident FaceEnhancer, in still mode the face does not move so one detection is enough
+                frames = enhancer.enhance_frames(frames, static_face=x.get('still_mode', False))
+        return frames
+
+    def render_segment(self, x, start, end, path, **stages):
+        """
+        Render frames [start, end) of x into the video-only file path, the job of a segment worker.
+        The frame to frame state of the stages after the renderer (the canvas of the feather paste, the face
+        detection of a still face) comes from the first frame of the video, so the first batch is rendered
+        ahead of a later segment and dropped: the frames are the ones of the sequential render.
+        """
+        lead_in = min(start, x['source_image'].shape[0])
+        frames = self.render_frames(segment_data(x, list(range(lead_in)) + list(range(start, end))),
+                                    paste_workers=0, **stages)
+        return save_frames_to_video(itertools.islice(frames, lead_in, None), path, fps=25)
+
+    def render_segments(self, x, segments, path, progress=None, **stages):
+        """ Render the segments in a pool of forked single threaded processes, one per segment, and join
+        them by stream copy, the audio is muxed in the same pass. progress is called as segments complete. """
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(path) or None) as segment_dir:
+            segment_paths = [os.path.join(segment_dir, 'segment%03d.mp4' % i) for i in range(len(segments))]
+            # forked workers share the loaded networks and x with this process, nothing is pickled but the ranges
+            with multiprocessing.get_context('fork').Pool(len(segments), initializer=_init_segment_worker,
+                                                          initargs=((self, x, stages),)) as pool:
+                results = pool.imap(_segment_worker, [(start, end, segment_path) for (start, end), segment_path in zip(segments, segment_paths)])
+                # imap yields in order, segment i is done once its result comes back
+                for start, end in segments:
+                    next(results)
+                    if progress is not None:
+                        progress(end, x['frame_num'])
+            concat_videos(segment_paths, path, audio=x['audio'], duration=x['frame_num']/25)
+
+    def generate(self, x, video_save_dir, pic_path, crop_info, enhancer=None, background_enhancer=None, preprocess='crop', img_size=256, paste_method='poisson', precision=None, num_workers=1, progress=None, paste_workers=None):
+        """
+        Render x into <video_save_dir>/<video name>.mp4 with its audio. With num_workers > 1 a long video is
+        split in up to num_workers segments, no more than torch.get_num_threads(), rendered in parallel single
+        threaded processes (CPU only, where fork is available).
+        progress, when given, is called with (frames written, frame_num) as the video is written.
+        paste_workers is the number of processes of the poisson paste back of the full modes (see paste_frames),
+        the segments always paste in their own process.
+        """
 
-        os.remove(path)
-        os.remove(new_audio_path)
+        frame_num = x['frame_num']
+        video_name = x['video_name']
+        if 'full' in preprocess.lower():
+            video_name = x['video_name']  + '_full'
+        if enhancer:
+            video_name = x['video_name']  + '_enhanced'
+        return_path = os.path.join(video_save_dir, video_name + '.mp4')
+        stages = dict(crop_info=crop_info, pic_path=pic_path, img_size=img_size, preprocess=preprocess, paste_method=paste_method,
+                      enhancer=enhancer, background_enhancer=background_enhancer, precision=precision)
+
+        segments = [(0, frame_num)]
+        if num_workers > 1 and 'cuda' not in str(self.device) and 'fork' in multiprocessing.get_all_start_methods() \
+                and not multiprocessing.current_process().daemon:
+            # one single threaded segment per core of the thread budget of this process
+            segments = split_segments(frame_num, x['source_image'].shape[0], min(num_workers, torch.get_num_threads()))
+
+        if len(segments) > 1:
+            print(f'Rendering {frame_num} frames in {len(segments)} segments')
+            self.render_segments(x, segments, return_path, progress=progress, **stages)
+        else:
+            # frames flow from the renderer through the optional paste back and enhancer
+            # into a single encode + mux, nothing is decoded or re-encoded in between.
+            frames = self.render_frames(x, paste_workers=paste_workers, **stages)
+            if progress is not None:
+                frames = report_progress(frames, progress, frame_num)
+            # the AudioBuffer decoded for the request, or the path of the audio file
+            save_frames_to_video(frames, return_path, fps=25, audio=x['audio'], duration=frame_num/25)
+        print(f'The generated video is named {return_path}') 
 
         return return_path
-
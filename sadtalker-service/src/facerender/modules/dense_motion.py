@@ -12,7 +12,7 @@ class DenseMotionNetwork(nn.Module):
     """
 
     def __init__(self, block_expansion, num_blocks, max_features, num_kp, feature_channel, reshape_depth, compress,
-                 estimate_occlusion_map=False):
+                 estimate_occlusion_map=False, deform_chunk_size=4):
         super(DenseMotionNetwork, self).__init__()
         # self.hourglass = Hourglass(block_expansion=block_expansion, in_features=(num_kp+1)*(feature_channel+1), max_features=max_features, num_blocks=num_blocks)
         self.hourglass = Hourglass(block_expansion=block_expansion, in_features=(num_kp+1)*(compress+1), max_features=max_features, num_blocks=num_blocks)
@@ -29,11 +29,13 @@ class DenseMotionNetwork(nn.Module):
             self.occlusion = None
 
         self.num_kp = num_kp
+        # keypoints (with the background) deformed per grid_sample call, None for all at once
+        self.deform_chunk_size = deform_chunk_size
 
 
     def create_sparse_motions(self, feature, kp_driving, kp_source):
         bs, _, d, h, w = feature.shape
-        identity_grid = make_coordinate_grid((d, h, w), type=kp_source['value'].type())
+        identity_grid = make_coordinate_grid((d, h, w), dtype=kp_source['value'].dtype, device=kp_source['value'].device)
         identity_grid = identity_grid.view(1, 1, d, h, w, 3)
         coordinate_grid = identity_grid - kp_driving['value'].view(bs, self.num_kp, 1, 1, 1, 3)
         
@@ -41,7 +43,6 @@ class DenseMotionNetwork(nn.Module):
         if 'jacobian' in kp_driving and kp_driving['jacobian'] is not None:
             jacobian = torch.matmul(kp_source['jacobian'], torch.inverse(kp_driving['jacobian']))
             jacobian = jacobian.unsqueeze(-3).unsqueeze(-3).unsqueeze(-3)
-            jacobian = jacobian.repeat(1, 1, d, h, w, 1, 1)
             coordinate_grid = torch.matmul(jacobian, coordinate_grid.unsqueeze(-1))
             coordinate_grid = coordinate_grid.squeeze(-1)                  
 
@@ -49,21 +50,32 @@ class DenseMotionNetwork(nn.Module):
         driving_to_source = coordinate_grid + kp_source['value'].view(bs, self.num_kp, 1, 1, 1, 3)    # (bs, num_kp, d, h, w, 3)
 
         #adding background feature
-        identity_grid = identity_grid.repeat(bs, 1, 1, 1, 1, 1)
+        identity_grid = identity_grid.expand(bs, 1, d, h, w, 3)
         sparse_motions = torch.cat([identity_grid, driving_to_source], dim=1)                #bs num_kp+1 d h w 3
         
         # sparse_motions = driving_to_source
 
         return sparse_motions
 
-    def create_deformed_feature(self, feature, sparse_motions):
-        bs, _, d, h, w = feature.shape
-        feature_repeat = feature.unsqueeze(1).unsqueeze(1).repeat(1, self.num_kp+1, 1, 1, 1, 1, 1)      # (bs, num_kp+1, 1, c, d, h, w)
-        feature_repeat = feature_repeat.view(bs * (self.num_kp+1), -1, d, h, w)                         # (bs*(num_kp+1), c, d, h, w)
-        sparse_motions = sparse_motions.view((bs * (self.num_kp+1), d, h, w, -1))                       # (bs*(num_kp+1), d, h, w, 3) !!!!
-        sparse_deformed = F.grid_sample(feature_repeat, sparse_motions)
-        sparse_deformed = sparse_deformed.view((bs, self.num_kp+1, -1, d, h, w))                        # (bs, num_kp+1, c, d, h, w)
-        return sparse_deformed
+    def create_deformed_feature(self, feature, sparse_motions, out=None):
+        """
+        Sample feature at the sparse motions of every keypoint, (bs, num_kp+1, c, d, h, w).
+        The keypoints are stacked along the depth of the sampling grid instead of repeating the feature volume.
+        Given out, the result is written into it deform_chunk_size keypoints at a time, so no other full size
+        tensor is allocated.
+        """
+        bs, c, d, h, w = feature.shape
+        num_groups = self.num_kp + 1
+        sparse_motions = sparse_motions.reshape(bs, num_groups * d, h, w, 3)                            # (bs, (num_kp+1)*d, h, w, 3)
+        if out is None:
+            sparse_deformed = F.grid_sample(feature, sparse_motions)                                     # (bs, c, (num_kp+1)*d, h, w)
+            return sparse_deformed.view(bs, c, num_groups, d, h, w).transpose(1, 2)
+        chunk_size = self.deform_chunk_size or num_groups
+        for i in range(0, num_groups, chunk_size):
+            n = min(chunk_size, num_groups - i)
+            sparse_deformed = F.grid_sample(feature, sparse_motions[:, i*d:(i+n)*d])                     # (bs, c, n*d, h, w)
+            out[:, i:i+n] = sparse_deformed.view(bs, c, n, d, h, w).transpose(1, 2)
+        return out
 
     def create_heatmap_representations(self, feature, kp_driving, kp_source):
         spatial_size = feature.shape[3:]
@@ -86,12 +98,18 @@ class DenseMotionNetwork(nn.Module):
 
         out_dict = dict()
         sparse_motion = self.create_sparse_motions(feature, kp_driving, kp_source)
-        deformed_feature = self.create_deformed_feature(feature, sparse_motion)
-
-        heatmap = self.create_heatmap_representations(deformed_feature, kp_driving, kp_source)
 
-        input_ = torch.cat([heatmap, deformed_feature], dim=2)
-        input_ = input_.view(bs, -1, d, h, w)
+        if torch.jit.is_tracing():
+            # the ONNX export does not follow the writes into a view below
+            deformed_feature = self.create_deformed_feature(feature, sparse_motion)
+            heatmap = self.create_heatmap_representations(deformed_feature, kp_driving, kp_source)
+            input_ = torch.cat([heatmap, deformed_feature], dim=2)
+        else:
+            # heatmap and deformed feature are written side by side into the hourglass input, no concatenation copy
+            input_ = feature.new_empty(bs, self.num_kp + 1, feature.shape[1] + 1, d, h, w)
+            deformed_feature = self.create_deformed_feature(feature, sparse_motion, out=input_[:, :, 1:])
+            input_[:, :, :1] = self.create_heatmap_representations(deformed_feature, kp_driving, kp_source)
+        input_ = input_.reshape(bs, -1, d, h, w)
 
         # input = deformed_feature.view(bs, -1, d, h, w)      # (bs, num_kp+1 * c, d, h, w)
 
@@ -114,7 +132,7 @@ class DenseMotionNetwork(nn.Module):
 
         if self.occlusion:
             bs, c, d, h, w = prediction.shape
-            prediction = prediction.view(bs, -1, h, w)
+            prediction = prediction.reshape(bs, -1, h, w)
             occlusion_map = torch.sigmoid(self.occlusion(prediction))
             out_dict['occlusion_map'] = occlusion_map
 
@@ -75,7 +75,7 @@ class OcclusionAwareGenerator(nn.Module):
         out = self.second(out)
         bs, c, h, w = out.shape
         # print(out.shape)
-        feature_3d = out.view(bs, self.reshape_channel, self.reshape_depth, h ,w) 
+        feature_3d = out.reshape(bs, self.reshape_channel, self.reshape_depth, h ,w) 
         feature_3d = self.resblocks_3d(feature_3d)
 
         # Transforming feature representation according to deformation and occlusion
@@ -94,7 +94,7 @@ class OcclusionAwareGenerator(nn.Module):
             out = self.deform_input(feature_3d, deformation)
 
             bs, c, d, h, w = out.shape
-            out = out.view(bs, c*d, h, w)
+            out = out.reshape(bs, c*d, h, w)
             out = self.third(out)
             out = self.fourth(out)
 
@@ -215,7 +215,7 @@ class OcclusionAwareSPADEGenerator(nn.Module):
         out = self.second(out)
         bs, c, h, w = out.shape
         # print(out.shape)
-        feature_3d = out.view(bs, self.reshape_channel, self.reshape_depth, h ,w) 
+        feature_3d = out.reshape(bs, self.reshape_channel, self.reshape_depth, h ,w) 
         feature_3d = self.resblocks_3d(feature_3d)
 
         # Transforming feature representation according to deformation and occlusion
@@ -236,7 +236,7 @@ class OcclusionAwareSPADEGenerator(nn.Module):
             out = self.deform_input(feature_3d, deformation)
 
             bs, c, d, h, w = out.shape
-            out = out.view(bs, c*d, h, w)
+            out = out.reshape(bs, c*d, h, w)
             out = self.third(out)
             out = self.fourth(out)
 
@@ -99,6 +99,11 @@ def keypoint_transformation(kp_canonical, he, wo_exp=False):
 
 
 
+def half_autocast(device_type, enabled=True):
+    """ autocast context for use_half: bfloat16 on CPU, float16 on CUDA """
+    dtype = torch.float16 if device_type == 'cuda' else torch.bfloat16
+    return torch.autocast(device_type=device_type, dtype=dtype, enabled=enabled)
+
 def make_animation(source_image, source_semantics, target_semantics,
                             generator, kp_detector, he_estimator, mapping, 
                             yaw_c_seq=None, pitch_c_seq=None, roll_c_seq=None,
@@ -125,7 +130,8 @@ def make_animation(source_image, source_semantics, target_semantics,
             kp_driving = keypoint_transformation(kp_canonical, he_driving)
                 
             kp_norm = kp_driving
-            out = generator(source_image, kp_source=kp_source, kp_driving=kp_norm)
+            with half_autocast(source_image.device.type, enabled=use_half):
+                out = generator(source_image, kp_source=kp_source, kp_driving=kp_norm)
             '''
             source_image_new = out['prediction'].squeeze(1)
             kp_canonical_new =  kp_detector(source_image_new)
@@ -134,10 +140,50 @@ def make_animation(source_image, source_semantics, target_semantics,
             kp_driving_new = keypoint_transformation(kp_canonical_new, he_driving, wo_exp=True)
             out = generator(source_image_new, kp_source=kp_source_new, kp_driving=kp_driving_new)
             '''
-            predictions.append(out['prediction'])
+            predictions.append(out['prediction'].float())
         predictions_ts = torch.stack(predictions, dim=1)
     return predictions_ts
 
+@torch.no_grad()
+def make_animation_iter(source_image, source_semantics, target_semantics,
+                            generator, kp_detector, he_estimator, mapping, 
+                            yaw_c_seq=None, pitch_c_seq=None, roll_c_seq=None,
+                            use_exp=True, use_half=False):
+    """
+    Same inputs as make_animation, but yields the predictions of batch_size consecutive frames
+    at a time (in frame order) instead of stacking the whole video in memory.
+    With use_half only the generator runs in reduced precision, keypoints and mapping stay in FP32.
+    """
+    batch_size = source_image.shape[0]
+    # (bs, frame_num/bs, ...) holds the frames in row-major order, flatten back to frame order
+    target_semantics = target_semantics.reshape((-1,) + target_semantics.shape[2:])      # frame_num 70 27
+    if yaw_c_seq is not None:
+        yaw_c_seq = yaw_c_seq.reshape(-1)
+    if pitch_c_seq is not None:
+        pitch_c_seq = pitch_c_seq.reshape(-1)
+    if roll_c_seq is not None:
+        roll_c_seq = roll_c_seq.reshape(-1)
+
+    kp_canonical = kp_detector(source_image)
+    he_source = mapping(source_semantics)
+    kp_source = keypoint_transformation(kp_canonical, he_source)
+
+    for start in tqdm(range(0, target_semantics.shape[0], batch_size), 'Face Renderer:'):
+        end = start + batch_size
+        target_semantics_frame = target_semantics[start:end]
+        he_driving = mapping(target_semantics_frame)
+        if yaw_c_seq is not None:
+            he_driving['yaw_in'] = yaw_c_seq[start:end]
+        if pitch_c_seq is not None:
+            he_driving['pitch_in'] = pitch_c_seq[start:end]
+        if roll_c_seq is not None:
+            he_driving['roll_in'] = roll_c_seq[start:end]
+
+        kp_driving = keypoint_transformation(kp_canonical, he_driving)
+        with half_autocast(source_image.device.type, enabled=use_half):
+            out = generator(source_image, kp_source=kp_source, kp_driving=kp_driving)
+        yield out['prediction'].float()             # bs 3 H W
+
 class AnimateModel(torch.nn.Module):
     """
     Merge all generator related updates into single model for better multi-gpu usage
@@ -15,14 +15,10 @@ def kp2gaussian(kp, spatial_size, kp_variance):
     """
     mean = kp['value']
 
-    coordinate_grid = make_coordinate_grid(spatial_size, mean.type())
+    coordinate_grid = make_coordinate_grid(spatial_size, dtype=mean.dtype, device=mean.device)
     number_of_leading_dimensions = len(mean.shape) - 1
-    shape = (1,) * number_of_leading_dimensions + coordinate_grid.shape
-    coordinate_grid = coordinate_grid.view(*shape)
-    repeats = mean.shape[:number_of_leading_dimensions] + (1, 1, 1, 1)
-    coordinate_grid = coordinate_grid.repeat(*repeats)
 
-    # Preprocess kp shape
+    # Preprocess kp shape, the grid is broadcast against the leading dimensions
     shape = mean.shape[:number_of_leading_dimensions] + (1, 1, 1, 3)
     mean = mean.view(*shape)
 
@@ -32,42 +28,40 @@ def kp2gaussian(kp, spatial_size, kp_variance):
 
     return out
 
-def make_coordinate_grid_2d(spatial_size, type):
+# coordinate grids by (spatial_size, dtype, device), they are constants of the network and shared between calls
+_coordinate_grids = {}
+# (dtype, device) of the tensor type strings, e.g. 'torch.cuda.FloatTensor', still accepted as `type`
+_tensor_types = {}
+
+def _cached_coordinate_grid(spatial_size, type, dtype, device):
+    if type is not None:
+        if type not in _tensor_types:
+            t = torch.empty(0).type(type)
+            _tensor_types[type] = (t.dtype, t.device)
+        dtype, device = _tensor_types[type]
+    key = (tuple(int(s) for s in spatial_size), dtype, torch.device(device))
+    grid = _coordinate_grids.get(key)
+    if grid is None:
+        # x first, as in the original meshgrid: the last coordinate is the first spatial dimension
+        axes = [2 * (torch.arange(n, dtype=dtype, device=device) / (n - 1)) - 1 for n in key[0]]
+        grid = torch.stack(torch.meshgrid(*axes, indexing='ij')[::-1], dim=-1)
+        _coordinate_grids[key] = grid
+    return grid
+
+def make_coordinate_grid_2d(spatial_size, type=None, dtype=torch.float32, device='cpu'):
     """
     Create a meshgrid [-1,1] x [-1,1] of given spatial_size.
+    The grid is cached and shared, do not modify it in place.
     """
-    h, w = spatial_size
-    x = torch.arange(w).type(type)
-    y = torch.arange(h).type(type)
+    return _cached_coordinate_grid(spatial_size, type, dtype, device)
 
-    x = (2 * (x / (w - 1)) - 1)
-    y = (2 * (y / (h - 1)) - 1)
 
-    yy = y.view(-1, 1).repeat(1, w)
-    xx = x.view(1, -1).repeat(h, 1)
-
-    meshed = torch.cat([xx.unsqueeze_(2), yy.unsqueeze_(2)], 2)
-
-    return meshed
-
-
-def make_coordinate_grid(spatial_size, type):
-    d, h, w = spatial_size
-    x = torch.arange(w).type(type)
-    y = torch.arange(h).type(type)
-    z = torch.arange(d).type(type)
-
-    x = (2 * (x / (w - 1)) - 1)
-    y = (2 * (y / (h - 1)) - 1)
-    z = (2 * (z / (d - 1)) - 1)
-   
-    yy = y.view(1, -1, 1).repeat(d, 1, w)
-    xx = x.view(1, 1, -1).repeat(d, h, 1)
-    zz = z.view(-1, 1, 1).repeat(1, h, w)
-
-    meshed = torch.cat([xx.unsqueeze_(3), yy.unsqueeze_(3), zz.unsqueeze_(3)], 3)
-
-    return meshed
+def make_coordinate_grid(spatial_size, type=None, dtype=torch.float32, device='cpu'):
+    """
+    Create a meshgrid [-1,1] x [-1,1] x [-1,1] of given spatial_size.
+    The grid is cached and shared, do not modify it in place.
+    """
+    return _cached_coordinate_grid(spatial_size, type, dtype, device)
 
 
 class ResBottleneck(nn.Module):
@@ -361,7 +355,7 @@ class KPHourglass(nn.Module):
         out = self.down_blocks(x)
         out = self.conv(out)
         bs, c, h, w = out.shape
-        out = out.view(bs, c//self.reshape_depth, self.reshape_depth, h, w)
+        out = out.reshape(bs, c//self.reshape_depth, self.reshape_depth, h, w)
         out = self.up_blocks(out)
 
         return out
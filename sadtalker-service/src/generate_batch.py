@@ -1,11 +1,12 @@
 import os
 
-from tqdm import tqdm
 import torch
 import numpy as np
 import random
 import scipy.io as scio
-import src.utils.audio as audio
+import src.utils.audio as audio_utils
+from src.utils.audio import AudioBuffer
+from src.utils.artifact import load_coeff
 
 def crop_pad_audio(wav, audio_length):
     if len(wav) > audio_length:
@@ -34,13 +35,13 @@ def generate_blink_seq(num_frames):
             break
     return ratio 
 
-def generate_blink_seq_randomly(num_frames):
+def generate_blink_seq_randomly(num_frames, rng=random):
     ratio = np.zeros((num_frames,1))
     if num_frames<=20:
         return ratio
     frame_id = 0
     while frame_id in range(num_frames):
-        start = random.choice(range(min(10,num_frames), min(int(num_frames/2), 70))) 
+        start = rng.choice(range(min(10,num_frames), min(int(num_frames/2), 70))) 
         if frame_id+start+5<=num_frames - 1:
             ratio[frame_id+start:frame_id+start+5, 0] = [0.5, 0.9, 1.0, 0.9, 0.5]
             frame_id = frame_id+start+5
@@ -48,46 +49,49 @@ def generate_blink_seq_randomly(num_frames):
             break
     return ratio
 
-def get_data(first_coeff_path, audio_path, device, ref_eyeblink_coeff_path, still=False, idlemode=False, length_of_audio=False, use_blink=True):
+def get_mel_windows(orig_mel, num_frames, fps=25, syncnet_mel_step_size=16):
+    # window of every video frame starts two frames back, clamped to the mel range
+    start_frame_num = np.arange(num_frames) - 2
+    start_idx = (80. * (start_frame_num / float(fps))).astype(np.int64)
+    seq = start_idx[:, None] + np.arange(syncnet_mel_step_size)[None, :]          # T 16
+    seq = np.clip(seq, 0, orig_mel.shape[0]-1)
+    return np.ascontiguousarray(orig_mel[seq].transpose(0, 2, 1))               # T 80 16
+
+def get_data(first_coeff, audio, device, ref_eyeblink_coeff, still=False, idlemode=False, length_of_audio=False, use_blink=True, seed=None):
+    """
+    first_coeff and ref_eyeblink_coeff are CoeffArtifacts or paths of .mat, audio an AudioBuffer or the path of the audio,
+    the blinks are drawn from a random.Random(seed) when a seed is given
+    """
 
     syncnet_mel_step_size = 16
     fps = 25
 
-    pic_name = os.path.splitext(os.path.split(first_coeff_path)[-1])[0]
-    audio_name = os.path.splitext(os.path.split(audio_path)[-1])[0]
+    first_coeff = load_coeff(first_coeff)
+    ref_eyeblink_coeff = load_coeff(ref_eyeblink_coeff)
+    pic_name = first_coeff.name
+    if not idlemode and not isinstance(audio, AudioBuffer):
+        audio = AudioBuffer.load(audio)
+    audio_name = audio.name if isinstance(audio, AudioBuffer) else os.path.splitext(os.path.split(audio)[-1])[0]
 
     
     if idlemode:
         num_frames = int(length_of_audio * 25)
         indiv_mels = np.zeros((num_frames, 80, 16))
     else:
-        wav = audio.load_wav(audio_path, 16000) 
-        wav_length, num_frames = parse_audio_length(len(wav), 16000, 25)
-        wav = crop_pad_audio(wav, wav_length)
-        orig_mel = audio.melspectrogram(wav).T
-        spec = orig_mel.copy()         # nframes 80
-        indiv_mels = []
-
-        for i in tqdm(range(num_frames), 'mel:'):
-            start_frame_num = i-2
-            start_idx = int(80. * (start_frame_num / float(fps)))
-            end_idx = start_idx + syncnet_mel_step_size
-            seq = list(range(start_idx, end_idx))
-            seq = [ min(max(item, 0), orig_mel.shape[0]-1) for item in seq ]
-            m = spec[seq, :]
-            indiv_mels.append(m.T)
-        indiv_mels = np.asarray(indiv_mels)         # T 80 16
-
-    ratio = generate_blink_seq_randomly(num_frames)      # T
-    source_semantics_path = first_coeff_path
-    source_semantics_dict = scio.loadmat(source_semantics_path)
-    ref_coeff = source_semantics_dict['coeff_3dmm'][:1,:70]         #1 70
+        if audio.sample_rate != 16000:
+            raise ValueError('the mel windows need 16 kHz audio, got %d Hz' % audio.sample_rate)
+        wav_length, num_frames = parse_audio_length(len(audio), 16000, 25)
+        wav = crop_pad_audio(audio.wav, wav_length)
+        orig_mel = audio_utils.cached_melspectrograms([audio.digest], [wav], device)[0].T         # nframes 80
+        indiv_mels = get_mel_windows(orig_mel, num_frames, fps, syncnet_mel_step_size)         # T 80 16
+
+    ratio = generate_blink_seq_randomly(num_frames, random if seed is None else random.Random(seed))      # T
+    ref_coeff = first_coeff.coeff_3dmm[:1,:70]         #1 70
     ref_coeff = np.repeat(ref_coeff, num_frames, axis=0)
 
-    if ref_eyeblink_coeff_path is not None:
+    if ref_eyeblink_coeff is not None:
         ratio[:num_frames] = 0
-        refeyeblink_coeff_dict = scio.loadmat(ref_eyeblink_coeff_path)
-        refeyeblink_coeff = refeyeblink_coeff_dict['coeff_3dmm'][:,:64]
+        refeyeblink_coeff = ref_eyeblink_coeff.coeff_3dmm[:,:64]
         refeyeblink_num_frames = refeyeblink_coeff.shape[0]
         if refeyeblink_num_frames<num_frames:
             div = num_frames//refeyeblink_num_frames
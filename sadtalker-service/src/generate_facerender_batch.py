@@ -1,22 +1,28 @@
 import os
 import numpy as np
 from PIL import Image
-from skimage import io, img_as_float32, transform
 import torch
 import scipy.io as scio
+from src.utils.artifact import load_coeff
 
-def get_facerender_data(coeff_path, pic_path, first_coeff_path, audio_path, 
+def get_facerender_data(coeff, pic, first_coeff, audio, 
                         batch_size, input_yaw_list=None, input_pitch_list=None, input_roll_list=None, 
-                        expression_scale=1.0, still_mode = False, preprocess='crop', size = 256):
+                        expression_scale=1.0, still_mode = False, preprocess='crop', size = 256, verbose=False):
+    """
+    coeff and first_coeff are CoeffArtifacts or paths of .mat, pic the cropped picture or its path,
+    audio the AudioBuffer or the path of the audio muxed into the video
+    """
+
+    from skimage import img_as_float32, transform
 
     semantic_radius = 13
-    video_name = os.path.splitext(os.path.split(coeff_path)[-1])[0]
-    txt_path = os.path.splitext(coeff_path)[0]
+    coeff = load_coeff(coeff)
+    first_coeff = load_coeff(first_coeff)
+    video_name = coeff.name
 
     data={}
 
-    img1 = Image.open(pic_path)
-    source_image = np.array(img1)
+    source_image = np.array(Image.open(pic)) if isinstance(pic, str) else pic
     source_image = img_as_float32(source_image)
     source_image = transform.resize(source_image, (size, size, 3))
     source_image = source_image.transpose((2, 0, 1))
@@ -24,16 +30,14 @@ def get_facerender_data(coeff_path, pic_path, first_coeff_path, audio_path,
     source_image_ts = source_image_ts.repeat(batch_size, 1, 1, 1)
     data['source_image'] = source_image_ts
  
-    source_semantics_dict = scio.loadmat(first_coeff_path)
-    generated_dict = scio.loadmat(coeff_path)
-
+    # copied, the artifacts are not modified
     if 'full' not in preprocess.lower():
-        source_semantics = source_semantics_dict['coeff_3dmm'][:1,:70]         #1 70
-        generated_3dmm = generated_dict['coeff_3dmm'][:,:70]
+        source_semantics = first_coeff.coeff_3dmm[:1,:70]         #1 70
+        generated_3dmm = coeff.coeff_3dmm[:,:70].copy()
 
     else:
-        source_semantics = source_semantics_dict['coeff_3dmm'][:1,:73]         #1 70
-        generated_3dmm = generated_dict['coeff_3dmm'][:,:70]
+        source_semantics = first_coeff.coeff_3dmm[:1,:73]         #1 70
+        generated_3dmm = coeff.coeff_3dmm[:,:70].copy()
 
     source_semantics_new = transform_semantic_1(source_semantics, semantic_radius)
     source_semantics_ts = torch.FloatTensor(source_semantics_new).unsqueeze(0)
@@ -49,29 +53,23 @@ def get_facerender_data(coeff_path, pic_path, first_coeff_path, audio_path,
     if still_mode:
         generated_3dmm[:, 64:] = np.repeat(source_semantics[:, 64:], generated_3dmm.shape[0], axis=0)
 
-    with open(txt_path+'.txt', 'w') as f:
-        for coeff in generated_3dmm:
-            for i in coeff:
-                f.write(str(i)[:7]   + '  '+'\t')
-            f.write('\n')
+    if verbose and coeff.path is not None:
+        with open(os.path.splitext(coeff.path)[0]+'.txt', 'w') as f:
+            for coeff in generated_3dmm:
+                for i in coeff:
+                    f.write(str(i)[:7]   + '  '+'\t')
+                f.write('\n')
 
-    target_semantics_list = [] 
     frame_num = generated_3dmm.shape[0]
     data['frame_num'] = frame_num
-    for frame_idx in range(frame_num):
-        target_semantics = transform_semantic_target(generated_3dmm, frame_idx, semantic_radius)
-        target_semantics_list.append(target_semantics)
-
-    remainder = frame_num%batch_size
-    if remainder!=0:
-        for _ in range(batch_size-remainder):
-            target_semantics_list.append(target_semantics)
-
-    target_semantics_np = np.array(target_semantics_list)             #frame_num 70 semantic_radius*2+1
+    # pad to a multiple of batch_size by repeating the window of the last frame
+    padded_num = frame_num + (-frame_num)%batch_size
+    target_semantics_np = transform_semantic_target_all(generated_3dmm, semantic_radius, padded_num)   #padded_num 70 semantic_radius*2+1
     target_semantics_np = target_semantics_np.reshape(batch_size, -1, target_semantics_np.shape[-2], target_semantics_np.shape[-1])
     data['target_semantics_list'] = torch.FloatTensor(target_semantics_np)
     data['video_name'] = video_name
-    data['audio_path'] = audio_path
+    data['audio'] = audio
+    data['still_mode'] = still_mode
     
     if input_yaw_list is not None:
         yaw_c_seq = gen_camera_pose(input_yaw_list, frame_num, batch_size)
@@ -97,6 +95,19 @@ def transform_semantic_target(coeff_3dmm, frame_index, semantic_radius):
     coeff_3dmm_g = coeff_3dmm[index, :]
     return coeff_3dmm_g.transpose(1,0)
 
+def transform_semantic_target_all(coeff_3dmm, semantic_radius, num_windows=None):
+    """
+    Sliding windows of transform_semantic_target for every frame in a single gather.
+    Windows past the last frame repeat the window of the last frame.
+    """
+    num_frames = coeff_3dmm.shape[0]
+    if num_windows is None:
+        num_windows = num_frames
+    frame_index = np.minimum(np.arange(num_windows), num_frames-1)
+    offsets = np.arange(-semantic_radius, semantic_radius+1)
+    index = np.clip(frame_index[:, None] + offsets[None, :], 0, num_frames-1)     # num_windows semantic_radius*2+1
+    return coeff_3dmm[index].transpose(0, 2, 1)                                 # num_windows 70 semantic_radius*2+1
+
 def gen_camera_pose(camera_degree_list, frame_num, batch_size):
 
     new_degree_list = [] 
@@ -3,17 +3,13 @@ import os, sys, shutil
 from src.utils.preprocess import CropAndExtract
 from src.test_audio2coeff import Audio2Coeff  
 from src.facerender.animate import AnimateFromCoeff
-from src.generate_batch import get_data
 from src.generate_facerender_batch import get_facerender_data
 
 from src.utils.init_path import init_path
-
-from pydub import AudioSegment
-
-
-def mp3_to_wav(mp3_filename,wav_filename,frame_rate):
-    mp3_file = AudioSegment.from_file(file=mp3_filename)
-    mp3_file.set_frame_rate(frame_rate).export(wav_filename,format="wav")
+from src.utils.ref_cache import default_ref_cache_dir
+from src.utils.coeff_cache import default_coeff_cache_dir
+from src.utils.audio import AudioBuffer
+from src.utils.idle_loops import IdleLoopLibrary, default_idle_loop_dir, render_idle_loops
 
 
 class SadTalker():
@@ -41,13 +37,17 @@ class SadTalker():
         ref_info = None,
         use_idle_mode = False,
         length_of_audio = 0, use_blink=True,
-        result_dir='./results/'):
+        result_dir='./results/', seed=None):
+
+        if use_idle_mode and not use_ref_video and not (driven_audio is not None and os.path.isfile(driven_audio)):
+            return self.idle(source_image, length_of_audio, preprocess, still_mode, use_enhancer, batch_size, size,
+                             pose_style, exp_scale, use_blink, result_dir)
 
         self.sadtalker_paths = init_path(self.checkpoint_path, self.config_path, size, False, preprocess)
         print(self.sadtalker_paths)
             
-        self.audio_to_coeff = Audio2Coeff(self.sadtalker_paths, self.device)
-        self.preprocess_model = CropAndExtract(self.sadtalker_paths, self.device)
+        self.audio_to_coeff = Audio2Coeff(self.sadtalker_paths, self.device, coeff_cache_dir=default_coeff_cache_dir(self.checkpoint_path))
+        self.preprocess_model = CropAndExtract(self.sadtalker_paths, self.device, ref_cache_dir=default_ref_cache_dir(self.checkpoint_path))
         self.animate_from_coeff = AnimateFromCoeff(self.sadtalker_paths, self.device)
 
         time_tag = str(uuid.uuid4())
@@ -61,41 +61,28 @@ class SadTalker():
         pic_path = os.path.join(input_dir, os.path.basename(source_image)) 
         shutil.move(source_image, input_dir)
 
+        # the audio is decoded once, in memory, for the mel windows and the muxer
         if driven_audio is not None and os.path.isfile(driven_audio):
-            audio_path = os.path.join(input_dir, os.path.basename(driven_audio))  
-
-            #### mp3 to wav
-            if '.mp3' in audio_path:
-                mp3_to_wav(driven_audio, audio_path.replace('.mp3', '.wav'), 16000)
-                audio_path = audio_path.replace('.mp3', '.wav')
-            else:
-                shutil.move(driven_audio, input_dir)
+            audio = AudioBuffer.load(driven_audio)
 
         elif use_idle_mode:
-            audio_path = os.path.join(input_dir, 'idlemode_'+str(length_of_audio)+'.wav') ## generate audio from this new audio_path
-            from pydub import AudioSegment
-            one_sec_segment = AudioSegment.silent(duration=1000*length_of_audio)  #duration in milliseconds
-            one_sec_segment.export(audio_path, format="wav")
+            audio = AudioBuffer.silence(length_of_audio, name='idlemode_'+str(length_of_audio))
         else:
             print(use_ref_video, ref_info)
             assert use_ref_video == True and ref_info == 'all'
 
         if use_ref_video and ref_info == 'all': # full ref mode
-            ref_video_videoname = os.path.basename(ref_video)
-            audio_path = os.path.join(save_dir, ref_video_videoname+'.wav')
-            print('new audiopath:',audio_path)
             # if ref_video contains audio, set the audio from ref_video.
-            cmd = r"ffmpeg -y -hide_banner -loglevel error -i %s %s"%(ref_video, audio_path)
-            os.system(cmd)        
+            audio = AudioBuffer.load(ref_video, name=os.path.basename(ref_video))
 
         os.makedirs(save_dir, exist_ok=True)
         
         #crop image and extract 3dmm from image
         first_frame_dir = os.path.join(save_dir, 'first_frame_dir')
         os.makedirs(first_frame_dir, exist_ok=True)
-        first_coeff_path, crop_pic_path, crop_info = self.preprocess_model.generate(pic_path, first_frame_dir, preprocess, True, size)
+        first_coeff, crop_pic, crop_info = self.preprocess_model.generate(pic_path, first_frame_dir, preprocess, True, size)
         
-        if first_coeff_path is None:
+        if first_coeff is None:
             raise AttributeError("No face is detected")
 
         if use_ref_video:
@@ -104,38 +91,37 @@ class SadTalker():
             ref_video_frame_dir = os.path.join(save_dir, ref_video_videoname)
             os.makedirs(ref_video_frame_dir, exist_ok=True)
             print('3DMM Extraction for the reference video providing pose')
-            ref_video_coeff_path, _, _ =  self.preprocess_model.generate(ref_video, ref_video_frame_dir, preprocess, source_image_flag=False)
+            ref_video_coeff =  self.preprocess_model.generate_ref_coeff(ref_video, ref_video_frame_dir, preprocess)
         else:
-            ref_video_coeff_path = None
+            ref_video_coeff = None
 
         if use_ref_video:
             if ref_info == 'pose':
-                ref_pose_coeff_path = ref_video_coeff_path
-                ref_eyeblink_coeff_path = None
+                ref_pose_coeff = ref_video_coeff
+                ref_eyeblink_coeff = None
             elif ref_info == 'blink':
-                ref_pose_coeff_path = None
-                ref_eyeblink_coeff_path = ref_video_coeff_path
+                ref_pose_coeff = None
+                ref_eyeblink_coeff = ref_video_coeff
             elif ref_info == 'pose+blink':
-                ref_pose_coeff_path = ref_video_coeff_path
-                ref_eyeblink_coeff_path = ref_video_coeff_path
+                ref_pose_coeff = ref_video_coeff
+                ref_eyeblink_coeff = ref_video_coeff
             elif ref_info == 'all':            
-                ref_pose_coeff_path = None
-                ref_eyeblink_coeff_path = None
+                ref_pose_coeff = None
+                ref_eyeblink_coeff = None
             else:
                 raise('error in refinfo')
         else:
-            ref_pose_coeff_path = None
-            ref_eyeblink_coeff_path = None
+            ref_pose_coeff = None
+            ref_eyeblink_coeff = None
 
         #audio2ceoff
         if use_ref_video and ref_info == 'all':
-            coeff_path = ref_video_coeff_path # self.audio_to_coeff.generate(batch, save_dir, pose_style, ref_pose_coeff_path)
+            coeff = ref_video_coeff # self.audio_to_coeff.generate(batch, save_dir, pose_style, ref_pose_coeff)
         else:
-            batch = get_data(first_coeff_path, audio_path, self.device, ref_eyeblink_coeff_path=ref_eyeblink_coeff_path, still=still_mode, idlemode=use_idle_mode, length_of_audio=length_of_audio, use_blink=use_blink) # longer audio?
-            coeff_path = self.audio_to_coeff.generate(batch, save_dir, pose_style, ref_pose_coeff_path)
+            coeff = self.audio_to_coeff.generate_cached(first_coeff, audio, save_dir, pose_style, ref_eyeblink_coeff, ref_pose_coeff, seed=seed, still=still_mode, idlemode=use_idle_mode, length_of_audio=length_of_audio, use_blink=use_blink) # longer audio?
 
         #coeff2video
-        data = get_facerender_data(coeff_path, crop_pic_path, first_coeff_path, audio_path, batch_size, still_mode=still_mode, preprocess=preprocess, size=size, expression_scale = exp_scale)
+        data = get_facerender_data(coeff, crop_pic, first_coeff, audio, batch_size, still_mode=still_mode, preprocess=preprocess, size=size, expression_scale = exp_scale)
         return_path = self.animate_from_coeff.generate(data, save_dir,  pic_path, crop_info, enhancer='gfpgan' if use_enhancer else None, preprocess=preprocess, img_size=size)
         video_name = data['video_name']
         print(f'The generated video is named {video_name} in {save_dir}')
@@ -152,4 +138,28 @@ class SadTalker():
         
         return return_path
 
+    def idle(self, source_image, length_of_audio, preprocess='crop', still_mode=False, use_enhancer=False, batch_size=1,
+             size=256, pose_style=0, exp_scale=1.0, use_blink=True, result_dir='./results/'):
+        """ length_of_audio seconds of idle animation cut from the idle loops of the avatar,
+        the loops are rendered on the first idle request of an avatar and reused afterwards """
+        idle_loops = IdleLoopLibrary(default_idle_loop_dir(self.checkpoint_path))
+        avatar = idle_loops.avatar_key(source_image, preprocess=preprocess, still=still_mode, enhancer='gfpgan' if use_enhancer else None, size=size,
+                                       pose_style=pose_style, expression_scale=exp_scale, use_blink=use_blink)
+        save_dir = os.path.join(result_dir, str(uuid.uuid4()))
+        os.makedirs(save_dir, exist_ok=True)
+
+        if not idle_loops.loops(avatar):
+            print('rendering the idle loops of the avatar')
+            sadtalker_paths = init_path(self.checkpoint_path, self.config_path, size, False, preprocess)
+            render_idle_loops(idle_loops, avatar, source_image,
+                              CropAndExtract(sadtalker_paths, self.device, ref_cache_dir=default_ref_cache_dir(self.checkpoint_path)),
+                              Audio2Coeff(sadtalker_paths, self.device, coeff_cache_dir=default_coeff_cache_dir(self.checkpoint_path)),
+                              AnimateFromCoeff(sadtalker_paths, self.device), save_dir,
+                              preprocess=preprocess, size=size, still=still_mode, enhancer='gfpgan' if use_enhancer else None,
+                              expression_scale=exp_scale, pose_style=pose_style, use_blink=use_blink, batch_size=batch_size)
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+        return idle_loops.serve(avatar, length_of_audio, os.path.join(save_dir, 'idlemode_'+str(length_of_audio)+'.mp4'))
+
     
\ No newline at end of file
@@ -5,13 +5,16 @@ from scipy.io import savemat, loadmat
 from yacs.config import CfgNode as CN
 from scipy.signal import savgol_filter
 
-import safetensors
-import safetensors.torch 
-
 from src.audio2pose_models.audio2pose import Audio2Pose
 from src.audio2exp_models.networks import SimpleWrapperV2 
 from src.audio2exp_models.audio2exp import Audio2Exp
 from src.utils.safetensor_helper import load_x_from_safetensor  
+from src.utils.backend import load_network
+from src.utils.prepare_model import prepare_for_inference
+from src.utils.artifact import CoeffArtifact, load_coeff
+from src.utils.audio import AudioBuffer
+from src.utils.coeff_cache import CoeffCache, coeff_key
+from src.generate_batch import get_data
 
 def load_cpk(checkpoint_path, model=None, optimizer=None, device="cpu"):
     checkpoint = torch.load(checkpoint_path, map_location=torch.device(device))
@@ -24,7 +27,7 @@ def load_cpk(checkpoint_path, model=None, optimizer=None, device="cpu"):
 
 class Audio2Coeff():
 
-    def __init__(self, sadtalker_path, device):
+    def __init__(self, sadtalker_path, device, backend='torch', export_dir=None, coeff_cache_dir=None):
         #load config
         fcfg_pose = open(sadtalker_path['audio2pose_yaml_path'])
         cfg_pose = CN.load_cfg(fcfg_pose)
@@ -33,6 +36,9 @@ class Audio2Coeff():
         cfg_exp = CN.load_cfg(fcfg_exp)
         cfg_exp.freeze()
 
+        if sadtalker_path['use_safetensor']:
+            import safetensors.torch
+
         # load audio2pose_model
         self.audio2pose_model = Audio2Pose(cfg_pose, None, device=device)
         self.audio2pose_model = self.audio2pose_model.to(device)
@@ -68,11 +74,49 @@ class Audio2Coeff():
         for param in self.audio2exp_model.parameters():
             param.requires_grad = False
         self.audio2exp_model.eval()
+        prepare_for_inference(self.audio2pose_model)
+        prepare_for_inference(self.audio2exp_model)
+
+        if backend != 'torch':
+            # the networks run from the models exported by scripts/export_models.py, the pre and post processing stays in torch
+            self.audio2exp_model.netG = load_network('audio2exp', backend, export_dir, device)
+            self.audio2pose_model.audio_encoder = load_network('audio_encoder', backend, export_dir, device)
+            self.audio2pose_model.netG.decoder = load_network('pose_decoder', backend, export_dir, device)
  
         self.device = device
-
-    def generate(self, batch, coeff_save_dir, pose_style, ref_pose_coeff_path=None):
-
+        self.backend = backend
+        self.coeff_cache = CoeffCache(coeff_cache_dir) if coeff_cache_dir is not None else None
+
+    def generate_cached(self, first_coeff, audio, coeff_save_dir, pose_style, ref_eyeblink_coeff=None, ref_pose_coeff=None,
+                        seed=None, persist=False, **data_args):
+        """
+        get_data and generate, the data_args (still, idlemode, length_of_audio, use_blink) go to get_data.
+        With a seed the CoeffArtifact is loaded from the coefficient cache when it is there.
+        """
+        if self.coeff_cache is None or seed is None:
+            batch = get_data(first_coeff, audio, self.device, ref_eyeblink_coeff, seed=seed, **data_args)
+            return self.generate(batch, coeff_save_dir, pose_style, ref_pose_coeff, persist=persist, seed=seed)
+
+        key = coeff_key(audio, first_coeff, pose_style, seed, ref_eyeblink_coeff, ref_pose_coeff, self.backend, **data_args)
+        cached_path = self.coeff_cache.get(key)
+        if cached_path is not None:
+            print(' Using cached coefficients of the audio.')
+            audio_name = audio.name if isinstance(audio, AudioBuffer) else os.path.splitext(os.path.split(audio)[-1])[0]
+            coeff = CoeffArtifact.load(cached_path, name='%s##%s'%(load_coeff(first_coeff).name, audio_name))
+            coeff.path = None
+            if persist:
+                coeff.save(coeff_save_dir)
+        else:
+            batch = get_data(first_coeff, audio, self.device, ref_eyeblink_coeff, seed=seed, **data_args)
+            coeff = self.generate(batch, coeff_save_dir, pose_style, ref_pose_coeff, persist=persist, seed=seed)
+            self.coeff_cache.put(key, coeff)
+        return coeff
+
+    def generate(self, batch, coeff_save_dir, pose_style, ref_pose_coeff=None, persist=False, seed=None):
+        """ the predicted coefficients as a CoeffArtifact, saved in coeff_save_dir with persist.
+        The pose latent codes are drawn from a generator seeded with seed when it is given. """
+
+        generator = torch.Generator().manual_seed(seed) if seed is not None else None
         with torch.no_grad():
             #test
             results_dict_exp= self.audio2exp_model.test(batch)
@@ -82,7 +126,7 @@ class Audio2Coeff():
             #class_id = 0#(i+10)%45
             #class_id = random.randint(0,46)                                   #46 styles can be selected 
             batch['class'] = torch.LongTensor([pose_style]).to(self.device)
-            results_dict_pose = self.audio2pose_model.test(batch) 
+            results_dict_pose = self.audio2pose_model.test(batch, generator) 
             pose_pred = results_dict_pose['pose_pred']                        #bs T 6
 
             pose_len = pose_pred.shape[1]
@@ -96,18 +140,18 @@ class Audio2Coeff():
 
             coeffs_pred_numpy = coeffs_pred[0].clone().detach().cpu().numpy() 
 
-            if ref_pose_coeff_path is not None: 
-                 coeffs_pred_numpy = self.using_refpose(coeffs_pred_numpy, ref_pose_coeff_path)
+            if ref_pose_coeff is not None: 
+                 coeffs_pred_numpy = self.using_refpose(coeffs_pred_numpy, ref_pose_coeff)
         
-            savemat(os.path.join(coeff_save_dir, '%s##%s.mat'%(batch['pic_name'], batch['audio_name'])),  
-                    {'coeff_3dmm': coeffs_pred_numpy})
+            coeff = CoeffArtifact('%s##%s'%(batch['pic_name'], batch['audio_name']), coeffs_pred_numpy)
+            if persist:
+                coeff.save(coeff_save_dir)
 
-            return os.path.join(coeff_save_dir, '%s##%s.mat'%(batch['pic_name'], batch['audio_name']))
+            return coeff
     
-    def using_refpose(self, coeffs_pred_numpy, ref_pose_coeff_path):
+    def using_refpose(self, coeffs_pred_numpy, ref_pose_coeff):
         num_frames = coeffs_pred_numpy.shape[0]
-        refpose_coeff_dict = loadmat(ref_pose_coeff_path)
-        refpose_coeff = refpose_coeff_dict['coeff_3dmm'][:,64:70]
+        refpose_coeff = load_coeff(ref_pose_coeff).coeff_3dmm[:,64:70]
         refpose_num_frames = refpose_coeff.shape[0]
         if refpose_num_frames<num_frames:
             div = num_frames//refpose_num_frames
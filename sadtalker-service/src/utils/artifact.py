@@ -0,0 +1,70 @@
+"""
+The 3DMM coefficients handed from one stage of the pipeline to the next.
+
+CropAndExtract.generate, CropAndExtract.generate_ref_coeff and Audio2Coeff.generate return a CoeffArtifact,
+get_data, Audio2Coeff.generate and get_facerender_data take one. It stays in memory, the .mat is only written
+when a stage is asked to persist its output (--verbose) or when the artifact goes to the reference cache.
+The stages still accept the path of a .mat in place of an artifact, through load_coeff.
+"""
+import hashlib
+import os
+
+import numpy as np
+from scipy.io import loadmat, savemat
+
+
+class CoeffArtifact():
+    """
+    name        -- str, names what is derived from it (the .mat, the rendered video)
+    coeff_3dmm  -- numpy.array (N, 70), exp 64, angle 3, trans 3, followed for the preprocess output
+                   by the 3 crop params (scale, tx, ty) of the aligned frame, (N, 73)
+    full_3dmm   -- numpy.array (1, 257), the net_recon output of the first frame, preprocess output only
+    path        -- the .mat it was loaded from or saved to, None while it only lives in memory
+    """
+
+    def __init__(self, name, coeff_3dmm, full_3dmm=None, path=None):
+        self.name = name
+        self.coeff_3dmm = coeff_3dmm
+        self.full_3dmm = full_3dmm
+        self.path = path
+
+    def __len__(self):
+        return self.coeff_3dmm.shape[0]
+
+    def __repr__(self):
+        return 'CoeffArtifact(%r, %d frames%s)' % (self.name, len(self), '' if self.path is None else ', ' + self.path)
+
+    @property
+    def digest(self):
+        """ SHA-256 of coeff_3dmm, identical for the artifact in memory and once saved and loaded back """
+        coeff_3dmm = np.ascontiguousarray(self.coeff_3dmm)
+        sha = hashlib.sha256(('%s%s' % (coeff_3dmm.dtype.str, coeff_3dmm.shape)).encode())
+        sha.update(coeff_3dmm.tobytes())
+        return sha.hexdigest()
+
+    @classmethod
+    def load(cls, path, name=None):
+        mat = loadmat(path)
+        if name is None:
+            name = os.path.splitext(os.path.split(path)[-1])[0]
+        return cls(name, mat['coeff_3dmm'], mat.get('full_3dmm'), path)
+
+    def to_mat(self):
+        """ the content of the .mat, in the layout the stages used to exchange """
+        mat = {'coeff_3dmm': self.coeff_3dmm}
+        if self.full_3dmm is not None:
+            mat['full_3dmm'] = self.full_3dmm
+        return mat
+
+    def save(self, save_dir):
+        """ write <save_dir>/<name>.mat and remember it as the path of the artifact """
+        self.path = os.path.join(save_dir, self.name + '.mat')
+        savemat(self.path, self.to_mat())
+        return self.path
+
+
+def load_coeff(coeff):
+    """ the CoeffArtifact itself, or the one saved at path coeff, None stays None """
+    if coeff is None or isinstance(coeff, CoeffArtifact):
+        return coeff
+    return CoeffArtifact.load(coeff)
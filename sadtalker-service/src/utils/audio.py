@@ -1,6 +1,13 @@
+import hashlib
+import io
+import os
+import threading
+import wave
+from collections import OrderedDict
 import librosa
 import librosa.filters
 import numpy as np
+import torch
 # import tensorflow as tf
 from scipy import signal
 from scipy.io import wavfile
@@ -9,6 +16,60 @@ from src.utils.hparams import hparams as hp
 def load_wav(path, sr):
     return librosa.core.load(path, sr=sr)[0]
 
+class AudioBuffer():
+    """
+    The audio of a request, decoded once into mono float32 PCM at sample_rate (16 kHz, the rate of the mel
+    windows). get_data computes the mel windows from it and save_frames_to_video muxes it through a pipe, so
+    the audio file is not decoded again and no intermediate WAV file is written.
+    """
+
+    def __init__(self, wav, sample_rate=16000, name='audio'):
+        self.wav = np.asarray(wav, dtype=np.float32)
+        self.sample_rate = sample_rate
+        self.name = name
+
+    @classmethod
+    def load(cls, path, sample_rate=16000, name=None):
+        """ decode any audio or video file ffmpeg or soundfile can read, named after the file by default """
+        if name is None:
+            name = os.path.splitext(os.path.split(path)[-1])[0]
+        return cls(load_wav(path, sample_rate), sample_rate, name)
+
+    @classmethod
+    def silence(cls, seconds, sample_rate=16000, name='silence'):
+        return cls(np.zeros(int(seconds * sample_rate), dtype=np.float32), sample_rate, name)
+
+    def __len__(self):
+        return len(self.wav)
+
+    @property
+    def digest(self):
+        """ SHA-256 of the rate and the samples, the key of the mel cache """
+        if getattr(self, '_digest', None) is None:
+            sha = hashlib.sha256(str(self.sample_rate).encode())
+            sha.update(self.wav.tobytes())
+            self._digest = sha.hexdigest()
+        return self._digest
+
+    @property
+    def duration(self):
+        return len(self.wav) / self.sample_rate
+
+    def to_wav_bytes(self, duration=None):
+        """ the content of a 16 bit WAV file of the audio, cut or padded with silence to duration seconds """
+        wav = self.wav
+        if duration is not None:
+            length = int(round(duration * self.sample_rate))
+            wav = np.pad(wav[:length], [0, max(0, length - len(wav))])
+        pcm = (np.clip(wav, -1, 1) * 32767).astype('<i2')
+        data = io.BytesIO()
+        with wave.open(data, 'wb') as f:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(self.sample_rate)
+            f.writeframes(pcm.tobytes())
+        return data.getvalue()
+
 def save_wav(wav, path, sr):
     wav *= 32767 / max(0.01, np.max(np.abs(wav)))
     #proposed by @dsmiller
@@ -50,6 +111,61 @@ def melspectrogram(wav):
         return _normalize(S)
     return S
 
+def melspectrogram_batch(wavs, device='cpu'):
+    """
+    melspectrogram of several clips at once: the clips are zero padded to the longest and go through a single
+    torch.stft, with the window and the mel basis cached per device. librosa centers the frames on zero
+    padding, so the frames of every clip are the ones melspectrogram gives, within float32 precision
+    (melspectrogram runs in float64). Returns a list of num_mels x frames arrays.
+    """
+    assert not hp.use_lws
+    hop_size = get_hop_size()
+    lengths = torch.tensor([len(wav) for wav in wavs])
+    batch = torch.zeros(len(wavs), int(lengths.max()))
+    for i, wav in enumerate(wavs):
+        batch[i, :len(wav)] = torch.from_numpy(np.asarray(wav, dtype=np.float32))
+    batch = batch.to(device)
+    if hp.preemphasize:
+        batch = torch.cat([batch[:, :1], batch[:, 1:] - hp.preemphasis * batch[:, :-1]], dim=1)
+        # the filter leaks the last sample of the shorter clips into their padding
+        batch = batch * (torch.arange(batch.shape[1]) < lengths[:, None]).to(device)
+
+    window, mel_basis = _torch_stft_constants(device)
+    with torch.no_grad():
+        D = torch.stft(batch, n_fft=hp.n_fft, hop_length=hop_size, win_length=hp.win_size, window=window,
+                       center=True, pad_mode='constant', return_complex=True)
+        mel = torch.matmul(mel_basis, D.abs()).cpu().numpy()
+
+    mels = []
+    for i, length in enumerate(lengths.tolist()):
+        S = _amp_to_db(mel[i, :, :1 + length // hop_size]) - hp.ref_level_db
+        mels.append(_normalize(S) if hp.signal_normalization else S)
+    return mels
+
+_mel_cache = OrderedDict()
+_mel_cache_lock = threading.Lock()
+MEL_CACHE_SIZE = 32
+
+def cached_melspectrograms(keys, wavs, device='cpu'):
+    """
+    melspectrogram_batch of the wavs, remembered under their keys (AudioBuffer.digest) for the MEL_CACHE_SIZE
+    most recent clips, so rendering the same audio again, with another pose style or avatar, skips it.
+    Only the clips missing from the cache are computed, in one batch.
+    """
+    with _mel_cache_lock:
+        mels = [_mel_cache.get(key) for key in keys]
+    missing = [i for i, mel in enumerate(mels) if mel is None]
+    if missing:
+        for i, mel in zip(missing, melspectrogram_batch([wavs[i] for i in missing], device)):
+            mels[i] = mel
+    with _mel_cache_lock:
+        for key, mel in zip(keys, mels):
+            _mel_cache[key] = mel
+            _mel_cache.move_to_end(key)
+        while len(_mel_cache) > MEL_CACHE_SIZE:
+            _mel_cache.popitem(last=False)
+    return mels
+
 def _lws_processor():
     import lws
     return lws.lws(hp.n_fft, get_hop_size(), fftsize=hp.win_size, mode="speech")
@@ -95,6 +211,19 @@ def _linear_to_mel(spectogram):
         _mel_basis = _build_mel_basis()
     return np.dot(_mel_basis, spectogram)
 
+_torch_stft_cache = {}
+
+def _torch_stft_constants(device):
+    """ the hann window of librosa.stft and the mel basis of _linear_to_mel, as float32 tensors on device """
+    global _mel_basis
+    key = str(device)
+    if key not in _torch_stft_cache:
+        if _mel_basis is None:
+            _mel_basis = _build_mel_basis()
+        window = torch.hann_window(hp.win_size, periodic=True)
+        _torch_stft_cache[key] = (window.to(device), torch.from_numpy(_mel_basis).float().to(device))
+    return _torch_stft_cache[key]
+
 def _build_mel_basis():
     assert hp.fmax <= hp.sample_rate // 2
     return librosa.filters.mel(sr=hp.sample_rate, n_fft=hp.n_fft, n_mels=hp.num_mels,
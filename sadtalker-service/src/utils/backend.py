@@ -0,0 +1,213 @@
+"""
+Run the SadTalker networks either in PyTorch or from models exported with scripts/export_models.py,
+through onnxruntime ('onnx') or OpenVINO ('openvino').
+
+Every network is exported as a tensor in, tensor out wrapper (the *Export modules below) into one
+directory per image size and preprocess family (see default_export_dir), <export_dir>/<name>.onnx
+and, for OpenVINO, <export_dir>/<name>.xml. The Compiled*
+modules load them back and take the place of the PyTorch modules with the same call signature, so
+Audio2Coeff, CropAndExtract and AnimateFromCoeff do not change how they call their networks.
+"""
+import os
+import numpy as np
+import torch
+from torch import nn
+
+BACKENDS = ['torch', 'onnx', 'openvino']
+
+MAPPING_KEYS = ['yaw', 'pitch', 'roll', 't', 'exp']
+
+
+# ------------------------ export wrappers ------------------------
+class KPDetectorExport(nn.Module):
+    def __init__(self, kp_detector):
+        super().__init__()
+        self.kp_detector = kp_detector
+
+    def forward(self, x):
+        return self.kp_detector(x)['value']
+
+
+class MappingNetExport(nn.Module):
+    def __init__(self, mapping):
+        super().__init__()
+        self.mapping = mapping
+
+    def forward(self, input_3dmm):
+        out = self.mapping(input_3dmm)
+        return tuple(out[key] for key in MAPPING_KEYS)
+
+
+class GeneratorExport(nn.Module):
+    def __init__(self, generator):
+        super().__init__()
+        self.generator = generator
+
+    def forward(self, source_image, kp_source, kp_driving):
+        return self.generator(source_image, kp_source={'value': kp_source}, kp_driving={'value': kp_driving})['prediction']
+
+
+class AudioEncoderExport(nn.Module):
+    """ the convolutions of AudioEncoder, on (N, 1, 80, 16) mel windows """
+    def __init__(self, audio_encoder):
+        super().__init__()
+        self.audio_encoder = audio_encoder.audio_encoder
+
+    def forward(self, x):
+        return self.audio_encoder(x)
+
+
+class PoseDecoderExport(nn.Module):
+    def __init__(self, decoder):
+        super().__init__()
+        self.decoder = decoder
+
+    def forward(self, z, class_id, ref, audio_emb):
+        return self.decoder({'z': z, 'class': class_id, 'ref': ref, 'audio_emb': audio_emb})['pose_motion_pred']
+
+
+# ------------------------ compiled models ------------------------
+class CompiledModel():
+    """ An exported network on onnxruntime or OpenVINO, called with torch tensors, returning a list of torch tensors. """
+
+    def __init__(self, path, backend='onnx', device='cpu'):
+        if backend == 'openvino' and not os.path.isfile(path + '.xml'):
+            # OpenVINO has no 5D GridSample, the generator is only exported to ONNX
+            print(f'no OpenVINO model for {os.path.basename(path)}, running it on onnxruntime')
+            backend = 'onnx'
+        self.path = path
+        self.backend = backend
+        if backend == 'onnx':
+            import onnxruntime
+            providers = ['CUDAExecutionProvider', 'CPUExecutionProvider'] if 'cuda' in str(device) else ['CPUExecutionProvider']
+            self.session = onnxruntime.InferenceSession(path + '.onnx', providers=providers)
+            self.input_names = [x.name for x in self.session.get_inputs()]
+        elif backend == 'openvino':
+            import openvino as ov
+            # the CPU plugin defaults to bf16 where the hardware has it, keep the precision of the PyTorch models
+            self.compiled_model = ov.Core().compile_model(path + '.xml', 'CPU', {'INFERENCE_PRECISION_HINT': 'f32'})
+            self.input_names = [x.get_any_name() for x in self.compiled_model.inputs]
+        else:
+            raise ValueError(f'unknown backend {backend}, expected one of {BACKENDS}')
+
+    def __call__(self, *inputs):
+        device = inputs[0].device
+        feed = {name: x.detach().cpu().numpy() for name, x in zip(self.input_names, inputs)}
+        if self.backend == 'onnx':
+            outputs = self.session.run(None, feed)
+        else:
+            # a new infer request per call, so one compiled model can serve several threads
+            results = self.compiled_model.create_infer_request().infer(feed)
+            outputs = [results[x] for x in self.compiled_model.outputs]
+        return [torch.from_numpy(np.ascontiguousarray(out)).to(device) for out in outputs]
+
+
+class CompiledKPDetector(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x):
+        return {'value': self.model(x)[0]}
+
+
+class CompiledMappingNet(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_3dmm):
+        return dict(zip(MAPPING_KEYS, self.model(input_3dmm)))
+
+
+class CompiledGenerator(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, source_image, kp_driving, kp_source):
+        return {'prediction': self.model(source_image, kp_source['value'], kp_driving['value'])[0]}
+
+
+class CompiledAudioEncoder(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, audio_sequences):
+        # same folding of time into the batch as AudioEncoder.forward
+        B = audio_sequences.size(0)
+        audio_sequences = torch.cat([audio_sequences[:, i] for i in range(audio_sequences.size(1))], dim=0)
+        audio_embedding = self.model(audio_sequences)[0]
+        dim = audio_embedding.shape[1]
+        audio_embedding = audio_embedding.reshape((B, -1, dim, 1, 1))
+        return audio_embedding.squeeze(-1).squeeze(-1)
+
+
+class CompiledPoseDecoder(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, batch):
+        batch['pose_motion_pred'] = self.model(batch['z'], batch['class'], batch['ref'], batch['audio_emb'])[0]
+        return batch
+
+
+class CompiledNetwork(nn.Module):
+    """ for the networks that already take and return plain tensors (SimpleWrapperV2, net_recon) """
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, *inputs):
+        return self.model(*inputs)[0]
+
+
+# name: (export wrapper, compiled module, input names, output names, dynamic axes)
+NETWORKS = {
+    'kp_detector': (KPDetectorExport, CompiledKPDetector, ['source_image'], ['value'], {'source_image': [0], 'value': [0]}),
+    'mapping': (MappingNetExport, CompiledMappingNet, ['input_3dmm'], MAPPING_KEYS,
+                dict({'input_3dmm': [0]}, **{key: [0] for key in MAPPING_KEYS})),
+    'generator': (GeneratorExport, CompiledGenerator, ['source_image', 'kp_source', 'kp_driving'], ['prediction'],
+                  {'source_image': [0], 'kp_source': [0], 'kp_driving': [0], 'prediction': [0]}),
+    'audio2exp': (None, CompiledNetwork, ['x', 'ref', 'ratio'], ['exp_coeff'],
+                  {'x': [0], 'ref': [0, 1], 'ratio': [0, 1], 'exp_coeff': [0, 1]}),
+    'audio_encoder': (AudioEncoderExport, CompiledAudioEncoder, ['mels'], ['audio_emb'], {'mels': [0], 'audio_emb': [0]}),
+    'pose_decoder': (PoseDecoderExport, CompiledPoseDecoder, ['z', 'class_id', 'ref', 'audio_emb'], ['pose_motion_pred'],
+                     {'z': [0], 'class_id': [0], 'ref': [0], 'audio_emb': [0], 'pose_motion_pred': [0]}),
+    'net_recon': (None, CompiledNetwork, ['image'], ['coeffs'], {'image': [0], 'coeffs': [0]}),
+}
+
+
+def default_export_dir(checkpoint_dir, size=256, preprocess='crop'):
+    """ The facerender checkpoints differ with the image size and between the full and the other preprocess modes. """
+    return os.path.join(checkpoint_dir, 'exported', '%d_%s' % (size, 'full' if 'full' in preprocess else 'crop'))
+
+
+def load_network(name, backend, export_dir, device='cpu'):
+    """ The compiled replacement of network `name`, exported to export_dir. """
+    if export_dir is None:
+        raise ValueError(f'backend {backend} needs the directory written by scripts/export_models.py')
+    compiled_module = NETWORKS[name][1]
+    return compiled_module(CompiledModel(os.path.join(export_dir, name), backend, device))
+
+
+def export_network(name, module, example_inputs, export_dir, openvino=True, opset_version=20):
+    """ Write network `name` (the PyTorch module) to <export_dir>/<name>.onnx and, with openvino, <name>.xml. """
+    export_wrapper, _, input_names, output_names, dynamic_axes = NETWORKS[name]
+    dynamic_axes = {key: {axis: ['batch', 'frames'][axis] for axis in axes} for key, axes in dynamic_axes.items()}
+    module = export_wrapper(module) if export_wrapper is not None else module
+    module.eval()
+    os.makedirs(export_dir, exist_ok=True)
+    path = os.path.join(export_dir, name)
+    with torch.no_grad():
+        torch.onnx.export(module, tuple(example_inputs), path + '.onnx', input_names=input_names, output_names=output_names,
+                          dynamic_axes=dynamic_axes, opset_version=opset_version, dynamo=False)
+    if openvino:
+        import openvino as ov
+        try:
+            ov.save_model(ov.convert_model(path + '.onnx'), path + '.xml')
+        except Exception as e:
+            print(f'{name} cannot be converted to OpenVINO ({str(e).strip().splitlines()[-1]}), it will run on onnxruntime')
+    return path
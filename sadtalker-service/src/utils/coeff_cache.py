@@ -0,0 +1,60 @@
+"""
+Cache of the coefficients predicted by Audio2Coeff.
+
+With a seed, the coefficients only depend on the audio, the coefficients of the source image, the reference
+coefficients, pose_style, the seed and the get_data options (still, use_blink, the idle mode length), so
+Audio2Coeff.generate_cached saves them under the SHA-256 of those, <cache_dir>/<sha256>.mat, and the next
+request with the same inputs skips get_data and the audio2exp / audio2pose networks. Changing only the
+renderer settings (size, enhancer, expression_scale, preprocess of the render) hits the entry.
+Without a seed the pose is sampled and nothing is cached.
+"""
+import hashlib
+import os
+import tempfile
+
+from scipy.io import savemat
+
+from src.utils.audio import AudioBuffer
+from src.utils.artifact import load_coeff
+from src.utils.ref_cache import file_digest
+
+
+def default_coeff_cache_dir(checkpoint_dir):
+    return os.path.join(checkpoint_dir, 'coeff_cache')
+
+
+def coeff_key(audio, first_coeff, pose_style, seed, ref_eyeblink_coeff=None, ref_pose_coeff=None, backend='torch',
+              still=False, idlemode=False, length_of_audio=False, use_blink=True):
+    """ the cache key of the arguments of Audio2Coeff.generate_cached """
+    if idlemode:
+        audio_digest = 'idle%s' % length_of_audio
+    else:
+        audio_digest = audio.digest if isinstance(audio, AudioBuffer) else file_digest(audio)
+    digest = lambda coeff: '' if coeff is None else load_coeff(coeff).digest
+    fields = [audio_digest, digest(first_coeff), digest(ref_eyeblink_coeff), digest(ref_pose_coeff),
+              pose_style, seed, backend, still, use_blink]
+    return hashlib.sha256('|'.join(str(field) for field in fields).encode()).hexdigest()
+
+
+class CoeffCache():
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.mat')
+
+    def get(self, key):
+        """ the path of the cached .mat, None on a miss """
+        path = self.path(key)
+        return path if os.path.isfile(path) else None
+
+    def put(self, key, coeff):
+        """ save the CoeffArtifact under key and return the cached path """
+        path = self.path(key)
+        # written aside and renamed, concurrent readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(suffix='.mat', dir=self.cache_dir)
+        os.close(fd)
+        savemat(tmp_path, coeff.to_mat())
+        os.replace(tmp_path, path)
+        return path
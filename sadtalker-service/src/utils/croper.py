@@ -10,14 +10,13 @@ import torch
 from tqdm import tqdm
 from itertools import cycle
 
-from src.face3d.extract_kp_videos_safe import KeypointExtractor
-from facexlib.alignment import landmark_98_to_68
-
 import numpy as np
 from PIL import Image
 
 class Preprocesser:
     def __init__(self, device='cuda'):
+        # facexlib is imported with the detectors, not with the module
+        from src.face3d.extract_kp_videos_safe import KeypointExtractor
         self.predictor = KeypointExtractor(device)
 
     def get_landmark(self, img_np):
@@ -32,6 +31,7 @@ class Preprocesser:
         det = dets[0]
 
         img = img_np[int(det[1]):int(det[3]), int(det[0]):int(det[2]), :]
+        from facexlib.alignment import landmark_98_to_68
         lm = landmark_98_to_68(self.predictor.detector.get_landmarks(img)) # [0]
 
         #### keypoints to the original location
@@ -124,21 +124,25 @@ class Preprocesser:
         return rsize, crop, [lx, ly, rx, ry]
     
     def crop(self, img_np_list, still=False, xsize=512):    # first frame for all video
-        img_np = img_np_list[0]
+        rsize, crop, quad = self.crop_params(img_np_list[0], xsize=xsize)
+        for _i in range(len(img_np_list)):
+            img_np_list[_i] = self.crop_frame(img_np_list[_i], rsize, crop, quad, still=still)
+        return img_np_list, crop, quad
+
+    def crop_params(self, img_np, xsize=512):
+        """ Resize, crop and quad of the face in img_np, to be applied with crop_frame """
         lm = self.get_landmark(img_np)
 
         if lm is None:
             raise 'can not detect the landmark from source image'
-        rsize, crop, quad = self.align_face(img=Image.fromarray(img_np), lm=lm, output_size=xsize)
+        return self.align_face(img=Image.fromarray(img_np), lm=lm, output_size=xsize)
+
+    def crop_frame(self, img_np, rsize, crop, quad, still=False):
         clx, cly, crx, cry = crop
         lx, ly, rx, ry = quad
         lx, ly, rx, ry = int(lx), int(ly), int(rx), int(ry)
-        for _i in range(len(img_np_list)):
-            _inp = img_np_list[_i]
-            _inp = cv2.resize(_inp, (rsize[0], rsize[1]))
-            _inp = _inp[cly:cry, clx:crx]
-            if not still:
-                _inp = _inp[ly:ry, lx:rx]
-            img_np_list[_i] = _inp
-        return img_np_list, crop, quad
-
+        _inp = cv2.resize(img_np, (rsize[0], rsize[1]))
+        _inp = _inp[cly:cry, clx:crx]
+        if not still:
+            _inp = _inp[ly:ry, lx:rx]
+        return _inp
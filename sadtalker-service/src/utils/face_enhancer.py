@@ -1,11 +1,12 @@
 import os
+import numpy as np
 import torch 
 
-from gfpgan import GFPGANer
+from torchvision.transforms.functional import normalize
 
 from tqdm import tqdm
 
-from src.utils.videoio import load_video_to_cv2
+from src.utils.videoio import VideoReader
 
 import cv2
 
@@ -32,8 +33,7 @@ def enhancer_generator_with_len(images, method='gfpgan', bg_upsampler='realesrga
     call len()"""
 
     if os.path.isfile(images): # handle video to images
-        # TODO: Create a generator version of load_video_to_cv2
-        images = load_video_to_cv2(images)
+        images = VideoReader(images, read_ahead=8)
 
     gen = enhancer_generator_no_len(images, method=method, bg_upsampler=bg_upsampler)
     gen_with_len = GeneratorWithLen(gen, len(images))
@@ -45,9 +45,14 @@ def enhancer_generator_no_len(images, method='gfpgan', bg_upsampler='realesrgan'
     the enhancer function. """
 
     print('face enhancer....')
-    if not isinstance(images, list) and os.path.isfile(images): # handle video to images
-        images = load_video_to_cv2(images)
+    if isinstance(images, str) and os.path.isfile(images): # handle video to images
+        images = VideoReader(images, read_ahead=8)
 
+    # a throw away enhancer, keep a FaceEnhancer around to avoid reloading the models
+    enhancer = FaceEnhancer(method=method, bg_upsampler=bg_upsampler)
+    yield from enhancer.enhance_frames(images)
+
+def build_restorer(method='gfpgan', bg_upsampler='realesrgan'):
     # ------------------------ set up GFPGAN restorer ------------------------
     if  method == 'gfpgan':
         arch = 'clean'
@@ -100,24 +105,125 @@ def enhancer_generator_no_len(images, method='gfpgan', bg_upsampler='realesrgan'
         # download pre-trained models from url
         model_path = url
 
-    restorer = GFPGANer(
+    # gfpgan and basicsr (through it) are imported when a restorer is built, not with the module
+    from gfpgan import GFPGANer
+    return GFPGANer(
         model_path=model_path,
         upscale=2,
         arch=arch,
         channel_multiplier=channel_multiplier,
         bg_upsampler=bg_upsampler)
 
-    # ------------------------ restore ------------------------
-    for idx in tqdm(range(len(images)), 'Face Enhancer:'):
-        
-        img = cv2.cvtColor(images[idx], cv2.COLOR_RGB2BGR)
-        
-        # restore faces and background if necessary
-        cropped_faces, restored_faces, r_img = restorer.enhance(
-            img,
-            has_aligned=False,
-            only_center_face=False,
-            paste_back=True)
-        
-        r_img = cv2.cvtColor(r_img, cv2.COLOR_BGR2RGB)
-        yield r_img
+
+class FaceEnhancer():
+    """ GFPGAN / RestoreFormer restorer that stays loaded between videos.
+
+    Faces of up to `batch_size` frames go through the restoration network together and
+    only the region around the faces is pasted back, the rest of the frame is just resized
+    (or upsampled by the background enhancer). With static_face=True the face detection of
+    the first frame is reused for the whole video, which suits a still avatar.
+    """
+
+    def __init__(self, method='gfpgan', bg_upsampler=None, batch_size=8):
+        self.method = method
+        # the name of the background enhancer, the restorer may still run without it (realesrgan on CPU)
+        self.bg_upsampler = bg_upsampler
+        self.batch_size = batch_size
+        self.restorer = build_restorer(method, bg_upsampler)
+        self.face_helper = self.restorer.face_helper
+
+    def detect(self, img):
+        """ Affine matrices (input to aligned face) of the faces in a BGR image. """
+        self.face_helper.clean_all()
+        self.face_helper.read_image(img)
+        self.face_helper.get_face_landmarks_5(only_center_face=False, eye_dist_threshold=5)
+        self.face_helper.align_warp_face()
+        return list(self.face_helper.affine_matrices)
+
+    def face_region(self, img, affine_matrices):
+        """ Box (x1, y1, x2, y2) of the input image covered by the aligned faces. """
+        h, w = img.shape[:2]
+        face_w, face_h = self.face_helper.face_size
+        corners = np.array([[0, 0], [face_w, 0], [0, face_h], [face_w, face_h]], dtype=np.float64)
+        points = np.concatenate([corners @ M[:, :2].T + M[:, 2] for M in
+                                 (cv2.invertAffineTransform(A) for A in affine_matrices)])
+        # a few pixels more for the interpolation kernels of the paste back
+        x1, y1 = np.floor(points.min(0)).astype(int) - 4
+        x2, y2 = np.ceil(points.max(0)).astype(int) + 4
+        return max(x1, 0), max(y1, 0), min(x2, w), min(y2, h)
+
+    @torch.no_grad()
+    def restore(self, cropped_faces, weight=0.5):
+        """ Run the restoration network on a list of aligned BGR faces at once. """
+        from basicsr.utils import img2tensor, tensor2img
+        faces_t = [img2tensor(face / 255., bgr2rgb=True, float32=True) for face in cropped_faces]
+        faces_t = torch.stack(faces_t).to(self.restorer.device)
+        normalize(faces_t, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5), inplace=True)
+        try:
+            output = self.restorer.gfpgan(faces_t, return_rgb=False, weight=weight)[0]
+            return [tensor2img(face, rgb2bgr=True, min_max=(-1, 1)).astype('uint8') for face in output]
+        except RuntimeError as error:
+            print(f'\tFailed inference for GFPGAN: {error}.')
+            return cropped_faces
+
+    def paste_back(self, img, restored_faces, affine_matrices, region):
+        upscale = self.face_helper.upscale_factor
+        h, w = img.shape[:2]
+        if self.restorer.bg_upsampler is not None:
+            bg_img = self.restorer.bg_upsampler.enhance(img, outscale=upscale)[0]
+        else:
+            bg_img = cv2.resize(img, (int(w * upscale), int(h * upscale)), interpolation=cv2.INTER_LANCZOS4)
+        if len(restored_faces) == 0:
+            return bg_img
+
+        # paste in the face region only, with the affine matrices moved to its origin
+        x1, y1, x2, y2 = region
+        self.face_helper.clean_all()
+        self.face_helper.read_image(img[y1:y2, x1:x2])
+        for M in affine_matrices:
+            M = M.copy()
+            M[:, 2] += M[:, :2] @ np.array([x1, y1], dtype=M.dtype)
+            self.face_helper.affine_matrices.append(M)
+        self.face_helper.get_inverse_affine(None)
+        self.face_helper.restored_faces = list(restored_faces)
+        X1, Y1, X2, Y2 = [int(v * upscale) for v in region]
+        bg_img[Y1:Y2, X1:X2] = self.face_helper.paste_faces_to_input_image(upsample_img=bg_img[Y1:Y2, X1:X2])
+        return bg_img
+
+    def enhance_batch(self, imgs, affine_matrices=None):
+        """ Enhance a list of BGR images, detecting the faces of each image unless affine_matrices is given. """
+        if affine_matrices is None:
+            frame_matrices = [self.detect(img) for img in imgs]
+        else:
+            frame_matrices = [affine_matrices] * len(imgs)
+
+        cropped_faces = []
+        for img, matrices in zip(imgs, frame_matrices):
+            for M in matrices:
+                cropped_faces.append(cv2.warpAffine(img, M, self.face_helper.face_size,
+                                                    borderMode=cv2.BORDER_CONSTANT, borderValue=(135, 133, 132)))
+        restored_faces = self.restore(cropped_faces) if cropped_faces else []
+
+        results = []
+        for img, matrices in zip(imgs, frame_matrices):
+            faces, restored_faces = restored_faces[:len(matrices)], restored_faces[len(matrices):]
+            region = self.face_region(img, matrices) if matrices else None
+            results.append(self.paste_back(img, faces, matrices, region))
+        return results
+
+    def enhance_frames(self, images, static_face=False):
+        """ Enhance an iterable of RGB frames, yielding RGB frames in order. """
+        affine_matrices = None
+        batch = []
+        for image in tqdm(images, 'Face Enhancer:'):
+            img = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+            if static_face and affine_matrices is None:
+                affine_matrices = self.detect(img)
+            batch.append(img)
+            if len(batch) == self.batch_size:
+                for r_img in self.enhance_batch(batch, affine_matrices):
+                    yield cv2.cvtColor(r_img, cv2.COLOR_BGR2RGB)
+                batch = []
+        if batch:
+            for r_img in self.enhance_batch(batch, affine_matrices):
+                yield cv2.cvtColor(r_img, cv2.COLOR_BGR2RGB)
@@ -0,0 +1,118 @@
+"""
+Library of idle loops per avatar, the animation shown between two answers.
+
+An idle loop is rendered once per avatar and render settings from the coefficients of silence, with its end
+blended into its start (close_loop) so that it can be played back to back without a jump. The loops are kept in
+<cache_dir>/<avatar key>/idle_<frames>.mp4 and an idle clip of any length is served by concatenating copies of a
+loop by stream copy (IdleLoopLibrary.serve), which costs a file concatenation instead of a render.
+scripts/build_idle_loops.py renders the loops of a set of avatars ahead of the requests.
+"""
+import glob
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from src.utils.artifact import CoeffArtifact, load_coeff
+from src.utils.audio import AudioBuffer
+from src.utils.ref_cache import file_digest
+from src.utils.videoio import concat_videos
+from src.generate_facerender_batch import get_facerender_data
+
+# lengths of the loops rendered for an avatar, in seconds
+IDLE_LOOP_SECONDS = (4, 8)
+
+
+def default_idle_loop_dir(checkpoint_dir):
+    return os.path.join(checkpoint_dir, 'idle_loops')
+
+
+def close_loop(coeff, blend_frames):
+    """
+    The first len(coeff) - blend_frames frames of coeff with the last blend_frames blended into the start, a
+    CoeffArtifact whose last frame leads into its first one as it leads into the frame after it in coeff.
+    """
+    coeff = load_coeff(coeff)
+    coeff_3dmm = coeff.coeff_3dmm
+    num_frames = coeff_3dmm.shape[0] - blend_frames
+    loop = coeff_3dmm[:num_frames].copy()
+    weight = (np.arange(blend_frames, dtype=np.float32) + 1)[:, None] / (blend_frames + 1)
+    loop[:blend_frames] = weight * coeff_3dmm[:blend_frames] + (1 - weight) * coeff_3dmm[num_frames:]
+    return CoeffArtifact(coeff.name, loop)
+
+
+class IdleLoopLibrary():
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def avatar_key(self, pic_path, **settings):
+        """ the key of the loops of the source image rendered with the settings (preprocess, size, enhancer...) """
+        fields = [file_digest(pic_path)] + ['%s=%s' % item for item in sorted(settings.items())]
+        return hashlib.sha256('|'.join(fields).encode()).hexdigest()
+
+    def loops(self, avatar):
+        """ the (frames, path) of the loops of the avatar, shortest first """
+        paths = glob.glob(os.path.join(self.cache_dir, avatar, 'idle_*.mp4'))
+        return sorted((int(os.path.splitext(os.path.basename(path))[0][len('idle_'):]), path) for path in paths)
+
+    def add(self, avatar, video_path, num_frames):
+        """ move the rendered loop of num_frames frames into the library """
+        avatar_dir = os.path.join(self.cache_dir, avatar)
+        os.makedirs(avatar_dir, exist_ok=True)
+        path = os.path.join(avatar_dir, 'idle_%d.mp4' % num_frames)
+        # copied aside and renamed, concurrent readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(suffix='.mp4', dir=avatar_dir)
+        os.close(fd)
+        shutil.move(video_path, tmp_path)
+        os.replace(tmp_path, path)
+        return path
+
+    def serve(self, avatar, seconds, path, fps=25):
+        """
+        Write seconds of idle animation of the avatar to path, with a silent audio track. The longest loop that
+        fits is repeated and the last repetition cut, the shortest loop is cut when none fits.
+        """
+        loops = self.loops(avatar)
+        if not loops:
+            raise KeyError('no idle loop for avatar %s' % avatar)
+        num_frames = max(1, int(seconds * fps))
+        fitting = [loop for loop in loops if loop[0] <= num_frames]
+        loop_frames, loop_path = fitting[-1] if fitting else loops[0]
+        concat_videos([loop_path] * -(-num_frames // loop_frames), path,
+                      audio=AudioBuffer.silence(num_frames / fps), duration=num_frames / fps)
+        return path
+
+
+def render_idle_loops(library, avatar, pic_path, preprocess_model, audio_to_coeff, animate_from_coeff, save_dir,
+                      seconds=IDLE_LOOP_SECONDS, preprocess='crop', size=256, still=False, enhancer=None,
+                      expression_scale=1.0, pose_style=0, use_blink=True, batch_size=2, seed=0, blend_seconds=1.0, fps=25,
+                      paste_workers=None):
+    """
+    Render the idle loops of seconds seconds of the avatar in pic_path into the library, save_dir holds the
+    intermediate files. The coefficients are predicted from blend_seconds more of silence than the loop lasts,
+    the surplus is blended into the start by close_loop. paste_workers goes to AnimateFromCoeff.generate.
+    Returns the paths of the loops.
+    """
+    first_coeff, crop_pic, crop_info = preprocess_model.generate(pic_path, save_dir, preprocess, True, size)
+    if first_coeff is None:
+        raise AttributeError("No face is detected")
+
+    blend_frames = int(blend_seconds * fps)
+    paths = []
+    for loop_seconds in seconds:
+        num_frames = int(loop_seconds * fps)
+        length_of_audio = (num_frames + blend_frames) / fps
+        coeff = audio_to_coeff.generate_cached(first_coeff, AudioBuffer.silence(length_of_audio, name='idle'), save_dir,
+                                               pose_style, seed=seed, still=still, idlemode=True,
+                                               length_of_audio=length_of_audio, use_blink=use_blink)
+        loop = close_loop(coeff, blend_frames)
+        num_frames = len(loop)
+        data = get_facerender_data(loop, crop_pic, first_coeff, AudioBuffer.silence(num_frames / fps), batch_size,
+                                   still_mode=still, preprocess=preprocess, size=size, expression_scale=expression_scale)
+        video_path = animate_from_coeff.generate(data, save_dir, pic_path, crop_info, enhancer=enhancer,
+                                                 preprocess=preprocess, img_size=size, paste_workers=paste_workers)
+        paths.append(library.add(avatar, video_path, num_frames))
+    return paths
@@ -1,11 +1,59 @@
 import cv2, os
 import numpy as np
+from collections import deque
+from multiprocessing import Pool
 from tqdm import tqdm
-import uuid
 
-from src.utils.videoio import save_video_with_watermark 
+from src.utils.videoio import VideoReader, save_frames_to_video
 
-def paste_pic(video_path, pic_path, crop_info, new_audio_path, full_video_path, extended_crop=False):
+# state of the paste worker processes, set once by _init_clone_worker
+_clone_background = None
+_clone_box = None
+
+def _seamless_clone(crop_frame, background, box):
+    """ Poisson blend one crop frame into background at box = (ox1, oy1, ox2, oy2).
+
+    Only the box region is handed to the solver: seamlessClone zeroes the mask border, so
+    the pixels outside the box are the untouched background and the result is identical
+    to cloning into the full resolution picture.
+    """
+    ox1, oy1, ox2, oy2 = box
+    p = cv2.resize(crop_frame.astype(np.uint8), (ox2-ox1, oy2 - oy1))
+    mask = 255*np.ones(p.shape, p.dtype)
+    h, w = background.shape[:2]
+    if ox1 < 0 or oy1 < 0 or ox2 > w or oy2 > h:
+        location = ((ox1+ox2) // 2, (oy1+oy2) // 2)
+        return cv2.seamlessClone(p, background, mask, location, cv2.NORMAL_CLONE)
+    gen_img = background.copy()
+    location = ((ox2-ox1) // 2, (oy2-oy1) // 2)
+    gen_img[oy1:oy2, ox1:ox2] = cv2.seamlessClone(p, background[oy1:oy2, ox1:ox2], mask, location, cv2.NORMAL_CLONE)
+    return gen_img
+
+def _init_clone_worker(background, box):
+    global _clone_background, _clone_box
+    cv2.setNumThreads(1)
+    _clone_background, _clone_box = background, box
+
+def _clone_worker(crop_frame):
+    return _seamless_clone(crop_frame, _clone_background, _clone_box)
+
+def feather_alpha(height, width, feather):
+    """ Alpha mask of shape (height, width, 1) ramping linearly from 0 at the border to 1 at `feather` pixels in. """
+    feather = max(int(feather), 1)
+    ramp_y = np.minimum(np.arange(height) + 1, height - np.arange(height)) / feather
+    ramp_x = np.minimum(np.arange(width) + 1, width - np.arange(width)) / feather
+    alpha = np.minimum.outer(ramp_y, ramp_x).clip(0, 1)
+    return alpha.astype(np.float32)[..., None]
+
+def paste_frames(crop_frames, pic_path, crop_info, extended_crop=False, method='poisson', num_workers=None, feather=None):
+    """ Paste an iterable of RGB crop frames back onto the full source picture, one frame at a time.
+
+    method='poisson' runs cv2.seamlessClone for every frame, spread over `num_workers` processes
+    (None for up to 4, 0 or 1 to stay in this process). method='feather' clones the first frame
+    only and alpha blends the following frames into that result with a linear feather of
+    `feather` pixels (default a tenth of the box), which is much faster for a static background.
+    Frames are yielded in input order.
+    """
 
     if not os.path.isfile(pic_path):
         raise ValueError('pic_path must be a valid path to video/image file')
@@ -14,31 +62,13 @@ def paste_pic(video_path, pic_path, crop_info, new_audio_path, full_video_path,
         full_img = cv2.imread(pic_path)
     else:
         # loader for videos
-        video_stream = cv2.VideoCapture(pic_path)
-        fps = video_stream.get(cv2.CAP_PROP_FPS)
-        full_frames = [] 
-        while 1:
-            still_reading, frame = video_stream.read()
-            if not still_reading:
-                video_stream.release()
-                break 
-            break 
-        full_img = frame
-    frame_h = full_img.shape[0]
-    frame_w = full_img.shape[1]
-
-    video_stream = cv2.VideoCapture(video_path)
-    fps = video_stream.get(cv2.CAP_PROP_FPS)
-    crop_frames = []
-    while 1:
-        still_reading, frame = video_stream.read()
-        if not still_reading:
-            video_stream.release()
-            break
-        crop_frames.append(frame)
-    
+        full_img = next(iter(VideoReader(pic_path, rgb=False, max_frames=1)))
+    # seamlessClone works per channel, so the paste can be done in RGB
+    full_img = cv2.cvtColor(full_img, cv2.COLOR_BGR2RGB)
+
     if len(crop_info) != 3:
         print("you didn't crop the image")
+        yield from crop_frames
         return
     else:
         r_w, r_h = crop_info[0]
@@ -52,18 +82,59 @@ def paste_pic(video_path, pic_path, crop_info, new_audio_path, full_video_path,
             oy1, oy2, ox1, ox2 = cly, cry, clx, crx
         else:
             oy1, oy2, ox1, ox2 = cly+ly, cly+ry, clx+lx, clx+rx
+    box = (int(ox1), int(oy1), int(ox2), int(oy2))
 
-    tmp_path = str(uuid.uuid4())+'.mp4'
-    out_tmp = cv2.VideoWriter(tmp_path, cv2.VideoWriter_fourcc(*'MP4V'), fps, (frame_w, frame_h))
-    for crop_frame in tqdm(crop_frames, 'seamlessClone:'):
-        p = cv2.resize(crop_frame.astype(np.uint8), (ox2-ox1, oy2 - oy1)) 
+    if method == 'feather':
+        yield from _feather_paste(crop_frames, full_img, box, feather)
+        return
+    elif method != 'poisson':
+        raise ValueError('unknown paste method: %s' % method)
 
-        mask = 255*np.ones(p.shape, p.dtype)
-        location = ((ox1+ox2) // 2, (oy1+oy2) // 2)
-        gen_img = cv2.seamlessClone(p, full_img, mask, location, cv2.NORMAL_CLONE)
-        out_tmp.write(gen_img)
+    if num_workers is None:
+        num_workers = min(4, os.cpu_count() or 1)
+    if num_workers <= 1:
+        for crop_frame in tqdm(crop_frames, 'seamlessClone:'):
+            yield _seamless_clone(crop_frame, full_img, box)
+        return
+
+    # keep a bounded number of frames in flight so the renderer upstream is not drained
+    # into memory, and hand results back strictly in submission order.
+    with Pool(num_workers, initializer=_init_clone_worker, initargs=(full_img, box)) as pool:
+        pending = deque()
+        for crop_frame in tqdm(crop_frames, 'seamlessClone:'):
+            pending.append(pool.apply_async(_clone_worker, (crop_frame,)))
+            if len(pending) >= 2*num_workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+def _feather_paste(crop_frames, full_img, box, feather=None):
+    ox1, oy1, ox2, oy2 = box
+    h, w = full_img.shape[:2]
+    crop_frames = iter(crop_frames)
+    first_frame = next(crop_frames, None)
+    if first_frame is None:
+        return
+    # the Poisson result of the first frame is the static canvas: its border colours are
+    # already matched to the crop, the following frames only need a feathered blend.
+    canvas = _seamless_clone(first_frame, full_img, box)
+    yield canvas
+
+    # clip the box to the picture, the part of the crop falling outside is dropped
+    bx1, by1, bx2, by2 = max(ox1, 0), max(oy1, 0), min(ox2, w), min(oy2, h)
+    if feather is None:
+        feather = 0.1*min(ox2-ox1, oy2-oy1)
+    alpha = feather_alpha(oy2-oy1, ox2-ox1, feather)[by1-oy1:by2-oy1, bx1-ox1:bx2-ox1]
+    canvas_part = (1 - alpha) * canvas[by1:by2, bx1:bx2] + 0.5
+
+    for crop_frame in tqdm(crop_frames, 'featherBlend:'):
+        p = cv2.resize(crop_frame.astype(np.uint8), (ox2-ox1, oy2 - oy1))[by1-oy1:by2-oy1, bx1-ox1:bx2-ox1]
+        gen_img = canvas.copy()
+        gen_img[by1:by2, bx1:bx2] = (alpha * p + canvas_part).astype(np.uint8)
+        yield gen_img
 
-    out_tmp.release()
+def paste_pic(video_path, pic_path, crop_info, new_audio_path, full_video_path, extended_crop=False, method='poisson', num_workers=None):
 
-    save_video_with_watermark(tmp_path, new_audio_path, full_video_path, watermark=False)
-    os.remove(tmp_path)
+    crop_frames = VideoReader(video_path, read_ahead=8)
+    full_frames = paste_frames(crop_frames, pic_path, crop_info, extended_crop=extended_crop, method=method, num_workers=num_workers)
+    save_frames_to_video(full_frames, full_video_path, fps=crop_frames.fps, audio=new_audio_path)
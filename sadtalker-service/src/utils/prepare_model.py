@@ -0,0 +1,116 @@
+"""
+Inference-only conversion of the SadTalker networks, applied once the checkpoints are loaded.
+
+prepare_for_inference() folds every batch norm that directly follows a convolution into the convolution
+weights, bakes the spectral norm of the SPADE decoder into plain weights, and replaces the remaining
+SynchronizedBatchNorm layers (the pre-activation ones of the res blocks) by the torch batch norm. The
+converted network computes the same function in eval mode, but can no longer be trained or load a
+checkpoint.
+"""
+import torch
+from torch import nn
+from torch.nn.utils.spectral_norm import SpectralNorm
+
+from src.facerender.sync_batchnorm.batchnorm import _SynchronizedBatchNorm
+
+# (convolution, batch norm) attribute pairs of the blocks whose forward applies the norm right after the convolution,
+# by class name. nn.Sequential is handled separately, by looking for adjacent pairs.
+FOLDABLE_PAIRS = {
+    # src/facerender/modules
+    'SameBlock2d': [('conv', 'norm')],
+    'DownBlock2d': [('conv', 'norm')],
+    'DownBlock3d': [('conv', 'norm')],
+    'UpBlock2d': [('conv', 'norm')],
+    'UpBlock3d': [('conv', 'norm')],
+    'Decoder': [('conv', 'norm')],
+    'ResBottleneck': [('conv1', 'norm1'), ('conv2', 'norm2'), ('conv3', 'norm3'), ('skip', 'norm4')],
+    'DenseMotionNetwork': [('compress', 'norm')],
+    'HEEstimator': [('conv1', 'norm1'), ('conv2', 'norm2'), ('conv3', 'norm3'), ('conv4', 'norm4'), ('conv5', 'norm5')],
+    # src/face3d/models/networks.py
+    'ResNet': [('conv1', 'bn1')],
+    'BasicBlock': [('conv1', 'bn1'), ('conv2', 'bn2')],
+    'Bottleneck': [('conv1', 'bn1'), ('conv2', 'bn2'), ('conv3', 'bn3')],
+}
+
+CONVS = (nn.Conv1d, nn.Conv2d, nn.Conv3d)
+PLAIN_BATCH_NORMS = {'SynchronizedBatchNorm2d': nn.BatchNorm2d, 'SynchronizedBatchNorm3d': nn.BatchNorm3d}
+
+
+def fold_batch_norm(conv, bn):
+    """ Scale and shift the output channels of conv in place so that it computes bn(conv(x)) with eval statistics. """
+    with torch.no_grad():
+        scale = torch.rsqrt(bn.running_var.double() + bn.eps)
+        bias = -bn.running_mean.double() * scale
+        if bn.affine:
+            scale = scale * bn.weight.double()
+            bias = bias * bn.weight.double() + bn.bias.double()
+        if conv.bias is not None:
+            bias = bias + conv.bias.double() * scale
+        weight = conv.weight.double() * scale.reshape((-1,) + (1,) * (conv.weight.dim() - 1))
+        conv.weight = nn.Parameter(weight.to(conv.weight.dtype), requires_grad=False)
+        conv.bias = nn.Parameter(bias.to(conv.weight.dtype), requires_grad=False)
+
+
+def can_fold(conv, bn):
+    return (isinstance(conv, CONVS) and isinstance(bn, nn.modules.batchnorm._BatchNorm)
+            and bn.track_running_stats and bn.running_mean is not None and bn.num_features == conv.out_channels)
+
+
+def bake_spectral_norm(model):
+    """ Replace the spectral norm hooks by the weights they compute in eval mode. """
+    count = 0
+    for module in list(model.modules()):
+        for hook in list(module._forward_pre_hooks.values()):
+            if isinstance(hook, SpectralNorm):
+                nn.utils.remove_spectral_norm(module, hook.name)
+                getattr(module, hook.name).requires_grad = False
+                count += 1
+    return count
+
+
+def fold_batch_norms(model):
+    """ Fold the batch norms following a convolution into it, the batch norm becomes an identity. """
+    count = 0
+    for module in list(model.modules()):
+        if isinstance(module, nn.Sequential):
+            for i in range(len(module) - 1):
+                if can_fold(module[i], module[i + 1]):
+                    fold_batch_norm(module[i], module[i + 1])
+                    module[i + 1] = nn.Identity()
+                    count += 1
+        for conv_name, bn_name in FOLDABLE_PAIRS.get(type(module).__name__, []):
+            conv, bn = getattr(module, conv_name, None), getattr(module, bn_name, None)
+            if can_fold(conv, bn):
+                fold_batch_norm(conv, bn)
+                setattr(module, bn_name, nn.Identity())
+                count += 1
+    return count
+
+
+def replace_sync_batch_norms(model):
+    """ Swap SynchronizedBatchNorm2d/3d for nn.BatchNorm2d/3d with the same statistics. """
+    count = 0
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            plain_batch_norm = PLAIN_BATCH_NORMS.get(type(child).__name__)
+            if isinstance(child, _SynchronizedBatchNorm) and plain_batch_norm is not None:
+                bn = plain_batch_norm(child.num_features, eps=child.eps, momentum=child.momentum,
+                                      affine=child.affine, track_running_stats=child.track_running_stats)
+                bn.load_state_dict(child.state_dict())
+                setattr(module, name, bn.to(child.running_mean.device).eval())
+                count += 1
+    return count
+
+
+def prepare_for_inference(model, verbose=False):
+    """ Convert a loaded network for inference, in place, and return it in eval mode without gradients. """
+    model.eval()
+    baked = bake_spectral_norm(model)
+    folded = fold_batch_norms(model)
+    replaced = replace_sync_batch_norms(model)
+    for param in model.parameters():
+        param.requires_grad = False
+    if verbose:
+        print('%s: %d spectral norms baked, %d batch norms folded, %d sync batch norms replaced'
+              % (type(model).__name__, baked, folded, replaced))
+    return model
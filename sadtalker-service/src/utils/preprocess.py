@@ -1,22 +1,27 @@
 import numpy as np
 import cv2, os, sys, torch
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from PIL import Image 
 
 # 3dmm extraction
-import safetensors
-import safetensors.torch 
 from src.face3d.util.preprocess import align_img
 from src.face3d.util.load_mats import load_lm3d
 from src.face3d.models import networks
 
 from scipy.io import loadmat, savemat
 from src.utils.croper import Preprocesser
+from src.utils.videoio import VideoReader
 
 
 import warnings
 
 from src.utils.safetensor_helper import load_x_from_safetensor 
+from src.utils.backend import load_network
+from src.utils.prepare_model import prepare_for_inference
+from src.utils.ref_cache import RefCoeffCache
+from src.utils.artifact import CoeffArtifact
 warnings.filterwarnings("ignore")
 
 def split_coeff(coeffs):
@@ -44,23 +49,68 @@ def split_coeff(coeffs):
 
 
 class CropAndExtract():
-    def __init__(self, sadtalker_path, device):
+    def __init__(self, sadtalker_path, device, backend='torch', export_dir=None, ref_cache_dir=None):
 
         self.propress = Preprocesser(device)
         self.net_recon = networks.define_net_recon(net_recon='resnet50', use_last_fc=False, init_path='').to(device)
         
         if sadtalker_path['use_safetensor']:
+            import safetensors.torch
             checkpoint = safetensors.torch.load_file(sadtalker_path['checkpoint'])    
             self.net_recon.load_state_dict(load_x_from_safetensor(checkpoint, 'face_3drecon'))
         else:
             checkpoint = torch.load(sadtalker_path['path_of_net_recon_model'], map_location=torch.device(device))    
             self.net_recon.load_state_dict(checkpoint['net_recon'])
 
-        self.net_recon.eval()
+        prepare_for_inference(self.net_recon)
+        if backend != 'torch':
+            self.net_recon = load_network('net_recon', backend, export_dir, device)
         self.lm3d_std = load_lm3d(sadtalker_path['dir_of_BFM_fitting'])
         self.device = device
+        self.ref_cache = RefCoeffCache(ref_cache_dir) if ref_cache_dir is not None else None
     
-    def generate(self, input_path, save_dir, crop_or_resize='crop', source_image_flag=False, pic_size=256):
+    def align_frame(self, frame, lm):
+        """ the trans params (float32) and the 224x224 crop (uint8 array) given to net_recon for one frame """
+        W,H = frame.size
+        lm1 = lm.reshape([-1, 2])
+    
+        if np.mean(lm1) == -1:
+            lm1 = (self.lm3d_std[:, :2]+1)/2.
+            lm1 = np.concatenate(
+                [lm1[:, :1]*W, lm1[:, 1:2]*H], 1
+            )
+        else:
+            lm1 = lm1.copy()
+            lm1[:, -1] = H - 1 - lm1[:, -1]
+
+        trans_params, im1, lm1, _ = align_img(frame, lm1, self.lm3d_std)
+
+        trans_params = np.array([float(item) for item in np.hsplit(trans_params, 5)]).astype(np.float32)
+        return trans_params, np.array(im1)
+
+    def generate_ref_coeff(self, ref_path, save_dir, crop_or_resize='crop', detect_every=1, persist=False):
+        """ the CoeffArtifact of a reference video, loaded from the reference cache when it is there """
+        if self.ref_cache is None:
+            return self.generate(ref_path, save_dir, crop_or_resize, source_image_flag=False, detect_every=detect_every, persist=persist)[0]
+
+        cached_path = self.ref_cache.get(ref_path, crop_or_resize, detect_every)
+        if cached_path is not None:
+            print(' Using cached coefficients of the reference video.')
+            coeff = CoeffArtifact.load(cached_path, name=os.path.splitext(os.path.split(ref_path)[-1])[0])
+            coeff.path = None
+            if persist:
+                coeff.save(save_dir)
+            return coeff
+        coeff, _, _ = self.generate(ref_path, save_dir, crop_or_resize, source_image_flag=False, detect_every=detect_every, persist=persist)
+        if coeff is not None:
+            self.ref_cache.put(ref_path, crop_or_resize, coeff, detect_every)
+        return coeff
+
+    def generate(self, input_path, save_dir, crop_or_resize='crop', source_image_flag=False, pic_size=256, chunk_size=64, detect_every=1, recon_batch_size=16, persist=False):
+        """
+        The CoeffArtifact of the input image or video, the cropped frame (RGB array) and the crop info. The
+        landmarks, the cropped frame and the coefficients are only written to save_dir with persist.
+        """
 
         pic_name = os.path.splitext(os.path.split(input_path)[-1])[0]  
 
@@ -73,98 +123,106 @@ class CropAndExtract():
             raise ValueError('input_path must be a valid path to video/image file')
         elif input_path.split('.')[-1] in ['jpg', 'png', 'jpeg']:
             # loader for first frame
-            full_frames = [cv2.imread(input_path)]
+            full_frames = [cv2.cvtColor(cv2.imread(input_path), cv2.COLOR_BGR2RGB)]
             fps = 25
         else:
-            # loader for videos
-            video_stream = cv2.VideoCapture(input_path)
-            fps = video_stream.get(cv2.CAP_PROP_FPS)
-            full_frames = [] 
-            while 1:
-                still_reading, frame = video_stream.read()
-                if not still_reading:
-                    video_stream.release()
-                    break 
-                full_frames.append(frame) 
-                if source_image_flag:
-                    break
-
-        x_full_frames= [cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)  for frame in full_frames] 
+            # loader for videos, frames are decoded while the previous ones are processed
+            full_frames = VideoReader(input_path, read_ahead=8, max_frames=1 if source_image_flag else None)
+            fps = full_frames.fps
+        num_frames = len(full_frames)
+        full_frames = iter(full_frames)
+        first_frame = next(full_frames, None)
+        if first_frame is None:
+            print('No face is detected in the input file')
+            return None, None, None
 
         #### crop images as the 
-        if 'crop' in crop_or_resize.lower(): # default crop
-            x_full_frames, crop, quad = self.propress.crop(x_full_frames, still=True if 'ext' in crop_or_resize.lower() else False, xsize=512)
-            clx, cly, crx, cry = crop
-            lx, ly, rx, ry = quad
-            lx, ly, rx, ry = int(lx), int(ly), int(rx), int(ry)
-            oy1, oy2, ox1, ox2 = cly+ly, cly+ry, clx+lx, clx+rx
-            crop_info = ((ox2 - ox1, oy2 - oy1), crop, quad)
-        elif 'full' in crop_or_resize.lower():
-            x_full_frames, crop, quad = self.propress.crop(x_full_frames, still=True if 'ext' in crop_or_resize.lower() else False, xsize=512)
+        if 'crop' in crop_or_resize.lower() or 'full' in crop_or_resize.lower(): # default crop
+            rsize, crop, quad = self.propress.crop_params(first_frame, xsize=512)
+            still = True if 'ext' in crop_or_resize.lower() else False
+            crop_frame = lambda frame: self.propress.crop_frame(frame, rsize, crop, quad, still=still)
             clx, cly, crx, cry = crop
             lx, ly, rx, ry = quad
             lx, ly, rx, ry = int(lx), int(ly), int(rx), int(ry)
             oy1, oy2, ox1, ox2 = cly+ly, cly+ry, clx+lx, clx+rx
             crop_info = ((ox2 - ox1, oy2 - oy1), crop, quad)
         else: # resize mode
-            oy1, oy2, ox1, ox2 = 0, x_full_frames[0].shape[0], 0, x_full_frames[0].shape[1] 
+            crop_frame = lambda frame: frame
+            oy1, oy2, ox1, ox2 = 0, first_frame.shape[0], 0, first_frame.shape[1] 
             crop_info = ((ox2 - ox1, oy2 - oy1), None, None)
 
-        frames_pil = [Image.fromarray(cv2.resize(frame,(pic_size, pic_size))) for frame in x_full_frames]
-        if len(frames_pil) == 0:
-            print('No face is detected in the input file')
-            return None, None
-
-        # save crop info
-        for frame in frames_pil:
-            cv2.imwrite(png_path, cv2.cvtColor(np.array(frame), cv2.COLOR_RGB2BGR))
-
-        # 2. get the landmark according to the detected face. 
-        if not os.path.isfile(landmarks_path): 
-            lm = self.propress.predictor.extract_keypoint(frames_pil, landmarks_path)
-        else:
+        if os.path.isfile(landmarks_path):
             print(' Using saved landmarks.')
-            lm = np.loadtxt(landmarks_path).astype(np.float32)
-            lm = lm.reshape([len(x_full_frames), -1, 2])
-
-        if not os.path.isfile(coeff_path):
-            # load 3dmm paramter generator from Deep3DFaceRecon_pytorch 
-            video_coeffs, full_coeffs = [],  []
-            for idx in tqdm(range(len(frames_pil)), desc='3DMM Extraction In Video:'):
-                frame = frames_pil[idx]
-                W,H = frame.size
-                lm1 = lm[idx].reshape([-1, 2])
-            
-                if np.mean(lm1) == -1:
-                    lm1 = (self.lm3d_std[:, :2]+1)/2.
-                    lm1 = np.concatenate(
-                        [lm1[:, :1]*W, lm1[:, 1:2]*H], 1
-                    )
+            saved_lm = np.loadtxt(landmarks_path).astype(np.float32).reshape([-1, 68, 2])
+        else:
+            saved_lm = None
+        extract_coeff = not os.path.isfile(coeff_path)
+
+        # frames are cropped, landmarked and fitted chunk by chunk, so only chunk_size
+        # frames are held in memory whatever the length of the video.
+        full_frames = itertools.chain([first_frame], full_frames)
+        landmarks, video_coeffs, full_coeffs = [], [], []
+        num_done = 0
+        progress = tqdm(desc='3DMM Extraction In Video:', total=num_frames)
+        # the alignment is numpy and PIL work that mostly releases the GIL
+        with ThreadPoolExecutor(min(4, os.cpu_count() or 1)) as align_pool:
+            while 1:
+                chunk = list(itertools.islice(full_frames, chunk_size))
+                if len(chunk) == 0:
+                    break
+                frames_pil = [Image.fromarray(cv2.resize(crop_frame(frame),(pic_size, pic_size))) for frame in chunk]
+                # save crop info
+                last_frame = frames_pil[-1]
+
+                # 2. get the landmark according to the detected face. 
+                if saved_lm is None:
+                    lm = self.propress.predictor.extract_keypoint(frames_pil, info=False, detect_every=detect_every)
+                    # a frame without a face takes the landmarks of the previous frame, across chunks as well
+                    for idx in range(len(lm)):
+                        if np.mean(lm[idx]) == -1 and landmarks:
+                            lm[idx] = landmarks[-1][-1]
+                        landmarks.append(lm[idx:idx+1].copy())
                 else:
-                    lm1[:, -1] = H - 1 - lm1[:, -1]
-
-                trans_params, im1, lm1, _ = align_img(frame, lm1, self.lm3d_std)
- 
-                trans_params = np.array([float(item) for item in np.hsplit(trans_params, 5)]).astype(np.float32)
-                im_t = torch.tensor(np.array(im1)/255., dtype=torch.float32).permute(2, 0, 1).to(self.device).unsqueeze(0)
-                
-                with torch.no_grad():
-                    full_coeff = self.net_recon(im_t)
-                    coeffs = split_coeff(full_coeff)
-
-                pred_coeff = {key:coeffs[key].cpu().numpy() for key in coeffs}
- 
-                pred_coeff = np.concatenate([
-                    pred_coeff['exp'], 
-                    pred_coeff['angle'],
-                    pred_coeff['trans'],
-                    trans_params[2:][None],
-                    ], 1)
-                video_coeffs.append(pred_coeff)
-                full_coeffs.append(full_coeff.cpu().numpy())
-
-            semantic_npy = np.array(video_coeffs)[:,0] 
-
-            savemat(coeff_path, {'coeff_3dmm': semantic_npy, 'full_3dmm': np.array(full_coeffs)[0]})
-
-        return coeff_path, png_path, crop_info
+                    lm = saved_lm[num_done:num_done+len(frames_pil)].copy()
+
+                if extract_coeff:
+                    # load 3dmm paramter generator from Deep3DFaceRecon_pytorch 
+                    aligned = list(align_pool.map(self.align_frame, frames_pil, lm))
+                    im_t = torch.tensor(np.stack([im1 for _, im1 in aligned])/255., dtype=torch.float32).permute(0, 3, 1, 2).to(self.device)
+
+                    for start in range(0, len(aligned), recon_batch_size):
+                        with torch.no_grad():
+                            full_coeff = self.net_recon(im_t[start:start+recon_batch_size])
+                            coeffs = split_coeff(full_coeff)
+
+                        pred_coeff = {key:coeffs[key].cpu().numpy() for key in coeffs}
+                        trans_params = np.stack([trans_params for trans_params, _ in aligned[start:start+recon_batch_size]])
+     
+                        pred_coeff = np.concatenate([
+                            pred_coeff['exp'], 
+                            pred_coeff['angle'],
+                            pred_coeff['trans'],
+                            trans_params[:, 2:],
+                            ], 1)
+                        full_coeff = full_coeff.cpu().numpy()
+                        for idx in range(len(pred_coeff)):
+                            video_coeffs.append(pred_coeff[idx:idx+1])
+                            full_coeffs.append(full_coeff[idx:idx+1])
+                num_done += len(chunk)
+                progress.update(len(chunk))
+        progress.close()
+
+        crop_pic = np.array(last_frame)
+        if persist:
+            cv2.imwrite(png_path, cv2.cvtColor(crop_pic, cv2.COLOR_RGB2BGR))
+            if saved_lm is None:
+                np.savetxt(landmarks_path, np.concatenate(landmarks).reshape(-1))
+
+        if extract_coeff:
+            coeff = CoeffArtifact(pic_name, np.array(video_coeffs)[:,0], np.array(full_coeffs)[0])
+            if persist:
+                coeff.save(save_dir)
+        else:
+            coeff = CoeffArtifact.load(coeff_path)
+
+        return coeff, crop_pic, crop_info
@@ -0,0 +1,67 @@
+"""
+Cache of the 3DMM coefficients of the reference videos (ref_pose, ref_eyeblink, the ref video of the webui).
+
+A reference video always gives the same coeff_3dmm for a given preprocess mode, so the CoeffArtifact returned by
+CropAndExtract.generate is saved in the cache directory under the SHA-256 of the video content and the mode,
+<cache_dir>/<sha256>_<preprocess>.mat, and loaded back by CropAndExtract.generate_ref_coeff on the next request.
+Renamed or copied clips hit the same entry. scripts/warm_ref_cache.py fills the cache for a directory of clips
+ahead of the requests.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+
+from scipy.io import savemat
+
+
+def default_ref_cache_dir(checkpoint_dir):
+    return os.path.join(checkpoint_dir, 'ref_cache')
+
+
+_digests = {}
+_digests_lock = threading.Lock()
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """ SHA-256 of the file content, remembered per (path, size, mtime) so a resident process hashes a clip once """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _digests_lock:
+        if key in _digests:
+            return _digests[key]
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            sha.update(block)
+    with _digests_lock:
+        _digests[key] = sha.hexdigest()
+    return _digests[key]
+
+
+class RefCoeffCache():
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, video_path, preprocess, detect_every=1):
+        name = '%s_%s' % (file_digest(video_path), preprocess.lower())
+        if detect_every != 1:
+            # the tracked boxes give slightly different landmarks
+            name += '_every%d' % detect_every
+        return os.path.join(self.cache_dir, name + '.mat')
+
+    def get(self, video_path, preprocess, detect_every=1):
+        """ the path of the cached .mat of the video, None on a miss """
+        path = self.path(video_path, preprocess, detect_every)
+        return path if os.path.isfile(path) else None
+
+    def put(self, video_path, preprocess, coeff, detect_every=1):
+        """ save the CoeffArtifact of the video into the cache and return the cached path """
+        path = self.path(video_path, preprocess, detect_every)
+        # written aside and renamed, concurrent readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(suffix='.mat', dir=self.cache_dir)
+        os.close(fd)
+        savemat(tmp_path, coeff.to_mat())
+        os.replace(tmp_path, path)
+        return path
@@ -1,26 +1,197 @@
+import contextlib
 import shutil
+import tempfile
 import uuid
+import subprocess
+import threading
+import queue
 
 import os
 
 import cv2
+import numpy as np
 
-def load_video_to_cv2(input_path):
-    video_stream = cv2.VideoCapture(input_path)
-    fps = video_stream.get(cv2.CAP_PROP_FPS)
-    full_frames = [] 
-    while 1:
-        still_reading, frame = video_stream.read()
-        if not still_reading:
+class VideoReader():
+    """ Iterate over the frames of a video file one at a time, RGB unless rgb=False.
+
+    Only `read_ahead` decoded frames are kept around: with read_ahead > 0 a background
+    thread decodes that many frames ahead of the consumer, with 0 frames are decoded on
+    demand. max_frames stops after the first max_frames frames.
+    """
+
+    def __init__(self, path, rgb=True, read_ahead=0, max_frames=None):
+        self.path = path
+        self.rgb = rgb
+        self.read_ahead = read_ahead
+        self.max_frames = max_frames
+        video_stream = cv2.VideoCapture(path)
+        self.fps = video_stream.get(cv2.CAP_PROP_FPS)
+        self.frame_count = int(video_stream.get(cv2.CAP_PROP_FRAME_COUNT))
+        video_stream.release()
+        if max_frames is not None:
+            self.frame_count = min(self.frame_count, max_frames)
+
+    def __len__(self):
+        # from the container header, which can be off by a few frames for some codecs
+        return self.frame_count
+
+    def _read(self):
+        video_stream = cv2.VideoCapture(self.path)
+        try:
+            num_frames = 0
+            while self.max_frames is None or num_frames < self.max_frames:
+                still_reading, frame = video_stream.read()
+                if not still_reading:
+                    break
+                num_frames += 1
+                yield cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) if self.rgb else frame
+        finally:
             video_stream.release()
-            break 
-        full_frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-    return full_frames
+
+    def __iter__(self):
+        if self.read_ahead <= 0:
+            return self._read()
+        return self._read_ahead()
+
+    def _read_ahead(self):
+        frames = queue.Queue(maxsize=self.read_ahead)
+        stop = threading.Event()
+        done = object()
+        # an exception of the decoder, re-raised in the consumer instead of ending the stream early
+        errors = []
+
+        def decode():
+            try:
+                for frame in self._read():
+                    while not stop.is_set():
+                        try:
+                            frames.put(frame, timeout=0.1)
+                            break
+                        except queue.Full:
+                            pass
+                    if stop.is_set():
+                        return
+            except Exception as error:
+                errors.append(error)
+            finally:
+                while not stop.is_set():
+                    try:
+                        frames.put(done, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+
+        worker = threading.Thread(target=decode, daemon=True)
+        worker.start()
+        try:
+            while 1:
+                frame = frames.get()
+                if frame is done:
+                    if errors:
+                        raise errors[0]
+                    break
+                yield frame
+        finally:
+            # also reached when the consumer stops early, let the decoder exit
+            stop.set()
+            worker.join()
+
+def load_video_to_cv2(input_path):
+    return list(VideoReader(input_path))
+
+@contextlib.contextmanager
+def audio_input(audio, duration=None):
+    """ What to give ffmpeg as the audio input: a path as it is, an AudioBuffer (src/utils/audio.py) as a WAV
+    stream written by a thread into a named pipe, cut or padded to duration seconds. """
+    if audio is None or isinstance(audio, str):
+        yield audio
+        return
+    data = audio.to_wav_bytes(duration)
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, 'audio.wav')
+    if not hasattr(os, 'mkfifo'):
+        # no named pipes on Windows, the WAV goes through a temporary file there
+        with open(path, 'wb') as f:
+            f.write(data)
+        try:
+            yield path
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return
+
+    os.mkfifo(path)
+    def feed():
+        try:
+            with open(path, 'wb') as f:
+                f.write(data)
+        except BrokenPipeError:
+            # ffmpeg stopped reading, past -t or on an error
+            pass
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    try:
+        yield path
+    finally:
+        while feeder.is_alive():
+            # ffmpeg never opened the pipe: open and close the read end so the feeder stops waiting
+            os.close(os.open(path, os.O_RDONLY | os.O_NONBLOCK))
+            feeder.join(0.1)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def save_frames_to_video(frames, path, fps=25, audio=None, duration=None):
+    """ Stream RGB uint8 frames from any iterable into an ffmpeg encoder subprocess.
+    Frames are written as they arrive, so the video is never held in memory. 
+    When audio is given, the path of a file or an AudioBuffer, it is muxed in the same ffmpeg pass, cut to
+    duration seconds. Uses the same encoder settings as imageio.mimsave. Returns the number of frames written. """
+    output_params = []
+    if duration is not None:
+        output_params += ['-t', '%.3f' % duration]
+    import imageio_ffmpeg
+    writer = None
+    num_frames = 0
+    with audio_input(audio, duration) as audio_path:
+        try:
+            for frame in frames:
+                if writer is None:
+                    h, w = frame.shape[:2]
+                    writer = imageio_ffmpeg.write_frames(path, (w, h), fps=float(fps), quality=5, macro_block_size=16,
+                                                         audio_path=audio_path, audio_codec='aac' if audio_path else None,
+                                                         output_params=output_params)
+                    writer.send(None)
+                writer.send(np.ascontiguousarray(frame))
+                num_frames += 1
+        finally:
+            if writer is not None:
+                writer.close()
+    return num_frames
+
+def concat_videos(paths, path, audio=None, duration=None, fps=25):
+    """ Join videos encoded with the same settings (save_frames_to_video) by stream copy, nothing is re-encoded.
+    audio, the path of a file or an AudioBuffer, is muxed in the same pass, cut to duration seconds. """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        list_path = os.path.join(tmp_dir, 'concat.txt')
+        with open(list_path, 'w') as f:
+            for video_path in paths:
+                f.write("file '%s'\n" % os.path.abspath(video_path).replace("'", "'\\''"))
+        args = ['-f', 'concat', '-safe', '0', '-i', list_path]
+        with audio_input(audio, duration) as audio_path:
+            if audio_path:
+                args += ['-i', audio_path, '-map', '0:v:0', '-map', '1:a:0', '-c:a', 'aac']
+            args += ['-c:v', 'copy']
+            if duration is not None:
+                # -t alone keeps the copied frame starting at duration
+                args += ['-frames:v', str(int(round(duration * fps))), '-t', '%.3f' % duration]
+            run_ffmpeg(args + [path])
+
+def run_ffmpeg(args):
+    """ Run ffmpeg with a list of arguments (no shell), raising if it fails. """
+    import imageio_ffmpeg
+    cmd = [imageio_ffmpeg.get_ffmpeg_exe(), '-y', '-hide_banner', '-loglevel', 'error'] + list(args)
+    subprocess.run(cmd, check=True)
 
 def save_video_with_watermark(video, audio, save_path, watermark=False):
     temp_file = str(uuid.uuid4())+'.mp4'
-    cmd = r'ffmpeg -y -hide_banner -loglevel error -i "%s" -i "%s" -vcodec copy "%s"' % (video, audio, temp_file)
-    os.system(cmd)
+    run_ffmpeg(['-i', video, '-i', audio, '-vcodec', 'copy', temp_file])
 
     if watermark is False:
         shutil.move(temp_file, save_path)
@@ -36,6 +207,5 @@ def save_video_with_watermark(video, audio, save_path, watermark=False):
             dir_path = os.path.dirname(os.path.realpath(__file__))
             watarmark_path = dir_path+"/../../docs/sadtalker_logo.png"
 
-        cmd = r'ffmpeg -y -hide_banner -loglevel error -i "%s" -i "%s" -filter_complex "[1]scale=100:-1[wm];[0][wm]overlay=(main_w-overlay_w)-10:10" "%s"' % (temp_file, watarmark_path, save_path)
-        os.system(cmd)
-        os.remove(temp_file)
\ No newline at end of file
+        run_ffmpeg(['-i', temp_file, '-i', watarmark_path, '-filter_complex', '[1]scale=100:-1[wm];[0][wm]overlay=(main_w-overlay_w)-10:10', save_path])
+        os.remove(temp_file)